@@ -0,0 +1,198 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+import redis
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+from fastapi.encoders import jsonable_encoder
+
+
+load_dotenv()
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", None)
+
+# binary-safe client (no decode_responses), callers encode/decode their own payloads
+redis_client = aioredis.Redis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    password=REDIS_PASSWORD,
+    socket_connect_timeout=5
+)
+
+
+async def cache_get(key: str):
+    try:
+        return await redis_client.get(key)
+    except redis.RedisError as e:
+        print(f"Redis error in cache_get: {e}")
+        return None
+
+
+async def cache_set(key: str, value, ttl: int):
+    try:
+        await redis_client.setex(key, ttl, value)
+    except redis.RedisError as e:
+        print(f"Redis error in cache_set: {e}")
+
+
+# every invalidation bumps the key's version, a value read from the DB before that bump is dropped instead of cached
+CACHE_VERSION_TTL = int(os.getenv("CACHE_VERSION_TTL", 86400))
+
+_set_if_current = redis_client.register_script("""
+if (redis.call('get', KEYS[2]) or '0') == ARGV[1] then
+    redis.call('setex', KEYS[1], ARGV[3], ARGV[2])
+    return 1
+end
+return 0
+""")
+
+
+def cache_version_key(key: str):
+    return f"{key}:version"
+
+
+async def cache_version(key: str):
+    # read before loading the value, None when Redis is down
+    try:
+        return (await redis_client.get(cache_version_key(key)) or b"0").decode()
+    except redis.RedisError as e:
+        print(f"Redis error in cache_version: {e}")
+        return None
+
+
+async def cache_set_if_current(key: str, value, ttl: int, version):
+    # returns whether the value was stored, False if the key was invalidated since `version` was read
+    if version is None:
+        return False
+    try:
+        return bool(await _set_if_current(keys=[key, cache_version_key(key)], args=[version, value, ttl]))
+    except redis.RedisError as e:
+        print(f"Redis error in cache_set_if_current: {e}")
+        return False
+
+
+async def cache_bump(*keys: str):
+    # deletes the keys and moves their versions on, so loaders already past cache_version can't put them back
+    if not keys:
+        return
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            for key in keys:
+                pipe.incr(cache_version_key(key))
+                pipe.expire(cache_version_key(key), CACHE_VERSION_TTL)
+            pipe.delete(*keys)
+            await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Redis error in cache_bump: {e}")
+
+
+async def cache_delete(*keys: str):
+    if not keys:
+        return
+    try:
+        await redis_client.delete(*keys)
+    except redis.RedisError as e:
+        print(f"Redis error in cache_delete: {e}")
+
+
+LOCAL_CACHE_SIZE = int(os.getenv("LOCAL_CACHE_SIZE", 1024))
+LOCAL_CACHE_TTL = float(os.getenv("LOCAL_CACHE_TTL", 30))
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+
+class LocalCache:
+    # per-worker LRU with TTL, sits in front of Redis for small hot payloads
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # moves on with every delete/clear, see set()
+        self.generation = 0
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value, generation: int = None):
+        # a value read before an invalidation reached this worker is not kept
+        if generation is not None and generation != self.generation:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def delete(self, *keys: str):
+        self.generation += 1
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+
+
+local_cache = LocalCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+
+
+async def cached_json(key: str, ttl: int, loader):
+    # read-through: worker memory -> Redis -> loader(). None from the loader is not cached.
+    # Every caller gets the same object back, copy it before changing anything.
+    generation = local_cache.generation
+    value = local_cache.get(key)
+    if value is not None:
+        return value
+
+    raw = await cache_get(key)
+    if raw is not None:
+        value = json.loads(raw)
+    else:
+        version = await cache_version(key)
+        value = await loader()
+        if value is None:
+            return None
+        value = jsonable_encoder(value)
+        # invalidated while loading, serve it this once but keep it out of both tiers
+        if not await cache_set_if_current(key, json.dumps(value), ttl, version):
+            return value
+
+    local_cache.set(key, value, generation)
+    return value
+
+
+async def invalidate(*keys: str):
+    if not keys:
+        return
+    local_cache.delete(*keys)
+    await cache_bump(*keys)
+    try:
+        await redis_client.publish(INVALIDATION_CHANNEL, json.dumps(keys))
+    except redis.RedisError as e:
+        print(f"Redis error in invalidate: {e}")
+
+
+async def listen_for_invalidations():
+    # runs once per worker for the app's lifetime, drops keys other workers invalidated from local_cache
+    while True:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            async for message in pubsub.listen():
+                local_cache.delete(*json.loads(message["data"]))
+        except redis.RedisError as e:
+            print(f"Redis error in listen_for_invalidations: {e}")
+            # messages may have been missed while disconnected, start over cold
+            local_cache.clear()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
@@ -0,0 +1,127 @@
+import math
+import os
+from sqlalchemy import select, delete, func, literal, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import LocalCache
+from database import AsyncSessionLocal
+from models import Pin, PinCluster
+
+CLUSTER_MIN_ZOOM = 0
+CLUSTER_MAX_ZOOM = 18
+
+# pins rarely move, a moved pin is placed at its old location until its entry expires
+_pin_locations = LocalCache(int(os.getenv("PIN_LOCATION_CACHE_SIZE", 10000)), 3600)
+
+
+def grid_size(zoom: int):
+    return 180 / (2 ** zoom)
+
+
+def cell_for(lon: float, lat: float, zoom: int):
+    size = grid_size(zoom)
+    return math.floor(lon / size), math.floor(lat / size)
+
+
+async def pin_location(pin_id: int):
+    # (lon, lat) of a pin for code that places events on the grid outside a request, None if it has no point
+    location = _pin_locations.get(str(pin_id))
+    if location is None:
+        async with AsyncSessionLocal() as db:
+            point = (await db.execute(
+                select(func.ST_X(Pin.coordinates), func.ST_Y(Pin.coordinates)).where(Pin.id == pin_id)
+            )).first()
+        if point is None or point[0] is None:
+            return None
+        location = (point[0], point[1])
+        _pin_locations.set(str(pin_id), location)
+    return location
+
+
+def forget_pin_location(pin_id: int):
+    # after this worker moved or deleted the pin, the other workers catch up when their entry expires
+    _pin_locations.delete(str(pin_id))
+
+
+async def _shift_clusters(db: AsyncSession, lon: float, lat: float, sign: int):
+    rows = []
+    for zoom in range(CLUSTER_MIN_ZOOM, CLUSTER_MAX_ZOOM + 1):
+        grid_x, grid_y = cell_for(lon, lat, zoom)
+        rows.append({
+            "zoom": zoom,
+            "grid_x": grid_x,
+            "grid_y": grid_y,
+            "count": sign,
+            "sum_lon": lon * sign,
+            "sum_lat": lat * sign,
+        })
+
+    stmt = insert(PinCluster).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PinCluster.zoom, PinCluster.grid_x, PinCluster.grid_y],
+        set_={
+            "count": PinCluster.count + stmt.excluded.count,
+            "sum_lon": PinCluster.sum_lon + stmt.excluded.sum_lon,
+            "sum_lat": PinCluster.sum_lat + stmt.excluded.sum_lat,
+        }
+    )
+    await db.execute(stmt)
+
+    if sign < 0:
+        keys = [(r["zoom"], r["grid_x"], r["grid_y"]) for r in rows]
+        await db.execute(
+            delete(PinCluster).where(
+                tuple_(PinCluster.zoom, PinCluster.grid_x, PinCluster.grid_y).in_(keys),
+                PinCluster.count <= 0
+            )
+        )
+
+
+# these run inside the caller's transaction, so the pyramid commits (or rolls back) together with the pin itself
+async def add_pin_to_clusters(db: AsyncSession, lon: float, lat: float):
+    await _shift_clusters(db, lon, lat, 1)
+
+
+async def remove_pin_from_clusters(db: AsyncSession, lon: float, lat: float):
+    await _shift_clusters(db, lon, lat, -1)
+
+
+async def move_pin_in_clusters(db: AsyncSession, old: tuple[float, float], new: tuple[float, float]):
+    if old == new:
+        return
+    await remove_pin_from_clusters(db, *old)
+    await add_pin_to_clusters(db, *new)
+
+
+async def rebuild_pin_clusters(db: AsyncSession):
+    # full recompute from the pins table, also corrects any float drift from the incremental sums
+    await db.execute(select(func.pg_advisory_xact_lock(func.hashtext(PinCluster.__tablename__))))
+    await db.execute(delete(PinCluster))
+    for zoom in range(CLUSTER_MIN_ZOOM, CLUSTER_MAX_ZOOM + 1):
+        size = grid_size(zoom)
+        grid_x = func.floor(func.ST_X(Pin.coordinates) / size)
+        grid_y = func.floor(func.ST_Y(Pin.coordinates) / size)
+        await db.execute(
+            insert(PinCluster).from_select(
+                ["zoom", "grid_x", "grid_y", "count", "sum_lon", "sum_lat"],
+                select(
+                    literal(zoom),
+                    grid_x,
+                    grid_y,
+                    func.count(Pin.id),
+                    func.sum(func.ST_X(Pin.coordinates)),
+                    func.sum(func.ST_Y(Pin.coordinates)),
+                )
+                .where(Pin.coordinates.isnot(None))
+                .group_by(grid_x, grid_y)
+            )
+        )
+    await db.commit()
+
+
+async def ensure_pin_clusters(db: AsyncSession):
+    if await db.scalar(select(PinCluster.zoom).limit(1)) is not None:
+        return
+    if await db.scalar(select(Pin.id).where(Pin.coordinates.isnot(None)).limit(1)) is None:
+        return
+    await rebuild_pin_clusters(db)
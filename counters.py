@@ -0,0 +1,347 @@
+import asyncio
+import os
+import uuid
+from collections import defaultdict
+import redis
+from sqlalchemy import select, update, func, or_, values, column, Integer
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import redis_client, invalidate
+from database import Base, AsyncSessionLocal
+from models import Pin, User, Post, Comment, Category, Wishlist, Visit, Follow, PostLike, CommentLike, PinCategory, Hangout, HangoutParticipant
+
+COUNTER_FLUSH_INTERVAL = float(os.getenv("COUNTER_FLUSH_INTERVAL", 2))
+COUNTER_RECONCILE_INTERVAL = float(os.getenv("COUNTER_RECONCILE_INTERVAL", 6 * 3600))
+PENDING_COUNTERS_KEY = "counters:pending"
+# a claimed hash lives under its own key until applied; one older than COUNTER_STALE_FLUSH_AGE belongs to a dead worker
+COUNTER_FLUSHING_TTL = int(os.getenv("COUNTER_FLUSHING_TTL", 7 * 86400))
+COUNTER_STALE_FLUSH_AGE = int(os.getenv("COUNTER_STALE_FLUSH_AGE", 600))
+RECONCILE_LOCK = "counters:reconcile"
+FLUSH_LOCK = "counters:flush"
+VIEW_DEDUPE_WINDOW = int(os.getenv("VIEW_DEDUPE_WINDOW", 1800))
+
+
+def counter_target(attr):
+    return f"{attr.class_.__tablename__}.{attr.key}"
+
+
+COUNTER_TARGETS = {
+    counter_target(attr) for attr in (
+        Pin.wishlist_count, Pin.visit_count, Pin.posts_count,
+        User.follower_count, User.following_count, User.posts_count, User.likes_count, User.visited_count,
+        Post.like_count, Post.comment_count,
+        Comment.like_count,
+        Category.location_count, Category.post_count,
+        Pin.view_count, Post.view_count,
+    )
+}
+
+# deltas recorded while Redis was unreachable, merged into the next flush of this worker
+_local_deltas = defaultdict(int)
+# table name -> cache key function of payloads that embed the table's counters, see cache_counters
+_counter_cache_keys = {}
+
+# RENAME hands the whole pending hash to exactly one flusher, increments keep landing in a fresh hash meanwhile
+_claim_pending = redis_client.register_script("""
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('rename', KEYS[1], KEYS[2])
+    redis.call('expire', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+""")
+
+# merges a flushing hash back into the pending one, unless its TTL shows it was claimed recently
+_restore_flushing = redis_client.register_script("""
+if redis.call('ttl', KEYS[1]) > tonumber(ARGV[1]) then
+    return 0
+end
+local entries = redis.call('hgetall', KEYS[1])
+for i = 1, #entries, 2 do
+    redis.call('hincrby', KEYS[2], entries[i], entries[i + 1])
+end
+redis.call('del', KEYS[1])
+return 1
+""")
+
+
+def counter_field(attr, row_id: int):
+    return f"{counter_target(attr)}:{row_id}"
+
+
+def cache_counters(model, cache_key):
+    # cache_key(row_id) is invalidated whenever a flush or reconcile changes one of the row's counters
+    _counter_cache_keys[model.__tablename__] = cache_key
+
+
+async def invalidate_counter_caches(table_name: str, row_ids):
+    cache_key = _counter_cache_keys.get(table_name)
+    if cache_key is not None:
+        await invalidate(*{cache_key(row_id) for row_id in row_ids})
+
+
+async def record_counter_deltas(*changes):
+    # changes are (Model.column, row id, delta); call after the source row change is committed
+    fields = {}
+    for attr, row_id, delta in changes:
+        if counter_target(attr) not in COUNTER_TARGETS:
+            raise ValueError(f"{attr} is not a registered counter")
+        if row_id is None or not delta:
+            continue
+        field = counter_field(attr, row_id)
+        fields[field] = fields.get(field, 0) + delta
+    if not fields:
+        return
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for field, delta in fields.items():
+                pipe.hincrby(PENDING_COUNTERS_KEY, field, delta)
+            await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Redis error in record_counter_deltas: {e}")
+        for field, delta in fields.items():
+            _local_deltas[field] += delta
+
+
+# first view of an item by a viewer inside the window marks the viewer and bumps the pending counter in one round trip
+_record_view = redis_client.register_script("""
+if redis.call('set', KEYS[1], 1, 'NX', 'EX', ARGV[1]) then
+    redis.call('hincrby', KEYS[2], ARGV[2], 1)
+    return 1
+end
+return 0
+""")
+
+
+def viewer_identity(user: dict | None, client_host: str | None):
+    return f"user:{user['id']}" if user else f"ip:{client_host or 'unknown'}"
+
+
+async def record_view(attr, row_id: int, viewer: str):
+    # view_count is approximate by design, a view seen while Redis is down is dropped rather than double counted.
+    # Returns whether this view was counted.
+    field = counter_field(attr, row_id)
+    try:
+        return bool(await _record_view(
+            keys=[f"views:{field}:{viewer}", PENDING_COUNTERS_KEY],
+            args=[VIEW_DEDUPE_WINDOW, field]
+        ))
+    except redis.RedisError as e:
+        print(f"Redis error in record_view: {e}")
+        return False
+
+
+async def get_pending_delta(attr, row_id: int):
+    # not yet flushed increments for one counter, for responses that should reflect the caller's own write
+    try:
+        pending = await redis_client.hget(PENDING_COUNTERS_KEY, counter_field(attr, row_id))
+    except redis.RedisError as e:
+        print(f"Redis error in get_pending_delta: {e}")
+        pending = None
+    return int(pending or 0) + _local_deltas.get(counter_field(attr, row_id), 0)
+
+
+async def apply_counter_deltas(db: AsyncSession, deltas: dict):
+    # one UPDATE ... FROM (VALUES ...) per counter column, rows in id order so concurrent flushes lock the same way
+    grouped = defaultdict(list)
+    for field, delta in deltas.items():
+        if not delta:
+            continue
+        target, _, row_id = field.rpartition(":")
+        if target not in COUNTER_TARGETS:
+            print(f"Skipping unknown counter {field}")
+            continue
+        table_name, _, column_name = target.partition(".")
+        grouped[(table_name, column_name)].append((int(row_id), delta))
+
+    for (table_name, column_name), rows in grouped.items():
+        table = Base.metadata.tables[table_name]
+        deltas_table = values(column("id", Integer), column("delta", Integer), name="deltas").data(sorted(rows))
+        counter = table.c[column_name]
+        await db.execute(
+            update(table)
+            .where(table.c.id == deltas_table.c.id)
+            .values({counter: func.coalesce(counter, 0) + deltas_table.c.delta})
+        )
+
+
+def _changed_rows(deltas: dict):
+    # table name -> ids of the rows the deltas touch, for the tables with cached counters
+    changed = defaultdict(set)
+    for field in deltas:
+        target, _, row_id = field.rpartition(":")
+        table_name = target.partition(".")[0]
+        if table_name in _counter_cache_keys:
+            changed[table_name].add(int(row_id))
+    return changed
+
+
+async def _claim_deltas(flushing_key: str):
+    # returns this worker's buffered deltas plus the pending hash, which is moved to flushing_key.
+    # The second value is False if the claimed hash couldn't be read, it must then be left for restore_stale_flushes.
+    deltas = defaultdict(int)
+    for field, delta in list(_local_deltas.items()):
+        deltas[field] += delta
+    _local_deltas.clear()
+
+    claimed = False
+    try:
+        claimed = await _claim_pending(keys=[PENDING_COUNTERS_KEY, flushing_key], args=[COUNTER_FLUSHING_TTL])
+        for field, delta in (await redis_client.hgetall(flushing_key)).items():
+            deltas[field.decode()] += int(delta)
+    except redis.RedisError as e:
+        print(f"Redis error in _claim_deltas: {e}")
+        return deltas, not claimed
+    return deltas, True
+
+
+async def _release_flushing_key(flushing_key: str):
+    try:
+        await redis_client.delete(flushing_key)
+    except redis.RedisError as e:
+        print(f"Redis error in _release_flushing_key: {e}")
+
+
+async def flush_counters():
+    try:
+        if not _local_deltas and not await redis_client.exists(PENDING_COUNTERS_KEY):
+            return 0
+    except redis.RedisError as e:
+        print(f"Redis error in flush_counters: {e}")
+
+    flushing_key = f"{PENDING_COUNTERS_KEY}:flushing:{uuid.uuid4().hex}"
+    deltas, read = {}, True
+    try:
+        async with AsyncSessionLocal() as db:
+            # shared with the other flushers, see reconcile_counters
+            await db.execute(select(func.pg_advisory_xact_lock_shared(func.hashtext(FLUSH_LOCK))))
+            deltas, read = await _claim_deltas(flushing_key)
+            if deltas:
+                await apply_counter_deltas(db, deltas)
+                await db.commit()
+    except Exception:
+        # keep them for the next round instead of dropping increments
+        for field, delta in deltas.items():
+            _local_deltas[field] += delta
+        raise
+    finally:
+        if read:
+            await _release_flushing_key(flushing_key)
+
+    for table_name, row_ids in _changed_rows(deltas).items():
+        await invalidate_counter_caches(table_name, row_ids)
+    return len(deltas)
+
+
+async def restore_stale_flushes():
+    # a worker that died between claiming the pending hash and applying it leaves its flushing key behind,
+    # those deltas go back into the pending hash. (One that died between its commit and the delete gets
+    # its deltas applied twice, the next reconcile corrects the recounted ones.)
+    try:
+        async for key in redis_client.scan_iter(match=f"{PENDING_COUNTERS_KEY}:flushing:*"):
+            await _restore_flushing(keys=[key, PENDING_COUNTERS_KEY], args=[COUNTER_FLUSHING_TTL - COUNTER_STALE_FLUSH_AGE])
+    except redis.RedisError as e:
+        print(f"Redis error in restore_stale_flushes: {e}")
+
+
+def _count(model, *criteria):
+    return select(func.count()).select_from(model).where(*criteria).scalar_subquery()
+
+
+def _reconcile_plan():
+    return [
+        (Pin, {
+            "wishlist_count": _count(Wishlist, Wishlist.pin_id == Pin.id),
+            "visit_count": _count(Visit, Visit.pin_id == Pin.id),
+            "posts_count": _count(Post, Post.pin_id == Pin.id),
+        }),
+        (User, {
+            "follower_count": _count(Follow, Follow.following_id == User.id),
+            "following_count": _count(Follow, Follow.follower_id == User.id),
+            "posts_count": _count(Post, Post.user_id == User.id),
+            "likes_count": _count(PostLike.__table__.join(Post.__table__), Post.user_id == User.id),
+            "visited_count": _count(Visit, Visit.user_id == User.id),
+        }),
+        (Post, {
+            "like_count": _count(PostLike, PostLike.post_id == Post.id),
+            "comment_count": _count(Comment, Comment.post_id == Post.id),
+        }),
+        (Comment, {
+            "like_count": _count(CommentLike, CommentLike.comment_id == Comment.id),
+        }),
+        # written synchronously by join/leave, reconciled here to backfill and catch drift
+        (Hangout, {
+            "participant_count": _count(HangoutParticipant, HangoutParticipant.hangout_id == Hangout.id),
+        }),
+        (Category, {
+            "location_count": _count(PinCategory, PinCategory.category_id == Category.id),
+            "post_count": _count(
+                Post.__table__.join(PinCategory.__table__, PinCategory.pin_id == Post.pin_id),
+                PinCategory.category_id == Category.id
+            ),
+        }),
+    ]
+
+
+async def reconcile_counters(db: AsyncSession):
+    # recomputes every counter from the source tables, only rows that drifted are written
+    if not await db.scalar(select(func.pg_try_advisory_xact_lock(func.hashtext(RECONCILE_LOCK)))):
+        return False
+    # a delta still pending while the absolute count is written would be added on top of it by a later flush.
+    # The exclusive lock waits for the flushes in flight and holds new ones off, then the pending deltas are
+    # applied in this transaction; the recount overwrites them where they are already part of the count.
+    await db.execute(select(func.pg_advisory_xact_lock(func.hashtext(FLUSH_LOCK))))
+    flushing_key = f"{PENDING_COUNTERS_KEY}:flushing:{uuid.uuid4().hex}"
+    deltas, read = await _claim_deltas(flushing_key)
+    changed = _changed_rows(deltas)
+    try:
+        await apply_counter_deltas(db, deltas)
+        for model, counts in _reconcile_plan():
+            query = (
+                update(model)
+                .values(counts)
+                .where(or_(*(getattr(model, name).is_distinct_from(count) for name, count in counts.items())))
+            )
+            if model.__tablename__ in _counter_cache_keys:
+                changed[model.__tablename__].update((await db.scalars(query.returning(model.id))).all())
+            else:
+                await db.execute(query)
+        await db.commit()
+    except Exception:
+        for field, delta in deltas.items():
+            _local_deltas[field] += delta
+        raise
+    finally:
+        if read:
+            await _release_flushing_key(flushing_key)
+    for table_name, row_ids in changed.items():
+        await invalidate_counter_caches(table_name, row_ids)
+    return True
+
+
+async def backfill_counters(conn, added_columns):
+    # a counter column just added to an existing table holds its server default, recount it before serving
+    for model, counts in _reconcile_plan():
+        counts = {name: count for name, count in counts.items() if (model.__tablename__, name) in added_columns}
+        if counts:
+            await conn.execute(update(model).values(counts))
+
+
+async def run_counter_flusher():
+    await restore_stale_flushes()
+    while True:
+        await asyncio.sleep(COUNTER_FLUSH_INTERVAL)
+        try:
+            await flush_counters()
+        except Exception as e:
+            print(f"Error flushing counters: {e}")
+
+
+async def run_counter_reconciler():
+    while True:
+        await asyncio.sleep(COUNTER_RECONCILE_INTERVAL)
+        try:
+            await restore_stale_flushes()
+            async with AsyncSessionLocal() as db:
+                await reconcile_counters(db)
+        except Exception as e:
+            print(f"Error reconciling counters: {e}")
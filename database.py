@@ -1,5 +1,11 @@
-from sqlalchemy.orm import sessionmaker, DeclarativeBase
-from sqlalchemy import create_engine
+import time
+from typing import Annotated
+from fastapi import Depends
+from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy import event, exc, inspect
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 import os
 from dotenv import load_dotenv
 
@@ -7,8 +13,136 @@ from dotenv import load_dotenv
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(bind=engine)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 15000))
+
+
+def to_async_url(url: str) -> str:
+    # postgresql:// and postgresql+psycopg2:// both point at the same server, asyncpg just needs its own driver prefix
+    scheme, _, rest = url.partition("://")
+    if scheme.split("+")[0] in ("postgres", "postgresql"):
+        return f"postgresql+asyncpg://{rest}"
+    return url
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.overflow_events = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_checkout(self, waited: float):
+        self.checkouts += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    def connect(self):
+        # timed once per checkout here, the queue wait underneath retries recursively. Includes the pre-ping
+        # and, when the pool has to grow, opening the connection
+        start = time.perf_counter()
+        try:
+            conn = super().connect()
+        except exc.TimeoutError:
+            pool_stats.timeouts += 1
+            raise
+        pool_stats.record_checkout(time.perf_counter() - start)
+        return conn
+
+    def _inc_overflow(self):
+        # called again on every retry, but only reports True for the one call that grows the pool.
+        # _overflow starts at -pool_size, anything above 0 is a connection past the configured pool size
+        opened = super()._inc_overflow()
+        if opened and self._overflow > 0:
+            pool_stats.overflow_events += 1
+        return opened
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(DATABASE_URL)
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    poolclass=InstrumentedPool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=True,
+    connect_args={"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}},
+)
+# expire_on_commit=False - expired attributes would otherwise trigger lazy IO on access, which AsyncSession can't do
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+def get_pool_stats():
+    pool = async_engine.pool
+    return {
+        "pool_size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checkouts": pool_stats.checkouts,
+        "overflow_events": pool_stats.overflow_events,
+        "timeouts": pool_stats.timeouts,
+        "avg_wait_ms": round(pool_stats.wait_total / pool_stats.checkouts * 1000, 3) if pool_stats.checkouts else 0.0,
+        "max_wait_ms": round(pool_stats.wait_max * 1000, 3),
+    }
+
+
+# AsyncSession only checks a connection out of the pool on its first statement, so a route that
+# never queries never holds one. The connection goes back to the pool on commit/rollback/close.
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def get_db_with_timeout(timeout_ms: int):
+    async def get_db_with_statement_timeout():
+        async with AsyncSessionLocal() as db:
+            @event.listens_for(db.sync_session, "after_begin")
+            def set_statement_timeout(session, transaction, connection):
+                # SET LOCAL only lasts until the transaction ends, so it never leaks back into the pool
+                connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+
+            yield db
+
+    return get_db_with_statement_timeout
+
+
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 class Base(DeclarativeBase):
-    pass
\ No newline at end of file
+    pass
+
+
+def create_missing_indexes(conn):
+    # create_all() only emits indexes together with a brand new table, so indexes added to existing tables land here
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def create_missing_columns(conn):
+    # likewise create_all() never alters an existing table, new nullable or server-defaulted columns are added here.
+    # Returns the (table, column) names it added so callers can backfill them.
+    added = []
+    existing = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not existing.has_table(table.name):
+            continue
+        present = {column["name"] for column in existing.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in present:
+                spec = CreateColumn(column).compile(dialect=conn.dialect)
+                conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {spec}")
+                added.append((table.name, column.name))
+    return added
@@ -0,0 +1,120 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import Optional
+from PIL import Image, ImageOps
+from cache import LocalCache
+from loaders import SERIALIZER_DEBUG
+
+# resized WebP copies written next to the original as <name>_<width>.webp, so the URLs can be derived from
+# the original's URL without storing anything extra. They appear shortly after the upload request returns,
+# and never for images uploaded before they existed or whose render failed, so sizes are only reported once written.
+# Whether they exist is cached per worker and checked off the event loop, see check_variants.
+VARIANT_WIDTHS = (128, 512, 1080)
+VARIANT_SOURCE_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp", "image/tiff"}
+VARIANT_SOURCE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".tiff", ".tif"}
+VARIANT_QUALITY = int(os.getenv("VARIANT_QUALITY", 80))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+
+_pool = None
+# keeps fire-and-forget tasks referenced until they finish
+_pending = set()
+# originals whose variants are on disk, names are never rewritten so a hit stays true
+_rendered = LocalCache(int(os.getenv("VARIANT_CACHE_SIZE", 50000)), 3600)
+# originals found without variants, kept briefly since the render may still be running
+_unrendered = LocalCache(int(os.getenv("VARIANT_CACHE_SIZE", 50000)), float(os.getenv("VARIANT_MISS_TTL", 10)))
+
+
+def variant_name(name: str, width: int):
+    stem, _, _ = name.rpartition(".")
+    return f"{stem or name}_{width}.webp"
+
+
+def variant_paths(path: Path):
+    return {width: path.with_name(variant_name(path.name, width)) for width in VARIANT_WIDTHS}
+
+
+def _stat_variants(paths: list[Path]):
+    # widths are rendered in order and each renamed into place when complete, so the largest one marks them all done
+    return [variant_paths(path)[VARIANT_WIDTHS[-1]].exists() for path in paths]
+
+
+async def check_variants(paths):
+    # fills the caches for a page of originals with one trip to a thread, call before serializing them
+    unknown = list({str(path) for path in paths if _rendered.get(str(path)) is None and _unrendered.get(str(path)) is None})
+    if not unknown:
+        return
+    for key, rendered in zip(unknown, await asyncio.to_thread(_stat_variants, [Path(key) for key in unknown])):
+        (_rendered if rendered else _unrendered).set(key, True)
+
+
+def variants_rendered(path: Path):
+    # answered from the caches check_variants filled for the response. A path it wasn't asked about is a missing
+    # check_rendered_variants call in the route: loud under SERIALIZER_DEBUG, otherwise statted right here
+    key = str(path)
+    if _rendered.get(key):
+        return True
+    if _unrendered.get(key):
+        return False
+    if SERIALIZER_DEBUG:
+        raise RuntimeError(f"variants of {path} not checked before serializing, use check_rendered_variants")
+    rendered = _stat_variants([path])[0]
+    (_rendered if rendered else _unrendered).set(key, True)
+    return rendered
+
+
+def variant_urls(url: Optional[str]):
+    # {"128": url, "512": url, "1080": url} for a locally stored raster image, None for video/external URLs
+    if not url or url.startswith(("http://", "https://")):
+        return None
+    original = PurePosixPath(url)
+    if original.suffix.lower() not in VARIANT_SOURCE_EXTENSIONS:
+        return None
+    return {str(width): str(original.with_name(variant_name(original.name, width))) for width in VARIANT_WIDTHS}
+
+
+def _render_variants(source: str, widths: tuple[int, ...]):
+    # runs in the process pool, decoding and resampling big images would otherwise hold the GIL for seconds
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+        for width in widths:
+            variant = image
+            if image.width > width:
+                variant = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+            destination = Path(source).with_name(variant_name(Path(source).name, width))
+            # a dotfile, which the media routes never serve
+            temporary = destination.with_name(f".{destination.name}.tmp")
+            variant.save(temporary, format="WEBP", quality=VARIANT_QUALITY, method=4)
+            os.replace(temporary, destination)
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _pool
+
+
+async def generate_variants(path: Path):
+    try:
+        await asyncio.get_running_loop().run_in_executor(_get_pool(), _render_variants, str(path), VARIANT_WIDTHS)
+    except Exception as e:
+        print(f"Error generating variants for {path}: {e}")
+
+
+def schedule_variants(path: Path, media_type: str):
+    if media_type not in VARIANT_SOURCE_TYPES:
+        return
+    task = asyncio.create_task(generate_variants(path))
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+def shutdown_variant_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,158 @@
+import os
+import uuid
+import redis
+from sqlalchemy import select, func, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import redis_client
+from database import AsyncSessionLocal
+from models import Follow, Post, User
+
+# home feed timelines: a Redis sorted set of post ids per user (score = post id, so newest first is a reverse range).
+# New posts are pushed into followers' timelines when created, except for accounts with more than
+# FEED_FANOUT_MAX_FOLLOWERS followers, whose posts are pulled from the DB at read time and merged in.
+FEED_MAX_LENGTH = int(os.getenv("FEED_MAX_LENGTH", 800))
+FEED_TTL = int(os.getenv("FEED_TTL", 7 * 86400))
+FEED_FANOUT_MAX_FOLLOWERS = int(os.getenv("FEED_FANOUT_MAX_FOLLOWERS", 5000))
+FEED_FANOUT_BATCH = int(os.getenv("FEED_FANOUT_BATCH", 500))
+# post ids start at 1, the marker keeps an empty timeline from looking like a cache miss
+EMPTY_MARKER = 0
+
+# only timelines that are already built get the post, a missing one is rebuilt from the DB on next read anyway.
+# KEYS are timeline, version pairs; every version is bumped, which tells a rebuild in progress that its DB read is outdated.
+_push_if_loaded = redis_client.register_script("""
+for i = 1, #KEYS, 2 do
+    redis.call('incr', KEYS[i + 1])
+    redis.call('expire', KEYS[i + 1], ARGV[3])
+    if redis.call('exists', KEYS[i]) == 1 then
+        redis.call('zadd', KEYS[i], ARGV[1], ARGV[1])
+        redis.call('zremrangebyrank', KEYS[i], 0, -tonumber(ARGV[2]) - 1)
+    end
+end
+return 0
+""")
+
+# a rebuilt timeline (KEYS[1]) replaces the missing one only if no post or follow change landed since its DB read started
+_publish_if_current = redis_client.register_script("""
+if redis.call('exists', KEYS[2]) == 0 and (redis.call('get', KEYS[3]) or '0') == ARGV[1] then
+    redis.call('rename', KEYS[1], KEYS[2])
+    redis.call('expire', KEYS[2], ARGV[2])
+    return 1
+end
+redis.call('del', KEYS[1])
+return 0
+""")
+
+
+def timeline_key(user_id: int):
+    return f"feed:{user_id}"
+
+
+def timeline_version_key(user_id: int):
+    return f"feed:{user_id}:version"
+
+
+def _timeline_keys(user_ids):
+    return [key for user_id in user_ids for key in (timeline_key(user_id), timeline_version_key(user_id))]
+
+
+def _followees(user_id: int, large: bool):
+    follower_count = func.coalesce(User.follower_count, 0)
+    return (
+        select(Follow.following_id)
+        .join(User, User.id == Follow.following_id)
+        .where(
+            Follow.follower_id == user_id,
+            follower_count > FEED_FANOUT_MAX_FOLLOWERS if large else follower_count <= FEED_FANOUT_MAX_FOLLOWERS
+        )
+    )
+
+
+def _timeline_posts(user_id: int):
+    # what fan-out delivers: own posts plus those of followed accounts below the fan-out limit
+    return select(Post.id).where(or_(Post.user_id == user_id, Post.user_id.in_(_followees(user_id, large=False))))
+
+
+async def _select_ids(db: AsyncSession, query, before_id: int | None, limit: int):
+    if before_id is not None:
+        query = query.where(Post.id < before_id)
+    return list((await db.scalars(query.order_by(Post.id.desc()).limit(limit))).all())
+
+
+async def _build_timeline(db: AsyncSession, user_id: int):
+    key = timeline_key(user_id)
+    version_key = timeline_version_key(user_id)
+    try:
+        version = (await redis_client.get(version_key) or b"0").decode()
+    except redis.RedisError as e:
+        print(f"Redis error in _build_timeline: {e}")
+        version = None
+    post_ids = await _select_ids(db, _timeline_posts(user_id), None, FEED_MAX_LENGTH)
+    if version is None:
+        return post_ids
+
+    # built under its own name, a post or follow change committed during the DB read can't be overwritten by it
+    loading_key = f"{key}:loading:{uuid.uuid4().hex}"
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.zadd(loading_key, {EMPTY_MARKER: EMPTY_MARKER, **{post_id: post_id for post_id in post_ids}})
+            pipe.expire(loading_key, 60)
+            await pipe.execute()
+        await _publish_if_current(keys=[loading_key, key, version_key], args=[version, FEED_TTL])
+    except redis.RedisError as e:
+        print(f"Redis error in _build_timeline: {e}")
+    return post_ids
+
+
+async def get_feed_ids(db: AsyncSession, user_id: int, before_id: int | None, limit: int):
+    # newest first post ids older than before_id, deleted posts may still be listed and are dropped by the caller
+    key = timeline_key(user_id)
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.exists(key)
+            pipe.zrevrangebyscore(key, f"({before_id}" if before_id is not None else "+inf", f"({EMPTY_MARKER}", start=0, num=limit)
+            pipe.zcard(key)
+            pipe.expire(key, FEED_TTL)
+            exists, cached, length, _ = await pipe.execute()
+        if exists:
+            timeline = [int(post_id) for post_id in cached]
+        else:
+            built = await _build_timeline(db, user_id)
+            timeline = [post_id for post_id in built if before_id is None or post_id < before_id][:limit]
+            length = len(built)
+        # past the trimmed tail of a full timeline, older pages come from the DB
+        if len(timeline) < limit and length >= FEED_MAX_LENGTH:
+            timeline += await _select_ids(db, _timeline_posts(user_id), timeline[-1] if timeline else before_id, limit - len(timeline))
+    except redis.RedisError as e:
+        print(f"Redis error in get_feed_ids: {e}")
+        timeline = await _select_ids(db, _timeline_posts(user_id), before_id, limit)
+
+    pulled = await _select_ids(db, select(Post.id).where(Post.user_id.in_(_followees(user_id, large=True))), before_id, limit)
+    return sorted(set(timeline) | set(pulled), reverse=True)[:limit]
+
+
+async def fan_out_post(post_id: int, author_id: int):
+    # runs after the response, pushes the new post into the author's and their followers' loaded timelines
+    try:
+        await _push_if_loaded(keys=_timeline_keys([author_id]), args=[post_id, FEED_MAX_LENGTH, FEED_TTL])
+        async with AsyncSessionLocal() as db:
+            follower_count = await db.scalar(select(User.follower_count).where(User.id == author_id))
+            if (follower_count or 0) > FEED_FANOUT_MAX_FOLLOWERS:
+                return
+            result = await db.stream_scalars(select(Follow.follower_id).where(Follow.following_id == author_id))
+            async for follower_ids in result.partitions(FEED_FANOUT_BATCH):
+                await _push_if_loaded(keys=_timeline_keys(follower_ids), args=[post_id, FEED_MAX_LENGTH, FEED_TTL])
+    except redis.RedisError as e:
+        print(f"Redis error in fan_out_post: {e}")
+
+
+async def reset_timeline(user_id: int):
+    # after a follow/unfollow the timeline is rebuilt on next read instead of patched, the version bump keeps
+    # a rebuild already reading the old follows from putting it back
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.incr(timeline_version_key(user_id))
+            pipe.expire(timeline_version_key(user_id), FEED_TTL)
+            pipe.delete(timeline_key(user_id))
+            await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Redis error in reset_timeline: {e}")
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+import redis
+from fastapi.encoders import jsonable_encoder
+from cache import redis_client
+from clusters import cell_for, pin_location
+
+# live hangout updates over Server-Sent Events. join/leave/update publish an event on the hangout's Redis channel
+# and on the channel of the map cell its pin is in; every worker keeps one pubsub connection subscribed to the
+# channels its open streams need, so a stream sees events from whichever worker handled the change.
+# zoom level of the clusters.py grid behind bbox streams, 7 is ~1.4 degree cells
+HANGOUT_EVENTS_CELL_ZOOM = int(os.getenv("HANGOUT_EVENTS_CELL_ZOOM", 7))
+HANGOUT_EVENTS_MAX_CELLS = int(os.getenv("HANGOUT_EVENTS_MAX_CELLS", 64))
+# events queued for one stream before it is treated as a stalled client and ended
+HANGOUT_EVENTS_QUEUE_SIZE = int(os.getenv("HANGOUT_EVENTS_QUEUE_SIZE", 100))
+# comment lines sent on idle streams so proxies don't time them out
+HANGOUT_EVENTS_HEARTBEAT = float(os.getenv("HANGOUT_EVENTS_HEARTBEAT", 15))
+WORKER_CHANNEL = "hangouts:workers"
+CHANNEL_PREFIX = "hangouts:events:"
+
+
+def hangout_channel(hangout_id: int):
+    return f"{CHANNEL_PREFIX}{hangout_id}"
+
+
+def cell_channel(cell: tuple[int, int]):
+    return f"{CHANNEL_PREFIX}cell:{cell[0]}:{cell[1]}"
+
+
+def bbox_channels(bbox: tuple[float, float, float, float]):
+    # None if the bbox covers more than HANGOUT_EVENTS_MAX_CELLS cells
+    min_x, min_y = cell_for(bbox[0], bbox[1], HANGOUT_EVENTS_CELL_ZOOM)
+    max_x, max_y = cell_for(bbox[2], bbox[3], HANGOUT_EVENTS_CELL_ZOOM)
+    if (max_x - min_x + 1) * (max_y - min_y + 1) > HANGOUT_EVENTS_MAX_CELLS:
+        return None
+    return [cell_channel((x, y)) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+
+def in_bbox(event: dict, bbox: tuple[float, float, float, float]):
+    # a cell reaches past the bbox edges, this is the precise check
+    return any(bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3] for lon, lat in event.get("locations", ()))
+
+
+def sse_frame(event: dict):
+    return f"event: {event['type']}\ndata: {json.dumps(jsonable_encoder(event))}\n\n"
+
+
+class Subscription:
+    def __init__(self, channels: list[str]):
+        self.channels = channels
+        self.queue = asyncio.Queue(maxsize=HANGOUT_EVENTS_QUEUE_SIZE)
+        self.stalled = False
+
+
+class EventBroker:
+    def __init__(self):
+        self.subscriptions = {}
+        self.pubsub = None
+
+    async def subscribe(self, subscription: Subscription):
+        new_channels = []
+        for channel in subscription.channels:
+            subscribers = self.subscriptions.setdefault(channel, set())
+            if not subscribers:
+                new_channels.append(channel)
+            subscribers.add(subscription)
+        if new_channels and self.pubsub is not None:
+            try:
+                await self.pubsub.subscribe(*new_channels)
+            except redis.RedisError as e:
+                print(f"Redis error in EventBroker.subscribe: {e}")
+
+    async def unsubscribe(self, subscription: Subscription):
+        unused = []
+        for channel in subscription.channels:
+            subscribers = self.subscriptions.get(channel)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.subscriptions[channel]
+                unused.append(channel)
+        if unused and self.pubsub is not None:
+            try:
+                await self.pubsub.unsubscribe(*unused)
+            except redis.RedisError as e:
+                print(f"Redis error in EventBroker.unsubscribe: {e}")
+
+    def deliver(self, channel: str, payload: str):
+        for subscription in list(self.subscriptions.get(channel, ())):
+            try:
+                subscription.queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                # backpressure: the stream ends, EventSource reconnects and starts from a fresh snapshot
+                subscription.stalled = True
+
+
+broker = EventBroker()
+
+
+async def publish_hangout_event(event: dict, hangout_id: int, *pin_ids: int):
+    # call after the change is committed. An update that moved the hangout passes both pins,
+    # so bbox streams around the old location see it leave.
+    locations = [location for location in [await pin_location(pin_id) for pin_id in set(pin_ids) if pin_id] if location]
+    channels = [hangout_channel(hangout_id)]
+    channels += list({cell_channel(cell_for(lon, lat, HANGOUT_EVENTS_CELL_ZOOM)) for lon, lat in locations})
+    payload = json.dumps(jsonable_encoder({**event, "hangout_id": hangout_id, "locations": locations}))
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for channel in channels:
+                pipe.publish(channel, payload)
+            await pipe.execute()
+    except redis.RedisError as e:
+        # at least the streams on this worker still get it
+        print(f"Redis error in publish_hangout_event: {e}")
+        for channel in channels:
+            broker.deliver(channel, payload)
+
+
+async def stream_events(channels: list[str], snapshot=None, bbox: tuple[float, float, float, float] | None = None):
+    # the SSE body. Subscribes before awaiting snapshot() (first event, None ends the stream), so nothing falls
+    # in between, and only once the body runs, so a stream that is never started never holds a subscription
+    subscription = Subscription(channels)
+    try:
+        await broker.subscribe(subscription)
+        if snapshot is not None:
+            event = await snapshot()
+            if event is None:
+                return
+            yield sse_frame(event)
+        while not subscription.stalled:
+            try:
+                payload = await asyncio.wait_for(subscription.queue.get(), HANGOUT_EVENTS_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            event = json.loads(payload)
+            if bbox is None or in_bbox(event, bbox):
+                yield f"event: {event['type']}\ndata: {payload}\n\n"
+    finally:
+        await broker.unsubscribe(subscription)
+
+
+async def run_hangout_event_dispatcher():
+    # one pubsub connection per worker, resubscribed to the open streams' channels after a Redis failure
+    while True:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(WORKER_CHANNEL, *list(broker.subscriptions))
+            broker.pubsub = pubsub
+            async for message in pubsub.listen():
+                channel = message["channel"].decode()
+                if channel.startswith(CHANNEL_PREFIX):
+                    broker.deliver(channel, message["data"].decode())
+        except redis.RedisError as e:
+            print(f"Redis error in run_hangout_event_dispatcher: {e}")
+            await asyncio.sleep(1)
+        finally:
+            broker.pubsub = None
+            await pubsub.aclose()
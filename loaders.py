@@ -0,0 +1,45 @@
+import os
+from sqlalchemy import inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.attributes import set_committed_value
+
+# serializers call require_loaded, with this on a relationship that wasn't loaded up front fails loudly
+# instead of surfacing as a MissingGreenlet from a lazy load deep inside the response
+SERIALIZER_DEBUG = os.getenv("SERIALIZER_DEBUG", "false").lower() in ("1", "true", "yes")
+
+
+def require_loaded(obj, *relations: str):
+    if not SERIALIZER_DEBUG:
+        return
+    missing = inspect(obj).unloaded & set(relations)
+    if missing:
+        names = ", ".join(f"{type(obj).__name__}.{name}" for name in sorted(missing))
+        raise RuntimeError(f"{names} not loaded before serializing, use load_relations or a loader option")
+
+
+async def load_relations(db: AsyncSession, objects, *relations: str):
+    # fills many-to-one relationships (e.g. "user", "pin") for a batch of objects with one query per target type.
+    # Targets already in the session's identity map, which lives as long as the request, are not queried again.
+    objects = [obj for obj in objects if obj is not None]
+    for name in relations:
+        pending = [obj for obj in objects if name in inspect(obj).unloaded]
+        if not pending:
+            continue
+        relationship = inspect(type(pending[0])).relationships[name]
+        (foreign_key,) = relationship.local_columns
+        target = relationship.mapper.class_
+        attribute = inspect(type(pending[0])).get_property_by_column(foreign_key).key
+
+        ids = {getattr(obj, attribute) for obj in pending} - {None}
+        found = {}
+        for target_id in ids:
+            loaded = db.identity_map.get(identity_key(target, target_id))
+            if loaded is not None:
+                found[target_id] = loaded
+        missing = ids - found.keys()
+        if missing:
+            found.update({row.id: row for row in (await db.scalars(select(target).where(target.id.in_(missing)))).all()})
+
+        for obj in pending:
+            set_committed_value(obj, name, found.get(getattr(obj, attribute)))
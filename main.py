@@ -1,17 +1,54 @@
-from contextlib import asynccontextmanager
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from typing import Annotated
-from fastapi import FastAPI, Depends, WebSocket
-from database import Base, engine, SessionLocal
-from sqlalchemy.orm import Session
-from routers import auth, pins, categories, user, hangouts, posts
+from fastapi import FastAPI, Depends, HTTPException, Request, WebSocket
+from fastapi.responses import JSONResponse
+from starlette import status
+from sqlalchemy import exc
+from database import Base, async_engine, AsyncSessionLocal, get_pool_stats, create_missing_columns, create_missing_indexes, db_dependency
+from clusters import ensure_pin_clusters
+from cache import listen_for_invalidations
+from derivatives import shutdown_variant_pool
+from uploads import run_partial_upload_sweeper
+from trending import run_trending_pruner
+from messaging import run_message_dispatcher, message_writer
+from hangout_events import run_hangout_event_dispatcher
+from counters import run_counter_flusher, run_counter_reconciler, flush_counters, reconcile_counters, backfill_counters
+from routers import auth, pins, categories, user, hangouts, posts, media, messages
 from routers.auth import get_current_user
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    #Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine, checkfirst=True)
+    async with async_engine.begin() as conn:
+        #await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all, checkfirst=True)
+        added_columns = await conn.run_sync(create_missing_columns)
+        await backfill_counters(conn, added_columns)
+        await conn.run_sync(create_missing_indexes)
+    async with AsyncSessionLocal() as db:
+        await ensure_pin_clusters(db)
+    background_tasks = [
+        asyncio.create_task(listen_for_invalidations()),
+        asyncio.create_task(run_counter_flusher()),
+        asyncio.create_task(run_counter_reconciler()),
+        asyncio.create_task(run_partial_upload_sweeper()),
+        asyncio.create_task(run_trending_pruner()),
+        asyncio.create_task(run_message_dispatcher()),
+        asyncio.create_task(run_hangout_event_dispatcher()),
+        asyncio.create_task(message_writer.run()),
+    ]
     yield
+    for task in background_tasks:
+        task.cancel()
+    for task in background_tasks:
+        with suppress(asyncio.CancelledError):
+            await task
+    # don't leave this worker's buffered counter deltas or queued messages behind
+    await flush_counters()
+    await message_writer.drain()
+    shutdown_variant_pool()
+    await async_engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(auth.router, prefix="/api")
@@ -19,4 +56,33 @@ app.include_router(pins.router, prefix="/api")
 app.include_router(categories.router, prefix="/api")
 app.include_router(user.router, prefix="/api")
 app.include_router(hangouts.router, prefix="/api")
-app.include_router(posts.router, prefix="/api")
\ No newline at end of file
+app.include_router(posts.router, prefix="/api")
+app.include_router(messages.router, prefix="/api")
+# media_url values are "/media/...", so this one sits outside /api
+app.include_router(media.router)
+
+
+@app.exception_handler(exc.TimeoutError)
+async def pool_timeout_handler(request: Request, e: exc.TimeoutError):
+    # every pool connection stayed busy for DB_POOL_TIMEOUT, tell the client to back off instead of a bare 500
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Database is busy, try again later"},
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.get("/api/db/pool")
+async def db_pool_stats(user: Annotated[dict, Depends(get_current_user)]):
+    if not user["is_admin"]:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    return get_pool_stats()
+
+
+@app.post("/api/counters/reconcile", status_code=status.HTTP_202_ACCEPTED)
+async def counters_reconcile(db: db_dependency, user: Annotated[dict, Depends(get_current_user)]):
+    if not user["is_admin"]:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    if not await reconcile_counters(db):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Reconcile already running")
+    return {"detail": "Counters reconciled"}
@@ -0,0 +1,115 @@
+import os
+import uuid
+import redis
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import redis_client
+from models import Wishlist, Visit
+
+# per-user Redis sets of pin ids, so is_wishlisted/is_visited on list endpoints skip the wishlists/visits tables
+MEMBERSHIP_MODELS = {"wishlist": Wishlist, "visited": Visit}
+MEMBERSHIP_CACHE_TTL = int(os.getenv("MEMBERSHIP_CACHE_TTL", 86400))
+# pin ids start at 1, the marker keeps a user with an empty wishlist from looking like a cache miss
+EMPTY_MARKER = 0
+
+# only touch sets that are already loaded, a missing one gets rebuilt from the DB on next read anyway.
+# Every change also bumps the version (KEYS[2]), which tells a rebuild in progress that its DB read is outdated.
+_update_if_loaded = redis_client.register_script("""
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[3])
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call(ARGV[1], KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+# a rebuilt set (KEYS[1]) replaces the missing one only if no change landed since its DB read started
+_publish_if_current = redis_client.register_script("""
+if redis.call('exists', KEYS[2]) == 0 and (redis.call('get', KEYS[3]) or '0') == ARGV[1] then
+    redis.call('rename', KEYS[1], KEYS[2])
+    redis.call('expire', KEYS[2], ARGV[2])
+    return 1
+end
+redis.call('del', KEYS[1])
+return 0
+""")
+
+
+def membership_key(kind: str, user_id: int):
+    return f"user:{user_id}:{kind}"
+
+
+def membership_version_key(kind: str, user_id: int):
+    return f"user:{user_id}:{kind}:version"
+
+
+async def _load_membership(db: AsyncSession, kind: str, user_id: int):
+    model = MEMBERSHIP_MODELS[kind]
+    key = membership_key(kind, user_id)
+    version_key = membership_version_key(kind, user_id)
+    try:
+        version = (await redis_client.get(version_key) or b"0").decode()
+    except redis.RedisError as e:
+        print(f"Redis error in _load_membership: {e}")
+        version = None
+    pin_ids = set((await db.scalars(select(model.pin_id).where(model.user_id == user_id))).all())
+    if version is None:
+        return pin_ids
+
+    # built under its own name, an add or remove committed during the DB read can't be overwritten by it
+    loading_key = f"{key}:loading:{uuid.uuid4().hex}"
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.sadd(loading_key, EMPTY_MARKER, *pin_ids)
+            pipe.expire(loading_key, 60)
+            await pipe.execute()
+        await _publish_if_current(keys=[loading_key, key, version_key], args=[version, MEMBERSHIP_CACHE_TTL])
+    except redis.RedisError as e:
+        print(f"Redis error in _load_membership: {e}")
+    return pin_ids
+
+
+async def get_pin_memberships(db: AsyncSession, user_id: int, pin_ids: list[int]):
+    # returns {"wishlist": set, "visited": set} restricted to pin_ids, the DB is only hit for sets not in Redis yet
+    memberships = {kind: set() for kind in MEMBERSHIP_MODELS}
+    if not pin_ids:
+        return memberships
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for kind in MEMBERSHIP_MODELS:
+                pipe.exists(membership_key(kind, user_id))
+                pipe.smismember(membership_key(kind, user_id), pin_ids)
+            results = await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Redis error in get_pin_memberships: {e}")
+        results = None
+
+    for i, (kind, model) in enumerate(MEMBERSHIP_MODELS.items()):
+        if results is None:
+            memberships[kind] = set((await db.scalars(
+                select(model.pin_id).where(model.pin_id.in_(pin_ids), model.user_id == user_id)
+            )).all())
+        elif results[2 * i]:
+            memberships[kind] = {pin_id for pin_id, hit in zip(pin_ids, results[2 * i + 1]) if hit}
+        else:
+            memberships[kind] = await _load_membership(db, kind, user_id) & set(pin_ids)
+    return memberships
+
+
+async def _update_membership(command: str, kind: str, user_id: int, pin_id: int):
+    try:
+        await _update_if_loaded(
+            keys=[membership_key(kind, user_id), membership_version_key(kind, user_id)],
+            args=[command, pin_id, MEMBERSHIP_CACHE_TTL],
+        )
+    except redis.RedisError as e:
+        print(f"Redis error in _update_membership: {e}")
+
+
+# call after the wishlist/visit row change is committed
+async def add_pin_membership(kind: str, user_id: int, pin_id: int):
+    await _update_membership("sadd", kind, user_id, pin_id)
+
+
+async def remove_pin_membership(kind: str, user_id: int, pin_id: int):
+    await _update_membership("srem", kind, user_id, pin_id)
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import os
+import redis
+from fastapi import WebSocket
+from sqlalchemy import select, insert, update, bindparam, case, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from fastapi.encoders import jsonable_encoder
+from cache import redis_client, LocalCache
+from database import AsyncSessionLocal
+from models import Conversation, Message
+
+# real-time DMs: each worker keeps its own sockets in `hub`, a message is persisted through the batched writer
+# and then published on the recipients' Redis channels. Every worker subscribes one pubsub connection to the
+# channels of the users connected to it, so delivery works whichever worker or node the other side is on.
+MESSAGE_MAX_LENGTH = 4000
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", 200))
+MESSAGE_BATCH_WINDOW = float(os.getenv("MESSAGE_BATCH_WINDOW", 0.02))
+# frames queued for one socket before it is treated as a stalled client and closed
+MESSAGE_OUTBOX_SIZE = int(os.getenv("MESSAGE_OUTBOX_SIZE", 100))
+# clients send {"type": "ping"} more often than this, a silent socket is closed
+MESSAGE_IDLE_TIMEOUT = float(os.getenv("MESSAGE_IDLE_TIMEOUT", 75))
+# keeps the worker's pubsub subscribed (and its listen loop running) while no user is connected
+WORKER_CHANNEL = "dm:workers"
+
+
+def user_channel(user_id: int):
+    return f"dm:user:{user_id}"
+
+
+def serialize_message(message: Message):
+    return {
+        "id": message.id,
+        "conversation_id": message.conversation_id,
+        "sender_id": message.sender_id,
+        "content": message.content,
+        "post_id": message.post_id,
+        "created_at": message.created_at,
+    }
+
+
+class Connection:
+    # one socket: frames go through a bounded outbox drained by its own writer task,
+    # so a slow reader never blocks delivery to anybody else
+    def __init__(self, websocket: WebSocket, user_id: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.outbox = asyncio.Queue(maxsize=MESSAGE_OUTBOX_SIZE)
+        self.writer = None
+        self.closing = None
+
+    def push(self, frame: str):
+        try:
+            self.outbox.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def write_loop(self):
+        while True:
+            await self.websocket.send_text(await self.outbox.get())
+
+    def close_stalled(self):
+        # backpressure: a socket that can't keep up is dropped, the client reconnects and catches up from history
+        if self.closing is None:
+            print(f"Closing stalled message socket of user {self.user_id}")
+            self.writer.cancel()
+            self.closing = asyncio.create_task(self.websocket.close(code=1013))
+
+
+class ConnectionHub:
+    def __init__(self):
+        self.connections = {}
+        self.pubsub = None
+
+    async def add(self, connection: Connection):
+        sockets = self.connections.setdefault(connection.user_id, set())
+        sockets.add(connection)
+        if len(sockets) == 1 and self.pubsub is not None:
+            try:
+                await self.pubsub.subscribe(user_channel(connection.user_id))
+            except redis.RedisError as e:
+                print(f"Redis error in ConnectionHub.add: {e}")
+
+    async def remove(self, connection: Connection):
+        sockets = self.connections.get(connection.user_id)
+        if not sockets:
+            return
+        sockets.discard(connection)
+        if not sockets:
+            del self.connections[connection.user_id]
+            if self.pubsub is not None:
+                try:
+                    await self.pubsub.unsubscribe(user_channel(connection.user_id))
+                except redis.RedisError as e:
+                    print(f"Redis error in ConnectionHub.remove: {e}")
+
+    def deliver(self, user_id: int, frame: str):
+        for connection in list(self.connections.get(user_id, ())):
+            if not connection.push(frame):
+                connection.close_stalled()
+
+
+hub = ConnectionHub()
+
+
+async def publish(frame: dict, *user_ids: int):
+    payload = json.dumps(jsonable_encoder(frame))
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for user_id in set(user_ids):
+                pipe.publish(user_channel(user_id), payload)
+            await pipe.execute()
+    except redis.RedisError as e:
+        # at least the sockets on this worker still get it
+        print(f"Redis error in publish: {e}")
+        for user_id in set(user_ids):
+            hub.deliver(user_id, payload)
+
+
+async def run_message_dispatcher():
+    # one pubsub connection per worker, resubscribed to the connected users after a Redis failure
+    while True:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(WORKER_CHANNEL, *(user_channel(user_id) for user_id in list(hub.connections)))
+            hub.pubsub = pubsub
+            async for message in pubsub.listen():
+                channel = message["channel"].decode()
+                if channel.startswith("dm:user:"):
+                    hub.deliver(int(channel.rpartition(":")[2]), message["data"].decode())
+        except redis.RedisError as e:
+            print(f"Redis error in run_message_dispatcher: {e}")
+            await asyncio.sleep(1)
+        finally:
+            hub.pubsub = None
+            await pubsub.aclose()
+
+
+# one row per (conversation, sender) in a batch: moves the conversation's last message forward and adds the
+# sender's messages to the other participant's unread count. Batches from several workers may commit out of order,
+# so the last message only ever moves to a higher id.
+_newer = bindparam("last_id") > func.coalesce(Conversation.last_message_id, 0)
+_bump_conversation = (
+    update(Conversation.__table__)
+    .where(Conversation.id == bindparam("conversation_id"))
+    .values(
+        last_message_id=case((_newer, bindparam("last_id")), else_=Conversation.last_message_id),
+        last_message_at=case((_newer, bindparam("last_at")), else_=Conversation.last_message_at),
+        user1_unread_count=Conversation.user1_unread_count + case((Conversation.user1_id == bindparam("sender_id"), 0), else_=bindparam("count")),
+        user2_unread_count=Conversation.user2_unread_count + case((Conversation.user2_id == bindparam("sender_id"), 0), else_=bindparam("count")),
+    )
+)
+
+
+def _conversation_updates(messages: list[Message]):
+    updates = {}
+    for message in messages:
+        entry = updates.setdefault((message.conversation_id, message.sender_id), {
+            "conversation_id": message.conversation_id, "sender_id": message.sender_id, "count": 0, "last_id": 0, "last_at": None,
+        })
+        entry["count"] += 1
+        if message.id > entry["last_id"]:
+            entry["last_id"], entry["last_at"] = message.id, message.created_at
+    # rows are locked in conversation id order by every writer, so concurrent batches can't deadlock
+    return [updates[key] for key in sorted(updates)]
+
+
+class MessageWriter:
+    # messages from all sockets of this worker are inserted together, one INSERT ... RETURNING per batch
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        # the batch the run loop holds, and whether its INSERT has been sent
+        self.batch = []
+        self.flushing = False
+        self.closed = False
+
+    async def write(self, conversation_id: int, sender_id: int, content: str, post_id: int | None = None):
+        if self.closed:
+            raise RuntimeError("Message writer is shut down")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(({"conversation_id": conversation_id, "sender_id": sender_id, "content": content, "post_id": post_id}, future))
+        return await future
+
+    async def _insert(self, rows: list[dict]):
+        async with AsyncSessionLocal() as db:
+            messages = (await db.scalars(insert(Message).returning(Message, sort_by_parameter_order=True), rows)).all()
+            await db.execute(_bump_conversation, _conversation_updates(messages))
+            await db.commit()
+        return messages
+
+    async def flush(self, batch):
+        try:
+            messages = await self._insert([row for row, _ in batch])
+            results = list(zip(batch, messages))
+        except Exception as e:
+            # one bad row (e.g. a deleted post) must not fail the others, retry them one by one
+            print(f"Error inserting message batch: {e}")
+            results = []
+            for row, future in batch:
+                try:
+                    results.append(((row, future), (await self._insert([row]))[0]))
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+        for (_, future), message in results:
+            if not future.done():
+                future.set_result(message)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.batch = batch = [await self.queue.get()]
+            deadline = loop.time() + MESSAGE_BATCH_WINDOW
+            while len(batch) < MESSAGE_BATCH_SIZE:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            self.flushing = True
+            await self.flush(batch)
+            self.batch, self.flushing = [], False
+
+    async def drain(self):
+        # on shutdown, after the run loop is cancelled: writes what it was still collecting or left queued.
+        # A batch cancelled mid-INSERT may or may not have committed, its writers get an error instead of a retry
+        # that could duplicate the messages. Either way no caller is left waiting.
+        self.closed = True
+        batch = [] if self.flushing else self.batch
+        if self.flushing:
+            for _, future in self.batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Message writer shut down during the write"))
+        self.batch, self.flushing = [], False
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            await self.flush(batch)
+
+
+message_writer = MessageWriter()
+
+# (user1_id, user2_id) -> conversation id, a pair's conversation never changes once created
+_conversation_ids = LocalCache(int(os.getenv("CONVERSATION_CACHE_SIZE", 10000)), 3600)
+
+
+async def get_or_create_conversation(user_id: int, other_id: int):
+    user1_id, user2_id = sorted((user_id, other_id))
+    key = f"{user1_id}:{user2_id}"
+    conversation_id = _conversation_ids.get(key)
+    if conversation_id is None:
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                pg_insert(Conversation)
+                .values(user1_id=user1_id, user2_id=user2_id)
+                .on_conflict_do_nothing(constraint="unique_user_pair")
+            )
+            conversation_id = await db.scalar(
+                select(Conversation.id).where(Conversation.user1_id == user1_id, Conversation.user2_id == user2_id)
+            )
+            await db.commit()
+        _conversation_ids.set(key, conversation_id)
+    return conversation_id
+
+
+def participant_side(conversation: Conversation, user_id: int):
+    # "user1" or "user2", the prefix of that participant's read cursor and unread count columns
+    return "user1" if conversation.user1_id == user_id else "user2"
+
+
+async def mark_read(user_id: int, conversation_id: int, message_id: int | None = None):
+    # moves the user's read cursor up to message_id (default: the last message) and recounts what is left unread.
+    # Returns (last_read_id, unread_count, other participant id), or None if the user is not in the conversation.
+    async with AsyncSessionLocal() as db:
+        # the row lock waits out a message batch touching the conversation, so the count below sees its messages
+        conversation = await db.scalar(select(Conversation).where(Conversation.id == conversation_id).with_for_update())
+        if not conversation or user_id not in (conversation.user1_id, conversation.user2_id):
+            return None
+        side = participant_side(conversation, user_id)
+        last_read_id = getattr(conversation, f"{side}_last_read_id")
+        last_message_id = conversation.last_message_id or 0
+        message_id = last_message_id if message_id is None else min(message_id, last_message_id)
+        if message_id > last_read_id:
+            unread_count = await db.scalar(
+                select(func.count()).select_from(Message).where(
+                    Message.conversation_id == conversation_id, Message.id > message_id, Message.sender_id != user_id
+                )
+            )
+            setattr(conversation, f"{side}_last_read_id", message_id)
+            setattr(conversation, f"{side}_unread_count", unread_count)
+            last_read_id = message_id
+        other_id = conversation.user2_id if side == "user1" else conversation.user1_id
+        result = (last_read_id, getattr(conversation, f"{side}_unread_count"), other_id)
+        await db.commit()
+    return result
@@ -1,5 +1,5 @@
 from geoalchemy2 import Geometry
-from sqlalchemy import Column, Integer, Boolean, String, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, Boolean, String, DateTime, Float, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import relationship, validates
 from sqlalchemy.sql import func
 import datetime
@@ -15,13 +15,32 @@ class Follow(Base):
     follower = relationship("User", foreign_keys=[follower_id], back_populates="following")
     following = relationship("User", foreign_keys=[following_id], back_populates="followers")
 
+    __table_args__ = (
+        # the primary key covers "who does X follow", this one "who follows X" (feed fan-out, follower lists)
+        Index("ix_follows_following_id", "following_id"),
+    )
+
 class Conversation(Base):
     __tablename__ = "conversations"
     id = Column(Integer, primary_key=True, index=True)
     user1_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     user2_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    __table_args__ = (UniqueConstraint("user1_id", "user2_id", name="unique_user_pair"),)
+    # denormalized by the message writer in the same transaction as the insert, so the inbox needs no messages scan.
+    # No FK on last_message_id, it would make conversations and messages depend on each other.
+    last_message_id = Column(Integer, nullable=True)
+    last_message_at = Column(DateTime(timezone=True), nullable=True)
+    # per participant read cursor (last read message id) and count of the other side's messages past it
+    user1_last_read_id = Column(Integer, nullable=False, server_default="0")
+    user2_last_read_id = Column(Integer, nullable=False, server_default="0")
+    user1_unread_count = Column(Integer, nullable=False, server_default="0")
+    user2_unread_count = Column(Integer, nullable=False, server_default="0")
+    __table_args__ = (
+        UniqueConstraint("user1_id", "user2_id", name="unique_user_pair"),
+        # a user is on either side of the pair, the inbox reads both in last_message_at order
+        Index("ix_conversations_user1_id_last_message_at", "user1_id", "last_message_at", "id"),
+        Index("ix_conversations_user2_id_last_message_at", "user2_id", "last_message_at", "id"),
+    )
     user1 = relationship("User", foreign_keys=[user1_id])
     user2 = relationship("User", foreign_keys=[user2_id])
     messages = relationship("Message", back_populates="conversation")
@@ -50,7 +69,7 @@ class User(Base):
     visited_count = Column(Integer, default=0)
 
     created_at = Column(DateTime(timezone=True), default=func.now())
-    last_seen_at = Column(DateTime, default=datetime.datetime.now(datetime.UTC))
+    last_seen_at = Column(DateTime, default=lambda: datetime.datetime.now(datetime.UTC).replace(tzinfo=None))
     updated_at = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now())
 
     is_suspended = Column(Boolean, default=False)
@@ -99,6 +118,18 @@ class Pin(Base):
     hangouts = relationship("Hangout", back_populates="pin")
     posts = relationship("Post", back_populates="pin")
 
+# KNN (`<->`) and ST_DWithin in meters for /pins/nearby, the queries must use the same geography() expression
+Index("ix_pins_coordinates_geography", func.geography(Pin.coordinates), postgresql_using="gist")
+
+class PinCluster(Base):
+    __tablename__ = "pin_clusters"
+    zoom = Column(Integer, primary_key=True)
+    grid_x = Column(Integer, primary_key=True)
+    grid_y = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    sum_lon = Column(Float, nullable=False, default=0)
+    sum_lat = Column(Float, nullable=False, default=0)
+
 class Wishlist(Base):
     __tablename__ = "wishlists"
     user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
@@ -182,10 +213,20 @@ class Hangout(Base):
     pin_id = Column(Integer, ForeignKey("pins.id"))
     expected_participants = Column(Integer, nullable=True)
     max_participants = Column(Integer, nullable=False)
+    # kept in step with hangout_participants by join/leave, capacity is checked against it
+    participant_count = Column(Integer, nullable=False, default=0, server_default="0")
     start_time = Column(DateTime(timezone=True), default=func.now())
     duration = Column(Interval, nullable=False)
     created_at = Column(DateTime(timezone=True), default=func.now())
     updated_at = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        # /hangouts/upcoming: a start_time range, keyset ordered by (start_time, id)
+        Index("ix_hangouts_start_time_id", "start_time", "id"),
+        # max(duration) bounds how far before the window an event still running may have started
+        Index("ix_hangouts_duration", "duration"),
+    )
+
     pin = relationship("Pin", back_populates="hangouts")
     user = relationship("User", back_populates="hangouts")
     participants = relationship("HangoutParticipant", back_populates="hangout")
@@ -210,11 +251,26 @@ class Post(Base):
     created_at = Column(DateTime(timezone=True), default=func.now())
     media_url = Column(String, nullable=True)
     view_count = Column(Integer, default=0)
+
+    __table_args__ = (
+        Index("ix_posts_created_at_id", "created_at", "id"),
+        Index("ix_posts_user_id_id", "user_id", "id"),
+    )
+
     user = relationship("User", back_populates="posts")
     pin = relationship("Pin", back_populates="posts")
     comments = relationship("Comment", back_populates="post")
     likes = relationship("PostLike", back_populates="post")
 
+class MediaBlob(Base):
+    # content addressed media file shared by every row that uploaded the same bytes, see uploads.py
+    __tablename__ = "media_blobs"
+    digest = Column(String(64), primary_key=True)
+    media_type = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), default=func.now())
+
 class Comment(Base):
     __tablename__ = "comments"
     id = Column(Integer, primary_key=True, index=True)
@@ -224,6 +280,13 @@ class Comment(Base):
     parent_id = Column(Integer, ForeignKey("comments.id"), nullable=True)
     created_at = Column(DateTime(timezone=True), default=func.now())
     like_count = Column(Integer, default=0)
+
+    __table_args__ = (
+        Index("ix_comments_post_id_created_at_id", "post_id", "created_at", "id"),
+        Index("ix_comments_user_id_created_at_id", "user_id", "created_at", "id"),
+        Index("ix_comments_parent_id_created_at_id", "parent_id", "created_at", "id"),
+    )
+
     user = relationship("User", back_populates="comments")
     post = relationship("Post", back_populates="comments")
     likes = relationship("CommentLike", back_populates="comment")
@@ -255,4 +318,8 @@ class Message(Base):
 
     created_at = Column(DateTime(timezone=True), default=func.now())
     sender = relationship("User", back_populates="messages")
+    __table_args__ = (
+        # history pages and unread counts of one conversation
+        Index("ix_messages_conversation_id_created_at_id", "conversation_id", "created_at", "id"),
+    )
     conversation = relationship("Conversation", back_populates="messages")
\ No newline at end of file
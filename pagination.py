@@ -0,0 +1,62 @@
+import base64
+import binascii
+import json
+import os
+from datetime import datetime
+from fastapi import HTTPException, Response
+from sqlalchemy import tuple_
+from starlette import status
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+PAGE_MAX_LIMIT = int(os.getenv("PAGE_MAX_LIMIT", 100))
+
+
+def encode_cursor(*values):
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *types):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return [datetime.fromisoformat(v) if t is datetime else t(v) for t, v in zip(types, values, strict=True)]
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def check_limit(limit: int, maximum: int = PAGE_MAX_LIMIT):
+    # a negative LIMIT is a database error and a huge one is no page at all
+    if not 0 < limit <= maximum:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"limit must be between 1 and {maximum}")
+
+
+def check_offset(offset: int, cursor: str | None):
+    if offset < 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="offset can't be negative")
+    # the cursor already positions the page, an offset on top would skip rows past it and bring back the deep scan
+    if offset and cursor:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="offset can't be combined with cursor")
+
+
+def paginate_by_id(query, id_column, cursor: str | None, limit: int):
+    if cursor:
+        (last_id,) = decode_cursor(cursor, int)
+        query = query.where(id_column > last_id)
+    return query.order_by(id_column).limit(limit)
+
+
+def paginate_by_created(query, created_column, id_column, cursor: str | None, limit: int, descending: bool = True):
+    # (created_at, id) row comparison, id breaks ties between rows created in the same transaction
+    key = tuple_(created_column, id_column)
+    if cursor:
+        last_created, last_id = decode_cursor(cursor, datetime, int)
+        query = query.where(key < (last_created, last_id) if descending else key > (last_created, last_id))
+    if descending:
+        return query.order_by(created_column.desc(), id_column.desc()).limit(limit)
+    return query.order_by(created_column, id_column).limit(limit)
+
+
+def set_next_cursor(response: Response, page_size: int, limit: int, *last_key):
+    # a short page is the last one, so only a full page hands out a cursor
+    if page_size and page_size == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(*last_key)
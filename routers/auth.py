@@ -1,9 +1,11 @@
 from datetime import timedelta, datetime
 from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
-from database import SessionLocal
+from starlette.concurrency import run_in_threadpool
+from database import db_dependency
 from models import User
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
@@ -46,14 +48,6 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/token")
 oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="api/auth/token", auto_error=False)
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
 
 
 def check_login_attempts(email: str):
@@ -128,7 +122,7 @@ def clear_login_attempts(email: str):
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
 async def create_user(db: db_dependency, create_user_request: CreateUserRequest):
-    user = db.query(User).filter(User.email == create_user_request.email).first()
+    user = await db.scalar(select(User).where(User.email == create_user_request.email))
     if user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
     if len(create_user_request.password) < 8:
@@ -137,16 +131,16 @@ async def create_user(db: db_dependency, create_user_request: CreateUserRequest)
     create_user_model = User(
         email=create_user_request.email,
         username=create_user_request.username,
-        hashed_password=pwd_context.hash(create_user_request.password),
+        hashed_password=await run_in_threadpool(pwd_context.hash, create_user_request.password),
     )
 
     db.add(create_user_model)
-    db.commit()
+    await db.commit()
 
 @router.post("/token", response_model=Token)
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: db_dependency):
     check_login_attempts(form_data.username)
-    user = authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         record_failed_attempt(form_data.username)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
@@ -157,11 +151,12 @@ async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm,
     return {"access_token": token, "token_type": "bearer"}
 
 
-def authenticate_user(email: str, password: str, db):
-    user = db.query(User).filter(User.email == email).first()
+async def authenticate_user(email: str, password: str, db: AsyncSession):
+    user = await db.scalar(select(User).where(User.email == email))
     if not user:
         return False
-    if not pwd_context.verify(password, user.hashed_password):
+    # bcrypt is deliberately slow, keep it off the event loop
+    if not await run_in_threadpool(pwd_context.verify, password, user.hashed_password):
         return False
     if user.is_suspended:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is suspended")
@@ -207,9 +202,9 @@ async def create_admin_user(db: db_dependency, create_user_request: CreateUserRe
     create_user_model = User(
         email=create_user_request.email,
         username=create_user_request.username,
-        hashed_password=pwd_context.hash(create_user_request.password),
+        hashed_password=await run_in_threadpool(pwd_context.hash, create_user_request.password),
         is_admin=True,
     )
 
     db.add(create_user_model)
-    db.commit()
\ No newline at end of file
+    await db.commit()
\ No newline at end of file
@@ -1,30 +1,48 @@
 from fastapi import APIRouter, Depends, HTTPException
 from typing import Annotated, List
-from database import SessionLocal
+from database import db_dependency
 from starlette import status
-from sqlalchemy.orm import Session
+from sqlalchemy import select
 from schemas import CategoryRequest, CategoryResponse
 from models import Category, FavoriteCategory
 from routers.auth import get_current_user
+from cache import cached_json, invalidate
+from counters import cache_counters
+import os
 
 router = APIRouter(
     prefix = "/categories",
     tags = ["categories"]
 )
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
+CATEGORY_CACHE_TTL = int(os.getenv("CATEGORY_CACHE_TTL", 3600))
+CATEGORIES_CACHE_KEY = "categories:all"
+# a category's payload carries its counters, kept shorter than the name list and dropped when they're flushed
+CATEGORY_DETAIL_CACHE_TTL = int(os.getenv("CATEGORY_DETAIL_CACHE_TTL", 300))
+
+
+def category_cache_key(id: int):
+    return f"categories:{id}"
+
+
+cache_counters(Category, category_cache_key)
+
+
+def serialize_category(category: Category):
+    return {
+        "id": category.id,
+        "name": category.name,
+        "location_count": category.location_count,
+        "post_count": category.post_count,
+    }
 
 @router.get("/", response_model=List[CategoryResponse])
 async def get_all_categories(db: db_dependency):
-    categories = db.query(Category).all()
+    async def load_categories():
+        return [{"id": c.id, "name": c.name} for c in (await db.scalars(select(Category))).all()]
+
+    categories = await cached_json(CATEGORIES_CACHE_KEY, CATEGORY_CACHE_TTL, load_categories)
     if not categories:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No categories found")
     return categories
@@ -35,7 +53,7 @@ async def create_category(db: db_dependency, cat: CategoryRequest, user: user_de
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
     if not cat.name:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Category name is required")
-    categories = db.query(Category).all()
+    categories = (await db.scalars(select(Category))).all()
     for category in categories:
         if category.name == cat.name:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Category already exists")
@@ -44,12 +62,17 @@ async def create_category(db: db_dependency, cat: CategoryRequest, user: user_de
         name=cat.name
     )
     db.add(new_category)
-    db.commit()
-    db.refresh(new_category)
+    await db.commit()
+    await db.refresh(new_category)
+    await invalidate(CATEGORIES_CACHE_KEY)
     return new_category
 @router.get("/{id}")
 async def get_category_by_id(id: int, db: db_dependency):
-    category = db.query(Category).filter(Category.id == id).first()
+    async def load_category():
+        category = await db.scalar(select(Category).where(Category.id == id))
+        return serialize_category(category) if category else None
+
+    category = await cached_json(category_cache_key(id), CATEGORY_DETAIL_CACHE_TTL, load_category)
     if not category:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Category not found")
     return category
@@ -58,7 +81,7 @@ async def favorite_category(id: int, db: db_dependency, user: user_dependency):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
 
-    category = db.query(Category).filter(Category.id == id).first()
+    category = await db.scalar(select(Category).where(Category.id == id))
     if not category:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Category not found")
 
@@ -67,21 +90,21 @@ async def favorite_category(id: int, db: db_dependency, user: user_dependency):
         category_id=id
     )
     db.add(new_favorite_category)
-    db.commit()
-    db.refresh(new_favorite_category)
+    await db.commit()
+    await db.refresh(new_favorite_category)
     return {"detail": "Category favorited successfully"}
 @router.delete("/{id}/favorite", status_code=status.HTTP_200_OK)
 async def unfavorite_category(id: int, db: db_dependency, user: user_dependency):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
 
-    favorite_category = db.query(FavoriteCategory).filter(
+    favorite_category = await db.scalar(select(FavoriteCategory).where(
         FavoriteCategory.user_id == user["id"],
         FavoriteCategory.category_id == id
-    ).first()
+    ))
     if not favorite_category:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Favorite category not found")
 
-    db.delete(favorite_category)
-    db.commit()
+    await db.delete(favorite_category)
+    await db.commit()
     return {"detail": "Category unfavorited successfully"}
\ No newline at end of file
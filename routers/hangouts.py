@@ -1,10 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 from typing import Annotated, List, Optional
-from database import SessionLocal
-from sqlalchemy.orm import Session, joinedload
+from datetime import datetime, timezone
+from database import db_dependency, AsyncSessionLocal
+from sqlalchemy import select, func, exists, literal, or_, delete, update, exc, DateTime
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import joinedload, contains_eager
 from models import Hangout, HangoutParticipant, Pin, PinCategory, Follow
-from schemas import HangoutRequest, HangoutUpdate, HangoutResponse, ParticipantUserResponse
+from schemas import HangoutRequest, HangoutUpdate, HangoutResponse, UpcomingHangoutResponse, ParticipantUserResponse
+from pagination import paginate_by_created, set_next_cursor
 from routers.auth import get_current_user
+from trending import parse_bbox
+from uploads import check_rendered_variants
+from hangout_events import bbox_channels, hangout_channel, publish_hangout_event, stream_events
 from geoalchemy2.shape import to_shape
 from shapely.geometry import mapping
 
@@ -14,18 +22,17 @@ router = APIRouter(
 )
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+user_dependency = Annotated[dict, Depends(get_current_user)]
 
+UPCOMING_MAX_LIMIT = 100
+UPCOMING_MAX_RADIUS = 200_000
+
+def attending(user_id: int):
+    # the caller's participation as a column, so participant rows are never loaded to answer it
+    return exists().where(HangoutParticipant.hangout_id == Hangout.id, HangoutParticipant.user_id == user_id)
 
-db_dependency = Annotated[Session, Depends(get_db)]
-user_dependency = Annotated[dict, Depends(get_current_user)]
 
-def serialize_hangout(hangout: Hangout, current_user_id: int):
+def serialize_hangout(hangout: Hangout, is_attending: bool):
     coordinates = {}
     if hangout.pin and hangout.pin.coordinates:
         point = to_shape(hangout.pin.coordinates)
@@ -35,16 +42,13 @@ def serialize_hangout(hangout: Hangout, current_user_id: int):
     if hangout.pin and hangout.pin.categories:
         categories = [cat.category.name for cat in hangout.pin.categories]
 
-    is_attending = False
-    if current_user_id and hangout.participants:
-        is_attending = any(p.user_id == current_user_id for p in hangout.participants)
-
     return {
         "title": hangout.title,
         "description": hangout.description,
         "catering": hangout.catering,
         "expected_participants": hangout.expected_participants,
         "max_participants": hangout.max_participants,
+        "participant_count": hangout.participant_count,
         "start_time": hangout.start_time,
         "duration": hangout.duration,
         "pin": {
@@ -63,25 +67,111 @@ def serialize_hangout(hangout: Hangout, current_user_id: int):
         "owner_id": hangout.creator_id,
         "owner_username": hangout.user.username,
         "owner_pfp": hangout.user.pfp_url,
-        "is_attending": is_attending
+        "is_attending": bool(is_attending)
     }
 
 
 @router.get("/", response_model=List[HangoutResponse])
 async def get_all_hangouts(db: db_dependency, user: user_dependency):
-    hangouts = db.query(Hangout) \
+    rows = (await db.execute(
+        select(Hangout, attending(user["id"]))
         .options(
-        joinedload(Hangout.participants),
-        joinedload(Hangout.pin).joinedload(Pin.categories).joinedload(PinCategory.category),
-        joinedload(Hangout.user)
-    ) \
-        .all()
-
-    if not hangouts:
-        return []
-
-    current_user_id = user["id"] if user else None
-    return [serialize_hangout(h, current_user_id) for h in hangouts]
+            joinedload(Hangout.pin).selectinload(Pin.categories).joinedload(PinCategory.category),
+            joinedload(Hangout.user)
+        )
+    )).all()
+
+    await check_rendered_variants(*(hangout.pin.title_image_url for hangout, _ in rows if hangout.pin))
+    return [serialize_hangout(hangout, is_attending) for hangout, is_attending in rows]
+
+
+@router.get("/upcoming", response_model=List[UpcomingHangoutResponse])
+async def get_upcoming_hangouts(db: db_dependency,
+                                user: user_dependency,
+                                response: Response,
+                                lat: Optional[float] = None,
+                                lon: Optional[float] = None,
+                                radius: float = 25_000,
+                                from_: Annotated[Optional[datetime], Query(alias="from")] = None,
+                                to: Optional[datetime] = None,
+                                limit: int = 20,
+                                cursor: Optional[str] = None):
+    # hangouts still running at or starting after `from` (default now) and starting before `to`, soonest first,
+    # optionally within `radius` meters of lat/lon. Participants come back as a count, not a list.
+    if (lat is None) != (lon is None):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="lat and lon go together")
+    if lat is not None and not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid coordinates")
+    if not 0 < radius <= UPCOMING_MAX_RADIUS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"radius must be between 0 and {UPCOMING_MAX_RADIUS} meters")
+    if not 0 < limit <= UPCOMING_MAX_LIMIT:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"limit must be between 1 and {UPCOMING_MAX_LIMIT}")
+    # start_time is timestamptz, a bound without an offset is taken as UTC
+    window_start = from_ or datetime.now(timezone.utc)
+    if window_start.tzinfo is None:
+        window_start = window_start.replace(tzinfo=timezone.utc)
+    if to is not None and to.tzinfo is None:
+        to = to.replace(tzinfo=timezone.utc)
+    if to is not None and to <= window_start:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="to must be after from")
+
+    # start_time + duration can't be indexed, the longest duration turns "still running" into a start_time range
+    longest = select(func.max(Hangout.duration)).scalar_subquery()
+    query = (
+        select(Hangout, attending(user["id"]))
+        .join(Pin, Pin.id == Hangout.pin_id)
+        .where(
+            Hangout.start_time > literal(window_start, DateTime(timezone=True)) - longest,
+            Hangout.start_time + Hangout.duration > window_start
+        )
+        .options(
+            contains_eager(Hangout.pin).selectinload(Pin.categories).joinedload(PinCategory.category),
+            joinedload(Hangout.user)
+        )
+    )
+    if to is not None:
+        query = query.where(Hangout.start_time < to)
+    if lat is not None:
+        # same geography() expression as ix_pins_coordinates_geography, see /pins/nearby
+        origin = func.geography(func.ST_SetSRID(func.ST_MakePoint(lon, lat), 4326))
+        pin_geography = func.geography(Pin.coordinates)
+        query = query.add_columns(func.ST_Distance(pin_geography, origin)).where(func.ST_DWithin(pin_geography, origin, radius))
+
+    rows = (await db.execute(
+        paginate_by_created(query, Hangout.start_time, Hangout.id, cursor, limit, descending=False)
+    )).all()
+    if rows:
+        set_next_cursor(response, len(rows), limit, rows[-1][0].start_time, rows[-1][0].id)
+    await check_rendered_variants(*(row[0].pin.title_image_url for row in rows))
+    return [
+        {
+            **serialize_hangout(hangout, is_attending),
+            "id": hangout.id,
+            "distance_m": distance_m[0] if distance_m else None,
+        }
+        for hangout, is_attending, *distance_m in rows
+    ]
+
+
+async def stream_user(request: Request, token: Optional[str]):
+    # EventSource can't set headers, so like the message socket the JWT may also come as ?token=
+    return await get_current_user(token or request.headers.get("authorization", "").removeprefix("Bearer "))
+
+
+def event_stream(body):
+    # X-Accel-Buffering keeps nginx from holding events back until its buffer fills
+    return StreamingResponse(body, media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.get("/events")
+async def stream_bbox_hangout_events(request: Request, bbox: str, token: Optional[str] = None):
+    # join/leave/update events of hangouts whose pin is inside min_lon,min_lat,max_lon,max_lat
+    await stream_user(request, token)
+    bounds = parse_bbox(bbox)
+    channels = bbox_channels(bounds)
+    if channels is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="bbox too large, zoom in")
+    return event_stream(stream_events(channels, bbox=bounds))
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=HangoutResponse)
@@ -98,35 +188,59 @@ async def create_hangout(db: db_dependency, hangout: HangoutRequest, user: user_
         duration=hangout.duration
     )
     db.add(new_hangout)
-    db.commit()
-    db.refresh(new_hangout)
+    await db.commit()
+    await db.refresh(new_hangout)
     return await get_hangout(new_hangout.id, db, user)
 
 
 @router.get("/{hangout_id}", response_model=HangoutResponse)
 async def get_hangout(hangout_id: int, db: db_dependency, user: user_dependency):
-    hangout = db.query(Hangout) \
-        .filter(Hangout.id == hangout_id) \
+    row = (await db.execute(
+        select(Hangout, attending(user["id"]))
+        .where(Hangout.id == hangout_id)
         .options(
-        joinedload(Hangout.participants),
-        joinedload(Hangout.pin).joinedload(Pin.categories).joinedload(PinCategory.category),
-        joinedload(Hangout.user)
-    ) \
-        .first()
+            joinedload(Hangout.pin).selectinload(Pin.categories).joinedload(PinCategory.category),
+            joinedload(Hangout.user)
+        )
+        .execution_options(populate_existing=True)
+    )).first()
 
-    if not hangout:
+    if not row:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Hangout not found")
 
-    current_user_id = user["id"] if user else None
-    return serialize_hangout(hangout, current_user_id)
+    await check_rendered_variants(row[0].pin.title_image_url if row[0].pin else None)
+    return serialize_hangout(*row)
+
+
+@router.get("/{hangout_id}/events")
+async def stream_hangout_events(hangout_id: int, request: Request, token: Optional[str] = None):
+    # starts with a snapshot of the count, then join/leave/update events. No DB session is held while streaming.
+    await stream_user(request, token)
+
+    async def load_participant_count():
+        async with AsyncSessionLocal() as db:
+            return await db.scalar(select(Hangout.participant_count).where(Hangout.id == hangout_id))
+
+    if await load_participant_count() is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Hangout not found")
+
+    async def snapshot():
+        # read again inside the stream, after it subscribed
+        participant_count = await load_participant_count()
+        if participant_count is None:
+            return None
+        return {"type": "snapshot", "hangout_id": hangout_id, "participant_count": participant_count}
+
+    return event_stream(stream_events([hangout_channel(hangout_id)], snapshot))
 
 
 @router.put("/{hangout_id}", response_model=HangoutResponse)
 async def update_hangout(hangout_id: int, updated_hangout: HangoutUpdate, db: db_dependency, user: user_dependency):
-    hangout = db.query(Hangout) \
-        .filter(Hangout.id == hangout_id) \
-        .options(joinedload(Hangout.user), joinedload(Hangout.pin)) \
-        .first()
+    hangout = await db.scalar(
+        select(Hangout)
+        .where(Hangout.id == hangout_id)
+        .options(joinedload(Hangout.user), joinedload(Hangout.pin))
+    )
 
     if not hangout:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Hangout not found")
@@ -134,64 +248,78 @@ async def update_hangout(hangout_id: int, updated_hangout: HangoutUpdate, db: db
     if hangout.creator_id != user["id"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You are not the owner")
 
+    previous_pin_id = hangout.pin_id
     update_data = updated_hangout.model_dump(exclude_unset=True)
     for key, value in update_data.items():
         setattr(hangout, key, value)
 
-    db.commit()
-    db.refresh(hangout)
+    await db.commit()
+    await publish_hangout_event({"type": "update", "changes": update_data}, hangout.id, previous_pin_id, hangout.pin_id)
 
     return await get_hangout(hangout.id, db, user)
 
 
 @router.post("/{hangout_id}/join", status_code=status.HTTP_202_ACCEPTED)
 async def join_hangout(hangout_id: int, db: db_dependency, user: user_dependency):
-    hangout = db.query(Hangout).filter(Hangout.id == hangout_id).with_for_update().first()
-
-    if not hangout:
+    # no lock is taken up front: the participant row is inserted, then the count is bumped only while below
+    # capacity. Whichever check fails rolls both back, concurrent joins only ever wait on the count update.
+    try:
+        joined = await db.scalar(
+            pg_insert(HangoutParticipant)
+            .values(hangout_id=hangout_id, user_id=user["id"])
+            .on_conflict_do_nothing()
+            .returning(HangoutParticipant.user_id)
+        )
+    except exc.IntegrityError:
+        await db.rollback()
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Hangout not found")
 
-    existing = db.query(HangoutParticipant) \
-        .filter(HangoutParticipant.hangout_id == hangout_id, HangoutParticipant.user_id == user["id"]) \
-        .first()
-
-    if existing:
-        db.rollback()
+    if joined is None:
+        await db.rollback()
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Already joined")
 
-    if hangout.max_participants is not None:
-        if len(hangout.participants) >= hangout.max_participants:
-            db.rollback()
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Hangout is full")
-
-    participant = HangoutParticipant(
-        hangout_id=hangout_id,
-        user_id=user["id"]
-    )
-    db.add(participant)
-    db.commit()
-    db.refresh(participant)
-
-    return {"message": "Successfully joined hangout", "hangout_id": hangout_id}
+    counted = (await db.execute(
+        update(Hangout)
+        .where(
+            Hangout.id == hangout_id,
+            or_(Hangout.max_participants.is_(None), Hangout.participant_count < Hangout.max_participants)
+        )
+        .values(participant_count=Hangout.participant_count + 1)
+        .returning(Hangout.participant_count, Hangout.pin_id)
+    )).first()
+    if counted is None:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Hangout is full")
+    await db.commit()
+    participant_count, pin_id = counted
+    await publish_hangout_event({"type": "join", "user_id": user["id"], "participant_count": participant_count}, hangout_id, pin_id)
+
+    return {"message": "Successfully joined hangout", "hangout_id": hangout_id, "participant_count": participant_count}
 
 @router.post("/{hangout_id}/leave", status_code=status.HTTP_202_ACCEPTED)
 async def leave_hangout(hangout_id: int, db: db_dependency, user: user_dependency):
-    hangout = db.query(Hangout).filter(Hangout.id == hangout_id).with_for_update().first()
-
-    if not hangout:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Hangout not found")
-
-    existing = db.query(HangoutParticipant) \
-        .filter(HangoutParticipant.hangout_id == hangout_id, HangoutParticipant.user_id == user["id"]) \
-        .first()
+    left = await db.scalar(
+        delete(HangoutParticipant)
+        .where(HangoutParticipant.hangout_id == hangout_id, HangoutParticipant.user_id == user["id"])
+        .returning(HangoutParticipant.user_id)
+    )
 
-    if not existing:
+    if left is None:
+        await db.rollback()
+        if not await db.scalar(select(Hangout.id).where(Hangout.id == hangout_id)):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Hangout not found")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Already left")
 
-    db.delete(existing)
-    db.commit()
+    participant_count, pin_id = (await db.execute(
+        update(Hangout)
+        .where(Hangout.id == hangout_id)
+        .values(participant_count=func.greatest(Hangout.participant_count - 1, 0))
+        .returning(Hangout.participant_count, Hangout.pin_id)
+    )).one()
+    await db.commit()
+    await publish_hangout_event({"type": "leave", "user_id": user["id"], "participant_count": participant_count}, hangout_id, pin_id)
 
-    return {"message": "Successfully left hangout", "hangout_id": hangout_id}
+    return {"message": "Successfully left hangout", "hangout_id": hangout_id, "participant_count": participant_count}
 
 
 @router.get("/{hangout_id}/participants", response_model=List[ParticipantUserResponse])
@@ -199,27 +327,30 @@ async def get_hangout_participants(hangout_id: int, db: db_dependency, user: use
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
 
-    hangout = db.query(Hangout).filter(Hangout.id == hangout_id).first()
+    hangout = await db.scalar(select(Hangout).where(Hangout.id == hangout_id))
     if not hangout:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Hangout not found")
 
-    participants = db.query(HangoutParticipant) \
-        .filter(HangoutParticipant.hangout_id == hangout_id) \
-        .options(joinedload(HangoutParticipant.user)) \
-        .all()
+    participants = (await db.scalars(
+        select(HangoutParticipant)
+        .where(HangoutParticipant.hangout_id == hangout_id)
+        .options(joinedload(HangoutParticipant.user))
+    )).all()
 
     if not participants:
         return []
 
     participant_ids = [p.user_id for p in participants]
 
-    followed_ids = db.query(Follow.following_id) \
-        .filter(
-        Follow.follower_id == user["id"],
-        Follow.following_id.in_(participant_ids)
-    ) \
-        .all()
+    followed_ids = (await db.execute(
+        select(Follow.following_id)
+        .where(
+            Follow.follower_id == user["id"],
+            Follow.following_id.in_(participant_ids)
+        )
+    )).all()
     followed_id_set = {id_[0] for id_ in followed_ids}
+    await check_rendered_variants(*(p.user.pfp_url for p in participants))
 
     return [{
         "user_id": p.user.id,
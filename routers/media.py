@@ -0,0 +1,86 @@
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import FileResponse
+from starlette import status
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Optional
+from uploads import MEDIA_DIR, BLOB_DIR
+import anyio
+import os
+import re
+import stat
+
+router = APIRouter(
+    prefix = "/media",
+    tags = ["media"]
+)
+
+# stored names are random and never rewritten, so clients and CDNs may keep them forever
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# when nginx sits in front, e.g. MEDIA_ACCEL_PREFIX=/_protected_media/ mapped to MEDIA_DIR with `internal;`,
+# only headers are sent and nginx streams the file with sendfile (ranges included)
+MEDIA_ACCEL_PREFIX = os.getenv("MEDIA_ACCEL_PREFIX")
+BLOB_NAME = re.compile(r"(?P<digest>[0-9a-f]{64})(_\d+)?\.[a-z0-9]+")
+
+
+def is_not_modified(request: Request, etag: str, last_modified: str):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # the If-None-Match takes precedence over If-Modified-Since
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+async def serve_media_file(request: Request, path: Path, url_path: str, etag: Optional[str] = None):
+    try:
+        stat_result = await anyio.Path(path).stat()
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+
+    # FileResponse derives ETag/Last-Modified from the stat, answers Range/If-Range requests with 206 and uses
+    # the ASGI pathsend extension (zero copy) on servers that support it
+    response = FileResponse(path, stat_result=stat_result, headers={"Cache-Control": MEDIA_CACHE_CONTROL})
+    if etag:
+        response.headers["etag"] = etag
+    if is_not_modified(request, response.headers["etag"], response.headers["last-modified"]):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={key: response.headers[key] for key in ("etag", "last-modified", "cache-control")},
+        )
+    if MEDIA_ACCEL_PREFIX:
+        return Response(
+            media_type=response.media_type,
+            headers={
+                "X-Accel-Redirect": f"{MEDIA_ACCEL_PREFIX.rstrip('/')}/{url_path}",
+                **{key: response.headers[key] for key in ("etag", "last-modified", "cache-control")},
+            },
+        )
+    return response
+
+
+@router.api_route("/blobs/{shard}/{name}", methods=["GET", "HEAD"])
+async def get_media_blob(shard: str, name: str, request: Request):
+    match = BLOB_NAME.fullmatch(name)
+    if not match or match["digest"][:2] != shard:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    # an original's name is the sha256 of its bytes, which makes a better strong ETag than size and mtime
+    etag = f'"{match["digest"]}"' if match.group(2) is None else None
+    return await serve_media_file(request, BLOB_DIR / shard / name, f"blobs/{shard}/{name}", etag)
+
+
+@router.api_route("/{user_id}/{name}", methods=["GET", "HEAD"])
+async def get_media(user_id: int, name: str, request: Request):
+    # variants are rendered into dotfiles, older renders left <name>.tmp files, neither is a finished file.
+    # The name can't contain "/" as it's a single path segment
+    if name.startswith(".") or name.endswith(".tmp") or "\\" in name:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    return await serve_media_file(request, MEDIA_DIR / str(user_id) / name, f"{user_id}/{name}")
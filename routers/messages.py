@@ -0,0 +1,200 @@
+from fastapi import APIRouter, Depends, HTTPException, Response, WebSocket, WebSocketDisconnect
+from typing import Annotated, Optional
+from contextlib import suppress
+from database import db_dependency
+from starlette import status
+from sqlalchemy import select, exc, case, union_all
+from models import Conversation, Message, User
+from pagination import check_limit, paginate_by_created, set_next_cursor
+from routers.auth import get_current_user
+from messaging import MESSAGE_MAX_LENGTH, MESSAGE_IDLE_TIMEOUT, Connection, hub, message_writer, publish, serialize_message, get_or_create_conversation, mark_read, participant_side
+import asyncio
+import json
+
+router = APIRouter(
+    prefix = "/messages",
+    tags = ["messages"]
+)
+
+user_dependency = Annotated[dict, Depends(get_current_user)]
+
+
+def error_frame(detail: str, client_id=None):
+    # client_id echoes the send frame's, so the client can mark that optimistic copy as failed
+    frame = {"type": "error", "detail": detail}
+    if client_id is not None:
+        frame["client_id"] = client_id
+    return json.dumps(frame)
+
+
+async def handle_send(connection: Connection, user: dict, frame: dict):
+    recipient_id = frame.get("to")
+    content = frame.get("content")
+    if not isinstance(recipient_id, int) or recipient_id == user["id"]:
+        connection.push(error_frame("Invalid recipient", frame.get("client_id")))
+        return
+    if not isinstance(content, str) or not content.strip() or len(content) > MESSAGE_MAX_LENGTH:
+        connection.push(error_frame(f"Message must be 1 to {MESSAGE_MAX_LENGTH} characters", frame.get("client_id")))
+        return
+    try:
+        conversation_id = await get_or_create_conversation(user["id"], recipient_id)
+    except exc.IntegrityError:
+        connection.push(error_frame("Recipient not found", frame.get("client_id")))
+        return
+    message = await message_writer.write(conversation_id, user["id"], content)
+    # the sender's own sockets get it too, client_id lets the sending one match it to its optimistic copy
+    await publish({"type": "message", "message": serialize_message(message), "client_id": frame.get("client_id")}, user["id"], recipient_id)
+
+
+async def read_conversation(user: dict, conversation_id: int, message_id: Optional[int]):
+    result = await mark_read(user["id"], conversation_id, message_id)
+    if result is None:
+        return None
+    # read receipt for the other side, and the reader's other devices clear their badge
+    await publish({"type": "read", "conversation_id": conversation_id, "user_id": user["id"], "last_read_id": result[0]}, user["id"], result[2])
+    return result
+
+
+async def handle_read(connection: Connection, user: dict, frame: dict):
+    conversation_id = frame.get("conversation_id")
+    message_id = frame.get("message_id")
+    if not isinstance(conversation_id, int) or (message_id is not None and not isinstance(message_id, int)):
+        connection.push(error_frame("Invalid read frame"))
+        return
+    if await read_conversation(user, conversation_id, message_id) is None:
+        connection.push(error_frame("Conversation not found"))
+
+
+# frames are JSON: {"type": "send", "to": user_id, "content": str, "client_id": any},
+# {"type": "read", "conversation_id": int, "message_id": int (optional, default the last one)} and {"type": "ping"},
+# answered with {"type": "message", ...}, {"type": "read", ...}, {"type": "pong"} or
+# {"type": "error", "detail": str, "client_id": any (when the failed frame had one)}.
+# Browsers can't set headers on a WebSocket, so the JWT may also come as ?token=.
+@router.websocket("/ws")
+async def messages_socket(websocket: WebSocket, token: Optional[str] = None):
+    authorization = websocket.headers.get("authorization", "")
+    try:
+        user = await get_current_user(token or authorization.removeprefix("Bearer "))
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+
+    # no DB session is held while the socket sits idle, each message borrows one only for its write
+    connection = Connection(websocket, user["id"])
+    connection.writer = asyncio.create_task(connection.write_loop())
+    await hub.add(connection)
+    try:
+        # a socket closed for backpressure stops reading too
+        while connection.closing is None:
+            try:
+                raw = await asyncio.wait_for(websocket.receive_text(), MESSAGE_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                await websocket.close(code=status.WS_1001_GOING_AWAY)
+                break
+            try:
+                frame = json.loads(raw)
+            except ValueError:
+                connection.push(error_frame("Invalid JSON"))
+                continue
+            if not isinstance(frame, dict):
+                connection.push(error_frame("Invalid frame"))
+            elif frame.get("type") == "ping":
+                connection.push(json.dumps({"type": "pong"}))
+            elif frame.get("type") in ("send", "read"):
+                try:
+                    if frame["type"] == "send":
+                        await handle_send(connection, user, frame)
+                    else:
+                        await handle_read(connection, user, frame)
+                except Exception as e:
+                    # a failed write (pool timeout, lost connection, ...) fails that frame only, the socket stays open
+                    print(f"Error handling {frame['type']} frame: {e}")
+                    connection.push(error_frame("Could not process the frame, try again", frame.get("client_id")))
+            else:
+                connection.push(error_frame("Unknown frame type"))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await hub.remove(connection)
+        connection.writer.cancel()
+        # a send that failed because the client vanished ends the writer with an error, nothing to report
+        with suppress(asyncio.CancelledError, Exception):
+            await connection.writer
+
+
+@router.get("/conversations")
+async def get_inbox(db: db_dependency,
+                    user: user_dependency,
+                    response: Response,
+                    limit: int = 20,
+                    cursor: Optional[str] = None):
+    # conversations with their latest message first. Each side of the pair is a range of its
+    # (userN_id, last_message_at, id) index, the two top-`limit` ranges are merged in the same query.
+    check_limit(limit)
+    sides = [
+        paginate_by_created(
+            select(Conversation.id, Conversation.last_message_at)
+            .where(column == user["id"], Conversation.last_message_at.is_not(None)),
+            Conversation.last_message_at, Conversation.id, cursor, limit
+        )
+        for column in (Conversation.user1_id, Conversation.user2_id)
+    ]
+    page = union_all(*sides).subquery()
+    other_id = case((Conversation.user1_id == user["id"], Conversation.user2_id), else_=Conversation.user1_id)
+    rows = (await db.execute(
+        select(Conversation, Message, User)
+        .join(page, page.c.id == Conversation.id)
+        .join(Message, Message.id == Conversation.last_message_id)
+        .join(User, User.id == other_id)
+        .order_by(page.c.last_message_at.desc(), page.c.id.desc())
+        .limit(limit)
+    )).all()
+    if rows:
+        set_next_cursor(response, len(rows), limit, rows[-1][0].last_message_at, rows[-1][0].id)
+
+    inbox = []
+    for conversation, message, other in rows:
+        side = participant_side(conversation, user["id"])
+        inbox.append({
+            "id": conversation.id,
+            "user_id": other.id,
+            "username": other.username,
+            "pfp_url": other.pfp_url,
+            "last_message": serialize_message(message),
+            "last_read_id": getattr(conversation, f"{side}_last_read_id"),
+            "unread_count": getattr(conversation, f"{side}_unread_count"),
+        })
+    return inbox
+
+
+@router.post("/conversations/{conversation_id}/read")
+async def read_conversation_messages(conversation_id: int, user: user_dependency, message_id: Optional[int] = None):
+    result = await read_conversation(user, conversation_id, message_id)
+    if result is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+    return {"conversation_id": conversation_id, "last_read_id": result[0], "unread_count": result[1]}
+
+
+@router.get("/conversations/{conversation_id}")
+async def get_conversation_messages(conversation_id: int,
+                                    db: db_dependency,
+                                    user: user_dependency,
+                                    response: Response,
+                                    limit: int = 50,
+                                    cursor: Optional[str] = None):
+    check_limit(limit)
+    conversation = await db.scalar(select(Conversation).where(Conversation.id == conversation_id))
+    if not conversation or user["id"] not in (conversation.user1_id, conversation.user2_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+
+    # newest first, what a client needs after (re)connecting to the socket
+    messages = (await db.scalars(
+        paginate_by_created(
+            select(Message).where(Message.conversation_id == conversation_id),
+            Message.created_at, Message.id, cursor, limit
+        )
+    )).all()
+    if messages:
+        set_next_cursor(response, len(messages), limit, messages[-1].created_at, messages[-1].id)
+    return [serialize_message(message) for message in messages]
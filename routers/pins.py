@@ -1,19 +1,27 @@
-import uuid
-from pathlib import Path
+import math
 from dotenv import load_dotenv
-from fastapi import APIRouter, Depends, HTTPException, File, UploadFile
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Response, Query, Request, BackgroundTasks
 from typing import Annotated, Optional
 from fastapi.params import Form
-from sqlalchemy import select
-from database import SessionLocal
+from sqlalchemy import select, delete, func, cast, literal, literal_column, true, JSON, Text
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import db_dependency, get_db_with_timeout
 from starlette import status
-from sqlalchemy.orm import Session, joinedload
-from models import Pin, LocationRequest, PinCategory, RequestMedia, RequestCategory, Wishlist, Visit
-from schemas import PinRequest, PinResponse
+from sqlalchemy.orm import joinedload, selectinload
+from models import Pin, Category, User, Post, PinCluster, LocationRequest, PinCategory, RequestMedia, RequestCategory, Wishlist, Visit
+from schemas import PinRequest, PinResponse, NearbyPinResponse, TrendingPinResponse
 from routers.auth import get_current_user, get_optional_current_user
 from geoalchemy2.elements import WKTElement
 from geoalchemy2.shape import to_shape
 from shapely.geometry import mapping
+from pagination import NEXT_CURSOR_HEADER, encode_cursor, check_limit, check_offset, paginate_by_id, set_next_cursor
+from memberships import get_pin_memberships, remove_pin_membership
+from counters import record_counter_deltas, viewer_identity
+from trending import TRENDING_MAX_LIMIT, get_trending, parse_bbox, record_trending_view, remove_trending, move_trending_pin
+from uploads import MAX_IMAGE_SIZE, PIN_MEDIA_TYPES, save_upload, save_uploads, discard_uploads, media_path, check_rendered_variants
+from cache import cache_get, cache_bump, cache_version, cache_set_if_current, cached_json, invalidate
+from clusters import CLUSTER_MIN_ZOOM, CLUSTER_MAX_ZOOM, cell_for, add_pin_to_clusters, remove_pin_from_clusters, move_pin_in_clusters, rebuild_pin_clusters
 import os
 
 
@@ -22,138 +30,229 @@ router = APIRouter(
     tags = ["pins"]
 )
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
 load_dotenv()
-MEDIA_DIR = Path(os.getenv("MEDIA_DIR"))
+# map endpoints are hit on every pan/zoom, a stuck one should be cut off rather than pile up on the pool
+MAP_STATEMENT_TIMEOUT_MS = int(os.getenv("MAP_STATEMENT_TIMEOUT_MS", 5000))
+map_db_dependency = Annotated[AsyncSession, Depends(get_db_with_timeout(MAP_STATEMENT_TIMEOUT_MS))]
+TILE_MAX_ZOOM = 22
+TILE_CACHE_TTL = int(os.getenv("TILE_CACHE_TTL", 3600))
+MAX_MERCATOR_LAT = 85.0511287798
+NEARBY_MAX_LIMIT = 100
+# map clients load a whole viewport at once, so geojson pages go past PAGE_MAX_LIMIT
+GEOJSON_MAX_LIMIT = int(os.getenv("GEOJSON_MAX_LIMIT", 5000))
+PIN_DETAIL_CACHE_TTL = int(os.getenv("PIN_DETAIL_CACHE_TTL", 300))
+
+
+async def load_pin(db: AsyncSession, pin_id: int):
+    return await db.scalar(
+        select(Pin)
+        .where(Pin.id == pin_id)
+        .options(selectinload(Pin.categories).selectinload(PinCategory.category))
+        .execution_options(populate_existing=True)
+    )
+
+
+def geojson_collection_query(user_id: Optional[int], envelope, limit: int, offset: int, cursor: Optional[str]):
+    if user_id is not None:
+        wishlisted = (
+            select(literal(True).label("flag"))
+            .where(Wishlist.pin_id == Pin.id, Wishlist.user_id == user_id)
+            .lateral("wishlisted")
+        )
+        visited = (
+            select(literal(True).label("flag"))
+            .where(Visit.pin_id == Pin.id, Visit.user_id == user_id)
+            .lateral("visited")
+        )
+        is_wishlisted = wishlisted.c.flag.isnot(None)
+        is_visited = visited.c.flag.isnot(None)
+    else:
+        is_wishlisted = is_visited = literal(False)
+
+    feature = func.json_build_object(
+        "type", "Feature",
+        "geometry", cast(func.ST_AsGeoJSON(Pin.coordinates), JSON),
+        "properties", func.json_build_object(
+            "id", Pin.id,
+            "slug", Pin.slug,
+            "title", Pin.title,
+            "title_image_url", Pin.title_image_url,
+            "cost", Pin.cost,
+            "post_count", Pin.posts_count,
+            "is_wishlisted", is_wishlisted,
+            "is_visited", is_visited,
+        )
+    )
+    features = select(Pin.id.label("id"), feature.label("feature")).select_from(Pin)
+    if user_id is not None:
+        features = features.outerjoin(wishlisted, true()).outerjoin(visited, true())
+    if envelope is not None:
+        features = features.where(func.ST_Intersects(Pin.coordinates, envelope))
+    features = paginate_by_id(features, Pin.id, cursor, limit).offset(offset).subquery("features")
+
+    # page size and last id come back alongside the document so the next cursor needs no second query
+    return select(
+        cast(
+            func.json_build_object(
+                "type", "FeatureCollection",
+                "features", func.coalesce(
+                    func.json_agg(aggregate_order_by(features.c.feature, features.c.id)),
+                    literal_column("'[]'::json")
+                )
+            ),
+            Text
+        ).label("collection"),
+        func.count().label("page_size"),
+        func.max(features.c.id).label("last_id"),
+    )
+
+
+async def get_user_pin_flags(db: AsyncSession, user: Optional[dict], pin_ids: list[int]):
+    # (wishlisted ids, visited ids) among pin_ids for the current user, empty sets for anonymous callers
+    if not user or not pin_ids:
+        return set(), set()
+    memberships = await get_pin_memberships(db, user["id"], pin_ids)
+    return memberships["wishlist"], memberships["visited"]
+
+
+def serialize_pin_item(pin: Pin, wishlisted_pins: set, visited_pins: set):
+    return {
+        "id": pin.id,
+        "slug": pin.slug,
+        "title": pin.title,
+        "title_image_url": pin.title_image_url,
+        "description": pin.description,
+        "coordinates": mapping(to_shape(pin.coordinates)),
+        "categories": [cat.category.name for cat in pin.categories],
+        "cost": pin.cost,
+        "is_wishlisted": pin.id in wishlisted_pins,
+        "is_visited": pin.id in visited_pins,
+        "post_count": pin.posts_count,
+        "created_at": pin.created_at,
+        "updated_at": pin.updated_at,
+    }
+
+
+def pin_detail_cache_key(pin_id_or_slug):
+    # anything int() accepts is looked up as that id ("05", "+5"), so it shares the id's key
+    try:
+        pin_id_or_slug = int(pin_id_or_slug)
+    except ValueError:
+        pass
+    return f"pins:detail:{pin_id_or_slug}"
+
+
+async def invalidate_pin_detail(pin_id: int, *slugs: Optional[str]):
+    # detail is cached under whichever identifier the client asked for, so drop the id and every known slug
+    await invalidate(pin_detail_cache_key(pin_id), *(pin_detail_cache_key(slug) for slug in slugs if slug))
+
+
+def tile_cache_key(z: int, x: int, y: int):
+    return f"tiles:pins:{z}/{x}/{y}"
+
+
+def tile_for_point(lon: float, lat: float, z: int):
+    n = 2 ** z
+    lat = max(min(lat, MAX_MERCATOR_LAT), -MAX_MERCATOR_LAT)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+async def invalidate_pin_tiles(*points):
+    # a pin lives in exactly one tile per zoom level, so a change only touches TILE_MAX_ZOOM + 1 keys per point
+    keys = set()
+    for lon, lat in points:
+        for z in range(TILE_MAX_ZOOM + 1):
+            keys.add(tile_cache_key(z, *tile_for_point(lon, lat, z)))
+    await cache_bump(*keys)
 
 
 @router.get("/", response_model=list[PinResponse])
 async def get_all_pins(
         db: db_dependency,
+        response: Response,
         user: Optional[dict] = Depends(get_optional_current_user),
         limit: int = 100,
-        offset: int = 0
+        offset: int = 0,
+        cursor: Optional[str] = None
 ):
-    pins_query = db.query(Pin).options(
-        joinedload(Pin.categories).joinedload(PinCategory.category)
-    ).limit(limit).offset(offset)
+    # keyset on id, deep pages seek straight into the primary key instead of scanning past `offset` rows
+    check_limit(limit)
+    check_offset(offset, cursor)
+    pins_query = paginate_by_id(
+        select(Pin).options(joinedload(Pin.categories).joinedload(PinCategory.category)),
+        Pin.id, cursor, limit
+    ).offset(offset)
 
-    pins = pins_query.all()
+    pins = (await db.scalars(pins_query)).unique().all()
 
     if not pins:
+        # following the cursor of an exactly full last page lands here
+        if cursor:
+            return []
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No pins found")
+    set_next_cursor(response, len(pins), limit, pins[-1].id)
 
-    pin_ids = [pin.id for pin in pins]
-    wishlisted_pins = set()
-    visited_pins = set()
-
-    if user:
-        wishlisted_pins = set(
-            db.execute(
-                select(Wishlist.pin_id)
-                .where(
-                    Wishlist.pin_id.in_(pin_ids),
-                    Wishlist.user_id == user["id"]
-                )
-            ).scalars().all()
-        )
-        visited_pins = set(
-            db.execute(
-                select(Visit.pin_id)
-                .where(
-                    Visit.pin_id.in_(pin_ids),
-                    Visit.user_id == user["id"]
-                )
-            ).scalars().all()
-        )
-
-    return [
-        {
-            "id": pin.id,
-            "slug": pin.slug,
-            "title": pin.title,
-            "title_image_url": pin.title_image_url,
-            "description": pin.description,
-            "coordinates": mapping(to_shape(pin.coordinates)),
-            "categories": [cat.category.name for cat in pin.categories],
-            "cost": pin.cost,
-            "is_wishlisted": pin.id in wishlisted_pins,
-            "is_visited": pin.id in visited_pins,
-            "post_count": pin.posts_count,
-            "created_at": pin.created_at,
-            "updated_at": pin.updated_at,
-        }
-        for pin in pins
-    ]
+    wishlisted_pins, visited_pins = await get_user_pin_flags(db, user, [pin.id for pin in pins])
+    await check_rendered_variants(*(pin.title_image_url for pin in pins))
+    return [serialize_pin_item(pin, wishlisted_pins, visited_pins) for pin in pins]
 
 
 @router.get("/geojson")
 async def get_pins_geojson(
-        db: db_dependency,
+        db: map_db_dependency,
+        response: Response,
         user: Optional[dict] = Depends(get_optional_current_user),
         limit: int = 1000,
         offset: int = 0,
-        bbox: Optional[str] = None
+        cursor: Optional[str] = None,
+        bbox: Optional[str] = None,
+        raw: bool = False
 ):
     from sqlalchemy import func, and_
 
-    query = db.query(
-        Pin.id,
-        Pin.slug,
-        Pin.title,
-        Pin.title_image_url,
-        func.ST_AsGeoJSON(Pin.coordinates).label('geojson'),
-        Pin.cost,
-        Pin.posts_count
-    )
-
+    check_limit(limit, GEOJSON_MAX_LIMIT)
+    check_offset(offset, cursor)
+    envelope = None
     if bbox:
         try:
             min_lon, min_lat, max_lon, max_lat = map(float, bbox.split(','))
-            query = query.filter(
-                func.ST_Intersects(
-                    Pin.coordinates,
-                    func.ST_MakeEnvelope(min_lon, min_lat, max_lon, max_lat, 4326)
-                )
-            )
+            envelope = func.ST_MakeEnvelope(min_lon, min_lat, max_lon, max_lat, 4326)
         except (ValueError, AttributeError):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid bbox format. Use: min_lon,min_lat,max_lon,max_lat"
             )
 
-    query = query.limit(limit).offset(offset)
-    results = query.all()
+    if raw:
+        # PostgreSQL renders the whole FeatureCollection, the text goes out as-is without json.loads/re-encoding
+        page = (await db.execute(
+            geojson_collection_query(user["id"] if user else None, envelope, limit, offset, cursor)
+        )).one()
+        headers = {NEXT_CURSOR_HEADER: encode_cursor(page.last_id)} if page.page_size == limit else None
+        return Response(content=page.collection.encode(), media_type="application/json", headers=headers)
+
+    query = select(
+        Pin.id,
+        Pin.slug,
+        Pin.title,
+        Pin.title_image_url,
+        func.ST_AsGeoJSON(Pin.coordinates).label('geojson'),
+        Pin.cost,
+        Pin.posts_count
+    )
+
+    if envelope is not None:
+        query = query.where(func.ST_Intersects(Pin.coordinates, envelope))
 
-    pin_ids = [r.id for r in results]
-    wishlisted_pins = set()
-    visited_pins = set()
+    query = paginate_by_id(query, Pin.id, cursor, limit).offset(offset)
+    results = (await db.execute(query)).all()
+    if results:
+        set_next_cursor(response, len(results), limit, results[-1].id)
 
-    if user and pin_ids:
-        wishlisted_pins = set(
-            db.execute(
-                select(Wishlist.pin_id).where(
-                    Wishlist.pin_id.in_(pin_ids),
-                    Wishlist.user_id == user["id"]
-                )
-            ).scalars().all()
-        )
-        visited_pins = set(
-            db.execute(
-                select(Visit.pin_id).where(
-                    Visit.pin_id.in_(pin_ids),
-                    Visit.user_id == user["id"]
-                )
-            ).scalars().all()
-        )
+    wishlisted_pins, visited_pins = await get_user_pin_flags(db, user, [r.id for r in results])
 
     features = []
     for r in results:
@@ -183,38 +282,58 @@ async def get_pins_geojson(
 
 @router.get("/clustered")
 async def get_pins_clustered(
-        db: db_dependency,
+        db: map_db_dependency,
         zoom: int = 10,
         bbox: Optional[str] = None
 ):
     from sqlalchemy import func
 
-    grid_size = 180 / (2 ** zoom)
-
-    query = db.query(
-        func.floor(func.ST_X(Pin.coordinates) / grid_size).label('grid_x'),
-        func.floor(func.ST_Y(Pin.coordinates) / grid_size).label('grid_y'),
-        func.count(Pin.id).label('count'),
-        func.avg(func.ST_X(Pin.coordinates)).label('center_lon'),
-        func.avg(func.ST_Y(Pin.coordinates)).label('center_lat')
-    )
-
     if bbox:
         try:
             min_lon, min_lat, max_lon, max_lat = map(float, bbox.split(','))
-            query = query.filter(
-                func.ST_Intersects(
-                    Pin.coordinates,
-                    func.ST_MakeEnvelope(min_lon, min_lat, max_lon, max_lat, 4326)
-                )
-            )
         except (ValueError, AttributeError):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid bbox format"
             )
 
-    clusters = query.group_by('grid_x', 'grid_y').all()
+    if CLUSTER_MIN_ZOOM <= zoom <= CLUSTER_MAX_ZOOM:
+        # precomputed pyramid, a primary key range scan instead of grouping the whole pins table
+        query = select(
+            PinCluster.count,
+            (PinCluster.sum_lon / PinCluster.count).label('center_lon'),
+            (PinCluster.sum_lat / PinCluster.count).label('center_lat')
+        ).where(PinCluster.zoom == zoom)
+
+        if bbox:
+            min_x, min_y = cell_for(min_lon, min_lat, zoom)
+            max_x, max_y = cell_for(max_lon, max_lat, zoom)
+            query = query.where(
+                PinCluster.grid_x.between(min_x, max_x),
+                PinCluster.grid_y.between(min_y, max_y)
+            )
+
+        clusters = (await db.execute(query)).all()
+    else:
+        grid_size = 180 / (2 ** zoom)
+
+        query = select(
+            func.floor(func.ST_X(Pin.coordinates) / grid_size).label('grid_x'),
+            func.floor(func.ST_Y(Pin.coordinates) / grid_size).label('grid_y'),
+            func.count(Pin.id).label('count'),
+            func.avg(func.ST_X(Pin.coordinates)).label('center_lon'),
+            func.avg(func.ST_Y(Pin.coordinates)).label('center_lat')
+        )
+
+        if bbox:
+            query = query.where(
+                func.ST_Intersects(
+                    Pin.coordinates,
+                    func.ST_MakeEnvelope(min_lon, min_lat, max_lon, max_lat, 4326)
+                )
+            )
+
+        clusters = (await db.execute(query.group_by('grid_x', 'grid_y'))).all()
 
     return {
         "type": "FeatureCollection",
@@ -235,6 +354,115 @@ async def get_pins_clustered(
     }
 
 
+@router.post("/clustered/rebuild", status_code=status.HTTP_202_ACCEPTED)
+async def rebuild_clusters(db: db_dependency, user: user_dependency):
+    if not user["is_admin"]:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    await rebuild_pin_clusters(db)
+    return {"detail": "Pin clusters rebuilt"}
+
+
+@router.get("/tiles/{z}/{x}/{y}.mvt")
+async def get_pins_tile(db: map_db_dependency, z: int, x: int, y: int):
+    if z < 0 or z > TILE_MAX_ZOOM or not (0 <= x < 2 ** z) or not (0 <= y < 2 ** z):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid tile coordinates")
+
+    headers = {"Cache-Control": "public, max-age=60"}
+    key = tile_cache_key(z, x, y)
+    tile = await cache_get(key)
+    if tile is not None:
+        return Response(content=tile, media_type="application/vnd.mapbox-vector-tile", headers=headers)
+
+    # a pin change landing while the query runs bumps the version, the outdated tile is then served but not cached
+    version = await cache_version(key)
+    envelope = func.ST_TileEnvelope(z, x, y)
+    features = (
+        select(
+            func.ST_AsMVTGeom(func.ST_Transform(Pin.coordinates, 3857), envelope).label("geom"),
+            Pin.id,
+            Pin.slug,
+            Pin.title,
+            Pin.cost,
+            Pin.posts_count.label("post_count"),
+        )
+        .where(Pin.coordinates.intersects(func.ST_Transform(envelope, 4326)))
+        .subquery("mvt_pins")
+    )
+    tile = await db.scalar(select(func.ST_AsMVT(features.table_valued(), "pins", 4096, "geom")))
+    tile = bytes(tile or b"")
+
+    await cache_set_if_current(key, tile, TILE_CACHE_TTL, version)
+    return Response(content=tile, media_type="application/vnd.mapbox-vector-tile", headers=headers)
+
+
+@router.get("/nearby", response_model=list[NearbyPinResponse])
+async def get_nearby_pins(
+        db: map_db_dependency,
+        lat: float,
+        lon: float,
+        user: Optional[dict] = Depends(get_optional_current_user),
+        limit: int = 20,
+        radius: Optional[float] = None,
+        category_ids: Annotated[Optional[list[int]], Query()] = None
+):
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid coordinates")
+    if not 0 < limit <= NEARBY_MAX_LIMIT:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"limit must be between 1 and {NEARBY_MAX_LIMIT}")
+    if radius is not None and radius <= 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="radius must be positive (meters)")
+
+    # both sides go through geography() so `<->` and ST_DWithin run on ix_pins_coordinates_geography
+    # and distances come back in meters on the spheroid rather than in degrees
+    origin = func.geography(func.ST_SetSRID(func.ST_MakePoint(lon, lat), 4326))
+    pin_geography = func.geography(Pin.coordinates)
+    query = (
+        select(Pin, func.ST_Distance(pin_geography, origin).label("distance_m"))
+        .options(selectinload(Pin.categories).selectinload(PinCategory.category))
+        .order_by(pin_geography.op("<->")(origin))
+        .limit(limit)
+    )
+    if radius is not None:
+        query = query.where(func.ST_DWithin(pin_geography, origin, radius))
+    if category_ids:
+        query = query.where(Pin.categories.any(PinCategory.category_id.in_(category_ids)))
+
+    rows = (await db.execute(query)).all()
+    wishlisted_pins, visited_pins = await get_user_pin_flags(db, user, [pin.id for pin, _ in rows])
+    await check_rendered_variants(*(pin.title_image_url for pin, _ in rows))
+    return [
+        {**serialize_pin_item(pin, wishlisted_pins, visited_pins), "distance_m": distance_m}
+        for pin, distance_m in rows
+    ]
+
+
+@router.get("/trending", response_model=list[TrendingPinResponse])
+async def get_trending_pins(
+        db: db_dependency,
+        user: Optional[dict] = Depends(get_optional_current_user),
+        limit: int = 20,
+        bbox: Optional[str] = None
+):
+    if not 0 < limit <= TRENDING_MAX_LIMIT:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"limit must be between 1 and {TRENDING_MAX_LIMIT}")
+    envelope = parse_bbox(bbox) if bbox else None
+    scores = dict(await get_trending("pins", limit, envelope))
+    if not scores:
+        return []
+
+    # ranking comes from Redis, the DB only loads the winners by primary key (and cuts cells down to the bbox)
+    query = select(Pin).options(selectinload(Pin.categories).selectinload(PinCategory.category)).where(Pin.id.in_(scores))
+    if envelope:
+        query = query.where(func.ST_Intersects(Pin.coordinates, func.ST_MakeEnvelope(*envelope, 4326)))
+    pins = sorted((await db.scalars(query)).all(), key=lambda pin: scores[pin.id], reverse=True)[:limit]
+    wishlisted_pins, visited_pins = await get_user_pin_flags(db, user, [pin.id for pin in pins])
+    await check_rendered_variants(*(pin.title_image_url for pin in pins))
+    return [
+        {**serialize_pin_item(pin, wishlisted_pins, visited_pins), "trending_score": scores[pin.id]}
+        for pin in pins
+    ]
+
+
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=PinResponse)
 async def create_pin(db: db_dependency, user: user_dependency,
                      title: str = Form(...),
@@ -252,49 +480,11 @@ async def create_pin(db: db_dependency, user: user_dependency,
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Title, longitude, and latitude are required")
     if lon < -180 or lon > 180 or lat < -90 or lat > 90:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid coordinates")
-    if db.query(Pin).filter(Pin.coordinates.like(WKTElement(f"POINT({lon} {lat})", srid=4326))).first():
+    if await db.scalar(select(Pin).where(Pin.coordinates.like(WKTElement(f"POINT({lon} {lat})", srid=4326)))):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Pin with these coordinates already exists")
 
-    if media.content_type not in ["image/jpeg", "image/png", "image/gif", "video/mp4"]:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid file type. Allowed types: JPEG, PNG, GIF, MP4"
-        )
-
-    MEDIA_DIR.mkdir(parents=True, exist_ok=True)
-
-    user_dir = MEDIA_DIR / str(user["id"])
-    user_dir.mkdir(parents=True, exist_ok=True)
-
-    ext = os.path.splitext(media.filename)[1]
-    unique_name = f"{uuid.uuid4().hex}{ext}"
-    file_path = user_dir / unique_name
-    file_size = 0
-    max_size = 20 * 1024 * 1024
-
-    try:
-        with open(file_path, "wb") as f:
-            while chunk := await media.read(1024 * 1024):
-                file_size += len(chunk)
-                if file_size > max_size:
-                    f.close()
-                    file_path.unlink(missing_ok=True)
-                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail=f"File too large. Max size: {max_size / (1024 * 1024):.0f}MB"
-                    )
-                f.write(chunk)
-    except HTTPException:
-        raise
-    except Exception as e:
-        if file_path.exists():
-            file_path.unlink(missing_ok=True)
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to save file: {str(e)}"
-        )
-
-    media_url = f"/media/{user['id']}/{unique_name}"
+    saved = await save_upload(media, user["id"], PIN_MEDIA_TYPES, max_size=MAX_IMAGE_SIZE)
+    media_url = saved.url
     created_pin = Pin(
         slug=title.lower().replace(" ", "-"),
         title=title,
@@ -303,9 +493,16 @@ async def create_pin(db: db_dependency, user: user_dependency,
         cost=cost or None,
         title_image_url=media_url,
     )
-    db.add(created_pin)
-    db.commit()
-    db.refresh(created_pin)
+    try:
+        db.add(created_pin)
+        await add_pin_to_clusters(db, lon, lat)
+        await db.commit()
+    except Exception:
+        # the pin never existed, so nothing else holds the upload (or its blob reference)
+        await db.rollback()
+        await discard_uploads(saved.path)
+        raise
+    await db.refresh(created_pin)
 
     parsed_categories = []
     if category_ids:
@@ -330,10 +527,12 @@ async def create_pin(db: db_dependency, user: user_dependency,
                 category_id=category
             )
             db.add(pin_category)
-        db.commit()
-        db.refresh(created_pin)
+        await db.commit()
+        await record_counter_deltas(*((Category.location_count, category, 1) for category in parsed_categories))
 
-    pin = created_pin
+    pin = await load_pin(db, created_pin.id)
+    await invalidate_pin_tiles((lon, lat))
+    await check_rendered_variants(pin.title_image_url)
     return {
         "id": pin.id,
         "slug": pin.slug,
@@ -349,12 +548,20 @@ async def create_pin(db: db_dependency, user: user_dependency,
     }
 
 @router.get("/requests")
-async def get_location_requests(db: db_dependency, user: user_dependency):
+async def get_location_requests(db: db_dependency,
+                                user: user_dependency,
+                                response: Response,
+                                limit: int = 50,
+                                cursor: Optional[str] = None):
     if not user["is_admin"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only admins can access location requests")
-    requests = db.query(LocationRequest).all()
+    check_limit(limit)
+    requests = (await db.scalars(paginate_by_id(select(LocationRequest), LocationRequest.id, cursor, limit))).all()
     if not requests:
+        if cursor:
+            return []
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No location requests found")
+    set_next_cursor(response, len(requests), limit, requests[-1].id)
     return [
         {
             "id": req.id,
@@ -383,44 +590,33 @@ async def create_location_request(db: db_dependency,
     if lon < -180 or lon > 180 or lat < -90 or lat > 90:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid coordinates")
 
+    # files go to disk first (in parallel), so a rejected file never leaves a half-created request behind
+    saved_media = await save_uploads(media, user["id"], PIN_MEDIA_TYPES) if media else []
+
     new_request = LocationRequest(
         user_id=user["id"],
         location=WKTElement(f"POINT({lon} {lat})", srid=4326),
         title=title,
         description=description or None,
         cost=cost or None,
-        has_media= bool(media),
+        has_media= bool(saved_media),
     )
 
-    db.add(new_request)
-    db.commit()
-    db.refresh(new_request)
-
-    media_urls = []
-    if media:
-        for med in media:
-            if med.content_type not in ["image/jpeg", "image/png", "image/gif", "video/mp4"]:
-                continue
-
-            MEDIA_DIR.mkdir(parents=True, exist_ok=True)
-            user_dir = MEDIA_DIR / str(user["id"])
-            user_dir.mkdir(parents=True, exist_ok=True)
-            ext = os.path.splitext(med.filename)[1]
-            unique_name = f"{uuid.uuid4().hex}{ext}"
-            file_path = user_dir / unique_name
-            with open(file_path, "wb") as f:
-                f.write(await med.read())
-            media_url = f"/media/{user['id']}/{unique_name}"
-            media_urls.append(media_url)
-
-            new_media = RequestMedia(
-                request_id=new_request.id,
-                media_url=media_url,
-                media_type=med.content_type
-            )
-            db.add(new_media)
-            db.commit()
-            db.refresh(new_media)
+    try:
+        db.add(new_request)
+        await db.flush()
+        db.add_all([
+            RequestMedia(request_id=new_request.id, media_url=saved.url, media_type=saved.media_type)
+            for saved in saved_media
+        ])
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        await discard_uploads(*(saved.path for saved in saved_media))
+        raise
+    await db.refresh(new_request)
+
+    media_urls = [saved.url for saved in saved_media]
 
     parsed_categories = []
     if category_ids:
@@ -446,8 +642,11 @@ async def create_location_request(db: db_dependency,
                 category_id=category
             )
             db.add(request_category)
-            db.commit()
-            db.refresh(request_category)
+            await db.commit()
+            await db.refresh(request_category)
+
+    if category_ids:
+        await db.refresh(new_request, ["categories"])
 
     point = to_shape(new_request.location)
     return {
@@ -466,7 +665,7 @@ async def create_location_request(db: db_dependency,
 async def get_location_request(request_id: int, db: db_dependency, user: user_dependency):
     if not user["is_admin"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only admins can access location requests")
-    request = db.query(LocationRequest).filter(LocationRequest.id == request_id).options(joinedload(LocationRequest.categories), joinedload(LocationRequest.media)).first()
+    request = await db.scalar(select(LocationRequest).where(LocationRequest.id == request_id).options(selectinload(LocationRequest.categories), selectinload(LocationRequest.media)))
     if not request:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Location request not found")
     point = to_shape(request.location)
@@ -487,47 +686,49 @@ async def get_location_request(request_id: int, db: db_dependency, user: user_de
 async def delete_location_request(request_id: int, db: db_dependency, user: user_dependency):
     if not user["is_admin"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only admins can delete location requests")
-    request = db.query(LocationRequest).filter(LocationRequest.id == request_id).first()
+    request = await db.scalar(select(LocationRequest).where(LocationRequest.id == request_id))
     if not request:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Location request not found")
-    db.delete(request)
 
-    media = db.query(RequestMedia).filter(RequestMedia.request_id == request_id).all()
+    # children first: deleting the request would otherwise autoflush their request_id to NULL before they are found
+    media = (await db.scalars(select(RequestMedia).where(RequestMedia.request_id == request_id))).all()
     for m in media:
-        media_path = MEDIA_DIR / str(m.media_url).lstrip('/')
-        if media_path.exists():
-            media_path.unlink()
-        db.delete(m)
+        await db.delete(m)
 
-    categories = db.query(RequestCategory).filter(RequestCategory.request_id == request_id).all()
+    categories = (await db.scalars(select(RequestCategory).where(RequestCategory.request_id == request_id))).all()
     for cat in categories:
-        db.delete(cat)
+        await db.delete(cat)
 
-    db.delete(categories)
-    db.commit()
+    await db.delete(request)
+    await db.commit()
+    # only once the rows are gone, a failed delete must not leave them pointing at released files
+    await discard_uploads(*(media_path(str(m.media_url)) for m in media))
     return {"detail": "Location request deleted successfully"}
 
 @router.post("/requests/{request_id}/approve", status_code=status.HTTP_202_ACCEPTED, response_model=PinResponse)
 async def approve_location_request(request_id: int,
                                    db: db_dependency,
                                    user: user_dependency):
-    if not user["id_admin"]:
+    if not user["is_admin"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
-    request = db.query(LocationRequest).filter(LocationRequest.id == request_id).first()
+    request = await db.scalar(select(LocationRequest).where(LocationRequest.id == request_id))
     if not request:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Location request not found")
-    request_media = db.query(RequestMedia).filter(RequestMedia.request_id == request_id).all()
-    request_categories = db.query(RequestCategory).filter(RequestCategory.request_id == request_id).all()
+    request_media = (await db.scalars(select(RequestMedia).where(RequestMedia.request_id == request_id))).all()
+    request_categories = (await db.scalars(select(RequestCategory).where(RequestCategory.request_id == request_id))).all()
 
     new_pin = Pin(
         title=request.title,
+        slug=request.title.lower().replace(" ", "-"),
         description=request.description,
         coordinates=request.location,
         cost=request.cost,
     )
     db.add(new_pin)
-    db.commit()
-    db.refresh(new_pin)
+    request_point = to_shape(request.location)
+    await add_pin_to_clusters(db, request_point.x, request_point.y)
+    await db.commit()
+    await db.refresh(new_pin)
 
     categories = []
     for category in request_categories:
@@ -536,16 +737,20 @@ async def approve_location_request(request_id: int,
             category_id=category.category_id
         )
         db.add(pin_category)
-        db.commit()
-        db.refresh(pin_category)
+        await db.commit()
+        await db.refresh(pin_category)
         categories.append(pin_category)
+    await record_counter_deltas(*((Category.location_count, c.category_id, 1) for c in categories))
 
-
-    pin = new_pin
+    pin = await load_pin(db, new_pin.id)
+    await invalidate_pin_tiles((request_point.x, request_point.y))
+    await invalidate_pin_detail(pin.id, pin.slug)
+    await check_rendered_variants(pin.title_image_url)
     return {
         "id": pin.id,
-        "slug": pin.title.lower().replace(" ", "-"),
+        "slug": pin.slug,
             "title": pin.title,
+            "title_image_url": pin.title_image_url,
             "description": pin.description,
             "coordinates": mapping(to_shape(pin.coordinates)),
             "categories": [cat.category.name for cat in pin.categories],
@@ -557,44 +762,45 @@ async def approve_location_request(request_id: int,
 
 
 @router.get("/{pin_id_or_slug}", response_model=PinResponse)
-async def get_pin_by_id(db: db_dependency, pin_id_or_slug: str, user: Optional[dict] = Depends(get_current_user)):
-    pin = None
-
-    try:
-        pin_id = int(pin_id_or_slug)
-        pin = db.query(Pin).filter(Pin.id == pin_id).first()
-    except ValueError:
-        pin = db.query(Pin).filter(Pin.slug == pin_id_or_slug).first()
+async def get_pin_by_id(db: db_dependency,
+                        pin_id_or_slug: str,
+                        request: Request,
+                        background_tasks: BackgroundTasks,
+                        user: Optional[dict] = Depends(get_current_user)):
+    async def load_pin_detail():
+        pin_query = select(Pin).options(selectinload(Pin.categories).selectinload(PinCategory.category))
+        try:
+            pin_id = int(pin_id_or_slug)
+            pin = await db.scalar(pin_query.where(Pin.id == pin_id))
+        except ValueError:
+            pin = await db.scalar(pin_query.where(Pin.slug == pin_id_or_slug))
+
+        if not pin:
+            return None
+        return {
+            "id": pin.id,
+            "slug": pin.slug,
+            "title": pin.title,
+            "title_image_url": pin.title_image_url,
+            "description": pin.description,
+            "coordinates": mapping(to_shape(pin.coordinates)),
+            "categories": [cat.category.name for cat in pin.categories],
+            "cost": pin.cost,
+            "post_count": pin.posts_count,
+            "created_at": pin.created_at,
+            "updated_at": pin.updated_at,
+        }
 
+    # the shared payload is user-independent, the wishlist flag is looked up per request on top of it
+    pin = await cached_json(pin_detail_cache_key(pin_id_or_slug), PIN_DETAIL_CACHE_TTL, load_pin_detail)
     if not pin:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Pin not found")
 
-    in_wishlist = False
-    if user:
-        item = db.execute(
-            select(Wishlist.pin_id)
-            .where(
-                Wishlist.pin_id == pin.id,
-                Wishlist.user_id == user["id"]
-            )
-        ).scalars().all()
-        if item:
-            in_wishlist = True
-
-    return {
-        "id": pin.id,
-        "slug": pin.slug,
-        "title": pin.title,
-        "title_image_url": pin.title_image_url,
-        "description": pin.description,
-        "coordinates": mapping(to_shape(pin.coordinates)),
-        "categories": [cat.category.name for cat in pin.categories],
-        "cost": pin.cost,
-        "is_wishlisted": in_wishlist,
-        "post_count": pin.posts_count,
-        "created_at": pin.created_at,
-        "updated_at": pin.updated_at,
-    }
+    wishlisted_pins, _ = await get_user_pin_flags(db, user, [pin["id"]])
+    await check_rendered_variants(pin["title_image_url"])
+    # counted after the response is sent, the read itself never writes
+    background_tasks.add_task(record_trending_view, Pin.view_count, pin["id"], viewer_identity(user, request.client.host if request.client else None), pin["id"])
+    return {**pin, "is_wishlisted": pin["id"] in wishlisted_pins}
 
 
 @router.put("/{pin_id_or_slug}", response_model=PinResponse)
@@ -605,13 +811,15 @@ async def update_pin(pin_id_or_slug: str, db: db_dependency, pin_req: PinRequest
     pin = None
     try:
         pin_id = int(pin_id_or_slug)
-        pin = db.query(Pin).filter(Pin.id == pin_id).first()
+        pin = await db.scalar(select(Pin).where(Pin.id == pin_id))
     except ValueError:
-        pin = db.query(Pin).filter(Pin.slug == pin_id_or_slug).first()
+        pin = await db.scalar(select(Pin).where(Pin.slug == pin_id_or_slug))
 
     if not pin:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Pin not found")
 
+    old_point = to_shape(pin.coordinates)
+    old_slug = pin.slug
     pin.title = pin_req.title
     pin.slug = pin_req.title.lower().replace(" ", "-")  # Auto-update slug based on new title
     pin.description = pin_req.description
@@ -621,40 +829,39 @@ async def update_pin(pin_id_or_slug: str, db: db_dependency, pin_req: PinRequest
         if pin_req.lon < -180 or pin_req.lon > 180 or pin_req.lat < -90 or pin_req.lat > 90:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid coordinates")
         pin.coordinates = WKTElement(f"POINT({pin_req.lon} {pin_req.lat})", srid=4326)
+        await move_pin_in_clusters(db, (old_point.x, old_point.y), (pin_req.lon, pin_req.lat))
 
+    old_category_ids = []
+    post_count = 0
     if pin_req.category_ids is not None:
-        db.query(PinCategory).filter(PinCategory.pin_id == pin.id).delete()
+        old_category_ids = (await db.scalars(select(PinCategory.category_id).where(PinCategory.pin_id == pin.id))).all()
+        # the pin's posts move to the new categories along with it
+        post_count = await db.scalar(select(func.count()).select_from(Post).where(Post.pin_id == pin.id))
+        await db.execute(delete(PinCategory).where(PinCategory.pin_id == pin.id))
 
         for category_id in pin_req.category_ids:
             new_cat = PinCategory(pin_id=pin.id, category_id=category_id)
             db.add(new_cat)
 
-    db.commit()
-    db.refresh(pin)
-
-    in_wishlist = False
-    is_visited = False
-
-    if db.query(Wishlist).filter(Wishlist.pin_id == pin.id, Wishlist.user_id == user["id"]).first():
-        in_wishlist = True
-    if db.query(Visit).filter(Visit.pin_id == pin.id, Visit.user_id == user["id"]).first():
-        is_visited = True
+    await db.commit()
+    pin = await load_pin(db, pin.id)
+    new_point = to_shape(pin.coordinates)
+    await invalidate_pin_tiles((old_point.x, old_point.y), (new_point.x, new_point.y))
+    if (old_point.x, old_point.y) != (new_point.x, new_point.y):
+        post_ids = (await db.scalars(select(Post.id).where(Post.pin_id == pin.id))).all()
+        await move_trending_pin(pin.id, post_ids, (old_point.x, old_point.y), (new_point.x, new_point.y))
+    await invalidate_pin_detail(pin.id, old_slug, pin.slug)
+    if pin_req.category_ids is not None:
+        await record_counter_deltas(
+            *((Category.location_count, category_id, -1) for category_id in old_category_ids),
+            *((Category.location_count, category_id, 1) for category_id in pin_req.category_ids),
+            *((Category.post_count, category_id, -post_count) for category_id in old_category_ids),
+            *((Category.post_count, category_id, post_count) for category_id in pin_req.category_ids)
+        )
 
-    return {
-        "id": pin.id,
-        "slug": pin.slug,
-        "title": pin.title,
-        "title_image_url": pin.title_image_url,
-        "description": pin.description,
-        "coordinates": mapping(to_shape(pin.coordinates)),
-        "categories": [cat.category.name for cat in pin.categories],
-        "cost": pin.cost,
-        "is_wishlisted": in_wishlist,
-        "is_visited": is_visited,
-        "post_count": pin.posts_count,
-        "created_at": pin.created_at,
-        "updated_at": pin.updated_at,
-    }
+    wishlisted_pins, visited_pins = await get_user_pin_flags(db, user, [pin.id])
+    await check_rendered_variants(pin.title_image_url)
+    return serialize_pin_item(pin, wishlisted_pins, visited_pins)
 
 
 @router.delete("/{pin_id_or_slug}", status_code=status.HTTP_204_NO_CONTENT)
@@ -665,28 +872,42 @@ async def delete_pin(pin_id_or_slug: str, db: db_dependency, user: user_dependen
     pin = None
     try:
         pin_id = int(pin_id_or_slug)
-        pin = db.query(Pin).filter(Pin.id == pin_id).first()
+        pin = await db.scalar(select(Pin).where(Pin.id == pin_id))
     except ValueError:
-        pin = db.query(Pin).filter(Pin.slug == pin_id_or_slug).first()
+        pin = await db.scalar(select(Pin).where(Pin.slug == pin_id_or_slug))
 
     if not pin:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Pin not found")
 
-    if pin.title_image_url:
-        relative_path = str(pin.title_image_url).lstrip('/')
-        file_path = MEDIA_DIR / relative_path
-        if file_path.exists():
-            try:
-                file_path.unlink()
-            except Exception as e:
-                print(f"Error deleting file {file_path}: {e}")
-
-    db.query(PinCategory).filter(PinCategory.pin_id == pin.id).delete()
-
-    db.query(Wishlist).filter(Wishlist.pin_id == pin.id).delete()
-    db.query(Visit).filter(Visit.pin_id == pin.id).delete()
-
-    db.delete(pin)
-    db.commit()
+    category_ids = (await db.scalars(select(PinCategory.category_id).where(PinCategory.pin_id == pin.id))).all()
+    await db.execute(delete(PinCategory).where(PinCategory.pin_id == pin.id))
+    # the pin's posts stay but lose their pin, so they drop out of their categories' post_count too
+    post_ids = (await db.scalars(select(Post.id).where(Post.pin_id == pin.id))).all()
+
+    wishlister_ids = (await db.scalars(delete(Wishlist).where(Wishlist.pin_id == pin.id).returning(Wishlist.user_id))).all()
+    visitor_ids = (await db.scalars(delete(Visit).where(Visit.pin_id == pin.id).returning(Visit.user_id))).all()
+
+    point = to_shape(pin.coordinates)
+    await remove_pin_from_clusters(db, point.x, point.y)
+    pin_id, slug = pin.id, pin.slug
+    title_image_url = pin.title_image_url
+    await db.delete(pin)
+    await db.commit()
+    # after the commit, like delete_post: a failed delete must keep its title image
+    if title_image_url:
+        await discard_uploads(media_path(str(title_image_url)))
+    await invalidate_pin_tiles((point.x, point.y))
+    await invalidate_pin_detail(pin_id, slug)
+    await record_counter_deltas(
+        *((Category.location_count, category_id, -1) for category_id in category_ids),
+        *((Category.post_count, category_id, -len(post_ids)) for category_id in category_ids),
+        *((User.visited_count, user_id, -1) for user_id in visitor_ids)
+    )
+    await remove_trending("pins", [pin_id], (point.x, point.y))
+    await remove_trending("posts", post_ids, (point.x, point.y))
+    for user_id in wishlister_ids:
+        await remove_pin_membership("wishlist", user_id, pin_id)
+    for user_id in visitor_ids:
+        await remove_pin_membership("visited", user_id, pin_id)
 
     return None
\ No newline at end of file
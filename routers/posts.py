@@ -1,19 +1,25 @@
 from dotenv import load_dotenv
-from fastapi import APIRouter, Depends, HTTPException, File, UploadFile
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Response, Request, BackgroundTasks
 from typing import Annotated, Optional
 from fastapi.params import Form
-from database import SessionLocal
+from database import db_dependency
 from starlette import status
-from sqlalchemy.orm import Session, joinedload
-from models import Post, Pin, Comment, CommentLike, PostLike
-from schemas import CommentRequest
-from routers.auth import get_current_user
+from sqlalchemy import select, func, exists, literal, true
+from sqlalchemy.orm import joinedload
+from models import Post, Pin, User, Category, PinCategory, Comment, CommentLike, PostLike
+from schemas import CommentRequest, PostUploadRequest
+from pagination import check_limit, paginate_by_created, set_next_cursor, decode_cursor, encode_cursor
+from feeds import get_feed_ids, fan_out_post
+from uploads import POST_MEDIA_TYPES, CHUNK_SIZE, UPLOAD_SESSION_TTL, save_upload, discard_uploads, media_path, create_upload_session, get_upload_session, append_upload_chunk, finish_upload_session, abort_upload_session, rendered_variant_urls, check_rendered_variants
+from loaders import load_relations, require_loaded
+from counters import record_counter_deltas, get_pending_delta, viewer_identity
+from trending import TRENDING_MAX_LIMIT, get_trending, parse_bbox, record_engagement, record_trending_view, remove_trending
+from clusters import pin_location
+from routers.auth import get_current_user, get_optional_current_user
 from geoalchemy2.elements import WKTElement
 from geoalchemy2.shape import to_shape
 from shapely.geometry import mapping
 import os
-import uuid
-from pathlib import Path
 from dotenv import load_dotenv
 
 router = APIRouter(
@@ -22,39 +28,73 @@ router = APIRouter(
 )
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-
-db_dependency = Annotated[Session, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
 
 load_dotenv()
-BASE_DIR = Path(__file__).resolve().parent.parent
-MEDIA_DIR = Path(os.getenv("MEDIA_DIR", "media"))
-MEDIA_DIR = BASE_DIR / MEDIA_DIR
-MEDIA_DIR.mkdir(parents=True, exist_ok=True)
 BASE_URL = os.getenv("BASE_URL", "http://13.48.126.53")
 
-MAX_IMAGE_SIZE = 20 * 1024 * 1024
-MAX_VIDEO_SIZE = 400 * 1024 * 1024
 MAX_MEDIA_COUNT = 10
+# threaded comments: levels of replies nested under a top-level comment, and how many replies per comment
+THREAD_MAX_DEPTH = 2
+THREAD_MAX_REPLIES = 10
+THREAD_MAX_LIMIT = 100
 
 @router.get("/")
-async def get_all_posts(db: db_dependency):
-    posts = db.query(Post).options(joinedload(Post.pin), joinedload(Post.user)).all()
+async def get_all_posts(db: db_dependency, response: Response, limit: int = 50, cursor: Optional[str] = None):
+    check_limit(limit)
+    posts = (await db.scalars(
+        paginate_by_created(
+            select(Post).options(joinedload(Post.pin), joinedload(Post.user)),
+            Post.created_at, Post.id, cursor, limit
+        )
+    )).all()
     if not posts:
+        # following the cursor of an exactly full last page lands here
+        if cursor:
+            return []
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No posts found")
+    set_next_cursor(response, len(posts), limit, posts[-1].created_at, posts[-1].id)
+    await check_rendered_variants(*(post.media_url for post in posts))
     return [serialize_post(post) for post in posts]
 
 
+@router.get("/feed")
+async def get_feed(db: db_dependency, user: user_dependency, response: Response, limit: int = 50, cursor: Optional[str] = None):
+    # the limit becomes ZREVRANGE bounds and a SQL LIMIT, neither copes with zero or negative values
+    check_limit(limit)
+    before_id = decode_cursor(cursor, int)[0] if cursor else None
+    post_ids = await get_feed_ids(db, user["id"], before_id, limit)
+    posts = {post.id: post for post in (await db.scalars(
+        select(Post).options(joinedload(Post.pin), joinedload(Post.user)).where(Post.id.in_(post_ids))
+    )).all()}
+    # the cursor follows the timeline, not the posts still found, so deleted posts don't end the feed early
+    if post_ids:
+        set_next_cursor(response, len(post_ids), limit, post_ids[-1])
+    await check_rendered_variants(*(post.media_url for post in posts.values()))
+    return [serialize_post(posts[post_id]) for post_id in post_ids if post_id in posts]
+
+
+@router.get("/trending")
+async def get_trending_posts(db: db_dependency, limit: int = 20, bbox: Optional[str] = None):
+    if not 0 < limit <= TRENDING_MAX_LIMIT:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"limit must be between 1 and {TRENDING_MAX_LIMIT}")
+    envelope = parse_bbox(bbox) if bbox else None
+    scores = dict(await get_trending("posts", limit, envelope))
+    if not scores:
+        return []
+
+    query = select(Post).options(joinedload(Post.pin), joinedload(Post.user)).where(Post.id.in_(scores))
+    if envelope:
+        query = query.join(Post.pin).where(func.ST_Intersects(Pin.coordinates, func.ST_MakeEnvelope(*envelope, 4326)))
+    posts = sorted((await db.scalars(query)).all(), key=lambda post: scores[post.id], reverse=True)[:limit]
+    await check_rendered_variants(*(post.media_url for post in posts))
+    return [{**serialize_post(post), "trending_score": scores[post.id]} for post in posts]
+
+
 @router.post("/", status_code=status.HTTP_201_CREATED)
 async def create_post(db: db_dependency,
                       user: user_dependency,
+                      background_tasks: BackgroundTasks,
                       title: Optional[str] = Form(None),
                       description: Optional[str] = Form(None),
                       pin_id: int = Form(...),
@@ -62,53 +102,118 @@ async def create_post(db: db_dependency,
                       ):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    pin = db.query(Pin).filter(Pin.id == pin_id).first()
+    pin = await db.scalar(select(Pin).where(Pin.id == pin_id))
     if not pin:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Pin not found")
 
-    if media.content_type not in ["image/jpeg", "image/png", "image/gif", "video/mp4"]:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unsupported media type")
-
-    user_dir = MEDIA_DIR / str(user["id"])
-    user_dir.mkdir(parents=True, exist_ok=True)
+    saved = await save_upload(media, user["id"], POST_MEDIA_TYPES)
+    return await insert_post(db, background_tasks, user["id"], pin_id, title, description, saved.url)
 
-    ext = os.path.splitext(media.filename)[1]
-    unique_name = f"{uuid.uuid4().hex}{ext}"
-    file_path = user_dir / unique_name
-    file_size = 0
-    max_size = MAX_VIDEO_SIZE if 'video' in media.content_type else MAX_IMAGE_SIZE
-
-    with open(file_path, "wb") as f:
-        while chunk := await media.read(1024 * 1024):  # 1MB chunks
-            file_size += len(chunk)
-            if file_size > max_size:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=f"File too large. Max size: {max_size / (1024 * 1024):.0f}MB"
-                )
-            f.write(chunk)
-
-    media_url = f"/media/{user['id']}/{unique_name}"
 
+async def insert_post(db, background_tasks: BackgroundTasks, user_id: int, pin_id: int, title: Optional[str], description: Optional[str], media_url: str):
     new_post = Post(
-        user_id=user["id"],
+        user_id=user_id,
         pin_id=pin_id,
         title=title,
         description=description,
         media_url=media_url,
     )
 
-    db.add(new_post)
-    db.commit()
-    db.refresh(new_post)
+    try:
+        db.add(new_post)
+        await db.commit()
+    except Exception:
+        # e.g. the pin was deleted meanwhile: the upload (or its blob reference) has no owner
+        await db.rollback()
+        await discard_uploads(media_path(media_url))
+        raise
+    await db.refresh(new_post, ["created_at"])
+    # the pin was just looked up by the caller, so usually only the author is queried
+    await load_relations(db, [new_post], "user", "pin")
+    category_ids = (await db.scalars(select(PinCategory.category_id).where(PinCategory.pin_id == pin_id))).all()
+    await record_counter_deltas(
+        (Pin.posts_count, pin_id, 1), (User.posts_count, user_id, 1),
+        *((Category.post_count, category_id, 1) for category_id in category_ids)
+    )
+    background_tasks.add_task(fan_out_post, new_post.id, user_id)
+    background_tasks.add_task(record_engagement, "post", pin_id, new_post.id)
     return serialize_post(new_post)
 
 
+# resumable variant of create_post for big videos: open a session, PUT the raw bytes in any number of chunks
+# (?offset= must match the server's offset, a failed chunk is simply re-sent from there), then complete
+def serialize_upload_session(session: dict):
+    return {
+        "upload_id": session["id"],
+        "offset": session["offset"],
+        "size": session["size"],
+        "complete": session["offset"] == session["size"],
+        "chunk_size": CHUNK_SIZE,
+        "expires_in": UPLOAD_SESSION_TTL,
+    }
+
+
+@router.post("/uploads", status_code=status.HTTP_201_CREATED)
+async def create_post_upload(db: db_dependency, user: user_dependency, upload_request: PostUploadRequest):
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
+    if not await db.scalar(select(Pin.id).where(Pin.id == upload_request.pin_id)):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Pin not found")
+    session = await create_upload_session(
+        user["id"],
+        upload_request.size,
+        pin_id=upload_request.pin_id,
+        title=upload_request.title,
+        description=upload_request.description,
+    )
+    return serialize_upload_session(session)
+
+
+@router.get("/uploads/{upload_id}")
+async def get_post_upload(upload_id: str, user: user_dependency):
+    return serialize_upload_session(await get_upload_session(upload_id, user["id"]))
+
+
+@router.put("/uploads/{upload_id}")
+async def put_post_upload_chunk(upload_id: str, offset: int, request: Request, user: user_dependency):
+    session = await get_upload_session(upload_id, user["id"])
+    session = await append_upload_chunk(session, offset, request.stream())
+    return serialize_upload_session(session)
+
+
+@router.post("/uploads/{upload_id}/complete", status_code=status.HTTP_201_CREATED)
+async def complete_post_upload(upload_id: str, db: db_dependency, user: user_dependency, background_tasks: BackgroundTasks):
+    session = await get_upload_session(upload_id, user["id"])
+    saved = await finish_upload_session(session, POST_MEDIA_TYPES)
+    return await insert_post(
+        db,
+        background_tasks,
+        user["id"],
+        int(session["pin_id"]),
+        session["title"] or None,
+        session["description"] or None,
+        saved.url,
+    )
+
+
+@router.delete("/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_post_upload(upload_id: str, user: user_dependency):
+    await get_upload_session(upload_id, user["id"])
+    await abort_upload_session(upload_id)
+    return None
+
+
 @router.get("/{post_id}")
-async def get_post(db: db_dependency, post_id: int):
-    post = db.query(Post).options(joinedload(Post.pin), joinedload(Post.user)).filter(Post.id == post_id).first()
+async def get_post(db: db_dependency,
+                   post_id: int,
+                   request: Request,
+                   background_tasks: BackgroundTasks,
+                   user: Optional[dict] = Depends(get_optional_current_user)):
+    post = await db.scalar(select(Post).options(joinedload(Post.pin), joinedload(Post.user)).where(Post.id == post_id))
     if not post:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Post not found")
+    background_tasks.add_task(record_trending_view, Post.view_count, post.id, viewer_identity(user, request.client.host if request.client else None), post.pin_id, post.id)
+    await check_rendered_variants(post.media_url)
     return serialize_post(post)
 
 
@@ -117,13 +222,21 @@ async def delete_post(db: db_dependency, post_id: int, user: user_dependency):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
 
-    post = db.query(Post).filter(Post.id == post_id, Post.user_id == user["id"]).first()
+    post = await db.scalar(select(Post).where(Post.id == post_id, Post.user_id == user["id"]))
     if not post:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="Post not found or you do not have permission to delete it")
 
-    db.delete(post)
-    db.commit()
+    category_ids = (await db.scalars(select(PinCategory.category_id).where(PinCategory.pin_id == post.pin_id))).all()
+    await db.delete(post)
+    await db.commit()
+    await record_counter_deltas(
+        (Pin.posts_count, post.pin_id, -1), (User.posts_count, post.user_id, -1),
+        *((Category.post_count, category_id, -1) for category_id in category_ids)
+    )
+    await remove_trending("posts", [post.id], await pin_location(post.pin_id) if post.pin_id else None)
+    if post.media_url:
+        await discard_uploads(media_path(post.media_url))
     return {"detail": "Post deleted successfully"}
 
 
@@ -134,38 +247,152 @@ async def like_post(db: db_dependency,
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
 
-    post = db.query(Post).filter(Post.id == post_id).first()
+    post = await db.scalar(select(Post).options(joinedload(Post.pin), joinedload(Post.user)).where(Post.id == post_id))
     if not post:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Post not found")
 
-    existing_like = db.query(PostLike).filter(PostLike.post_id == post_id, PostLike.user_id == user["id"]).first()
+    existing_like = await db.scalar(select(PostLike).where(PostLike.post_id == post_id, PostLike.user_id == user["id"]))
     if existing_like:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="You have already liked this post")
 
-    post.like_count += 1
+    # the like row is the source of truth, like_count is bumped by the counter flusher instead of locking the post row
     post_like = PostLike(
         user_id=user["id"],
         post_id=post_id
     )
     db.add(post_like)
-    db.commit()
-    db.refresh(post)
-    return serialize_post(post)
+    await db.commit()
+    await record_counter_deltas((Post.like_count, post_id, 1), (User.likes_count, post.user_id, 1))
+    await record_engagement("like", post.pin_id, post_id)
+    return {**serialize_post(post), "like_count": (post.like_count or 0) + await get_pending_delta(Post.like_count, post_id)}
 
 
 
 @router.get("/{post_id}/comments")
-async def get_post_comments(db: db_dependency, post_id: int):
-    post = db.query(Post).options(joinedload(Post.comments)).filter(Post.id == post_id).first()
-    if not post:
+async def get_post_comments(db: db_dependency,
+                            post_id: int,
+                            response: Response,
+                            limit: int = 50,
+                            cursor: Optional[str] = None):
+    check_limit(limit)
+    if await db.scalar(select(Post.id).where(Post.id == post_id)) is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Post not found")
 
-    comments = post.comments
+    # oldest first so a thread reads top to bottom
+    comments = (await db.scalars(
+        paginate_by_created(
+            select(Comment).options(joinedload(Comment.user)).where(Comment.post_id == post_id),
+            Comment.created_at, Comment.id, cursor, limit, descending=False
+        )
+    )).all()
     if not comments:
+        if cursor:
+            return []
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No comments found for this post")
+    set_next_cursor(response, len(comments), limit, comments[-1].created_at, comments[-1].id)
     return [serialize_comment(comment) for comment in comments]
 
 
+async def load_comment_threads(db, roots, replies: int, user: Optional[dict]):
+    # one recursive CTE: the page of roots (already keyset paginated), then up to replies + 1 children per comment (the extra one only says
+    # there are more) down to THREAD_MAX_DEPTH, plus one level past it that is fetched only to set has_more_replies
+    root_page = roots.subquery()
+    thread = select(
+        root_page.c.id, root_page.c.parent_id, root_page.c.created_at, literal(0).label("depth")
+    ).cte("thread", recursive=True)
+    children = (
+        select(Comment.id, Comment.parent_id, Comment.created_at)
+        .where(Comment.parent_id == thread.c.id)
+        .order_by(Comment.created_at, Comment.id)
+        .limit(replies + 1)
+        .lateral("children")
+    )
+    thread = thread.union_all(
+        select(children.c.id, children.c.parent_id, children.c.created_at, thread.c.depth + 1)
+        .select_from(thread.join(children, true()))
+        .where(thread.c.depth <= THREAD_MAX_DEPTH)
+    )
+    is_liked = (
+        exists().where(CommentLike.comment_id == Comment.id, CommentLike.user_id == user["id"])
+        if user else literal(False)
+    )
+    rows = (await db.execute(
+        select(Comment, thread.c.depth, is_liked.label("is_liked"))
+        .join(thread, thread.c.id == Comment.id)
+        .options(joinedload(Comment.user))
+        .order_by(Comment.created_at, Comment.id)
+    )).all()
+
+    children_of = {}
+    for comment, depth, liked in rows:
+        children_of.setdefault(comment.parent_id, []).append((comment, depth, liked))
+
+    def build(comment, depth, liked):
+        node = {**serialize_comment(comment), "is_liked": liked, "replies": [], "has_more_replies": False, "replies_cursor": None}
+        below = children_of.get(comment.id, [])
+        if depth >= THREAD_MAX_DEPTH:
+            # replies past the depth limit are loaded from the start via /posts/comments/{id}/replies
+            node["has_more_replies"] = bool(below)
+            return node
+        node["replies"] = [build(*child) for child in below[:replies]]
+        if len(below) > replies:
+            last = below[replies - 1][0] if replies else None
+            node["has_more_replies"] = True
+            node["replies_cursor"] = encode_cursor(last.created_at, last.id) if last else None
+        return node
+
+    return [build(*row) for row in rows if row[1] == 0]
+
+
+@router.get("/{post_id}/comments/threads")
+async def get_post_comment_threads(db: db_dependency,
+                                   post_id: int,
+                                   response: Response,
+                                   user: Optional[dict] = Depends(get_optional_current_user),
+                                   limit: int = 20,
+                                   replies: int = 3,
+                                   cursor: Optional[str] = None):
+    if not 0 < limit <= THREAD_MAX_LIMIT or not 0 <= replies <= THREAD_MAX_REPLIES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"limit must be between 1 and {THREAD_MAX_LIMIT}, replies between 0 and {THREAD_MAX_REPLIES}")
+    if await db.scalar(select(Post.id).where(Post.id == post_id)) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Post not found")
+
+    roots = paginate_by_created(
+        select(Comment.id, Comment.parent_id, Comment.created_at).where(Comment.post_id == post_id, Comment.parent_id.is_(None)),
+        Comment.created_at, Comment.id, cursor, limit, descending=False
+    )
+    threads = await load_comment_threads(db, roots, replies, user)
+    if threads:
+        set_next_cursor(response, len(threads), limit, threads[-1]["created_at"], threads[-1]["id"])
+    return threads
+
+
+@router.get("/comments/{comment_id}/replies")
+async def get_comment_replies(db: db_dependency,
+                              comment_id: int,
+                              response: Response,
+                              user: Optional[dict] = Depends(get_optional_current_user),
+                              limit: int = 20,
+                              replies: int = 3,
+                              cursor: Optional[str] = None):
+    # continues a thread where a replies_cursor left off, each reply comes with its own nested first replies
+    if not 0 < limit <= THREAD_MAX_LIMIT or not 0 <= replies <= THREAD_MAX_REPLIES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"limit must be between 1 and {THREAD_MAX_LIMIT}, replies between 0 and {THREAD_MAX_REPLIES}")
+    if await db.scalar(select(Comment.id).where(Comment.id == comment_id)) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found")
+
+    roots = paginate_by_created(
+        select(Comment.id, Comment.parent_id, Comment.created_at).where(Comment.parent_id == comment_id),
+        Comment.created_at, Comment.id, cursor, limit, descending=False
+    )
+    threads = await load_comment_threads(db, roots, replies, user)
+    if threads:
+        set_next_cursor(response, len(threads), limit, threads[-1]["created_at"], threads[-1]["id"])
+    return threads
+
+
 @router.post("/{post_id}/comments", status_code=status.HTTP_201_CREATED)
 async def create_comment(user: user_dependency,
                          db: db_dependency,
@@ -173,7 +400,7 @@ async def create_comment(user: user_dependency,
                          comment_request: CommentRequest):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    post = db.query(Post).filter(Post.id == post_id).first()
+    post = await db.scalar(select(Post).where(Post.id == post_id))
     if not post:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Post not found")
 
@@ -185,8 +412,11 @@ async def create_comment(user: user_dependency,
     )
 
     db.add(new_comment)
-    db.commit()
-    db.refresh(new_comment)
+    await db.commit()
+    await db.refresh(new_comment, ["created_at", "like_count"])
+    await load_relations(db, [new_comment], "user")
+    await record_counter_deltas((Post.comment_count, post_id, 1))
+    await record_engagement("comment", post.pin_id, post_id)
     return serialize_comment(new_comment)
 
 
@@ -196,13 +426,14 @@ async def delete_comment(db: db_dependency,
                          user: user_dependency):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    comment = db.query(Comment).filter(Comment.id == comment_id, Comment.user_id == user["id"]).first()
+    comment = await db.scalar(select(Comment).where(Comment.id == comment_id, Comment.user_id == user["id"]))
     if not comment:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="Comment not found or you do not have permission to delete it")
 
-    db.delete(comment)
-    db.commit()
+    await db.delete(comment)
+    await db.commit()
+    await record_counter_deltas((Post.comment_count, comment.post_id, -1))
     return {"detail": "Comment deleted successfully"}
 
 
@@ -214,26 +445,26 @@ async def create_like(db: db_dependency,
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
 
-    comment = db.query(Comment).filter(Comment.id == comment_id, Comment.post_id == post_id).first()
+    comment = await db.scalar(select(Comment).options(joinedload(Comment.user)).where(Comment.id == comment_id, Comment.post_id == post_id))
     if not comment:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found")
 
-    existing_like = db.query(CommentLike).filter(CommentLike.comment_id == comment_id, CommentLike.user_id == user["id"]).first()
+    existing_like = await db.scalar(select(CommentLike).where(CommentLike.comment_id == comment_id, CommentLike.user_id == user["id"]))
     if existing_like:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="You have already liked this comment")
 
-    comment.like_count += 1
     comment_like = CommentLike(
         user_id=user["id"],
         comment_id=comment_id
     )
     db.add(comment_like)
-    db.commit()
-    db.refresh(comment)
-    return serialize_comment(comment)
+    await db.commit()
+    await record_counter_deltas((Comment.like_count, comment_id, 1))
+    return {**serialize_comment(comment), "like_count": (comment.like_count or 0) + await get_pending_delta(Comment.like_count, comment_id)}
 
 
 def serialize_post(post: Post):
+    require_loaded(post, "user", "pin")
     return {
         "id": post.id,
         "user_id": post.user_id,
@@ -243,6 +474,7 @@ def serialize_post(post: Post):
         "title": post.title,
         "description": post.description,
         "media_url": post.media_url,
+        "media_sizes": rendered_variant_urls(post.media_url),
         "like_count": post.like_count,
         "comment_count": post.comment_count,
         "share_count": post.share_count,
@@ -251,6 +483,7 @@ def serialize_post(post: Post):
 
 
 def serialize_comment(comment):
+    require_loaded(comment, "user")
     return {
         "id": comment.id,
         "user_id": comment.user_id,
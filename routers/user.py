@@ -1,20 +1,24 @@
-import os
-import uuid
 from datetime import datetime, UTC
-from pathlib import Path
 from threading import active_count
 from dotenv import load_dotenv
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, Form
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, Form, Response
 from typing import Annotated, List, Optional
 from fastapi.params import File
 from sqlalchemy import select
-from database import SessionLocal
+from database import db_dependency
 from starlette import status
-from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.orm import joinedload, selectinload
 from models import Pin, Visit, Wishlist, User, Follow, Comment, Post, FavoriteCategory, PinCategory
 from schemas import UserResponse, FollowResponse, SuspensionRequest, SimpleUserResponse, VisitResponse, WishlistResponse
 from routers.auth import get_current_user
+from counters import record_counter_deltas
+from uploads import MAX_IMAGE_SIZE, AVATAR_MEDIA_TYPES, save_upload, discard_uploads, media_path, check_rendered_variants
+from memberships import add_pin_membership, remove_pin_membership
+from feeds import reset_timeline
+from trending import record_engagement
+from pagination import check_limit, paginate_by_id, paginate_by_created, set_next_cursor
 from routers.posts import serialize_post, serialize_comment
+from loaders import load_relations
 from geoalchemy2.elements import WKTElement
 from geoalchemy2.shape import to_shape
 from shapely.geometry import mapping
@@ -24,24 +28,15 @@ router = APIRouter(
     tags = ["user"]
 )
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
 load_dotenv()
-MEDIA_DIR = Path(os.getenv("MEDIA_DIR"))
 
 
 @router.get("/", response_model=UserResponse)
 async def get_user(db: db_dependency, user: user_dependency):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    result = db.execute(
+    result = await db.execute(
         select(User)
         .where(User.id == user["id"])
         .options(
@@ -82,56 +77,34 @@ async def update_user(db: db_dependency,
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
 
-    account = db.query(User).filter(User.id == user["id"]).first()
+    account = await db.scalar(
+        select(User)
+        .where(User.id == user["id"])
+        .options(
+            selectinload(User.favorite_categories).selectinload(FavoriteCategory.category)
+        )
+    )
     if username is not None and not "":
         account.username = username
     if bio is not None and not "":
         account.bio = bio
+    old_pfp_url = account.pfp_url
+    saved = None
     if media is not None:
-        if media.content_type not in ["image/jpeg", "image/png", "image/tiff", "image/webp"]:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid file type. Allowed types: JPEG, PNG, TIFF, WEBP"
-            )
-
-        MEDIA_DIR.mkdir(parents=True, exist_ok=True)
-
-        user_dir = MEDIA_DIR / str(user["id"])
-        user_dir.mkdir(parents=True, exist_ok=True)
-
-        ext = os.path.splitext(media.filename)[1]
-        unique_name = f"{uuid.uuid4().hex}{ext}"
-        file_path = user_dir / unique_name
-        file_size = 0
-        max_size = 20 * 1024 * 1024
-
-        try:
-            with open(file_path, "wb") as f:
-                while chunk := await media.read(1024 * 1024):
-                    file_size += len(chunk)
-                    if file_size > max_size:
-                        f.close()
-                        file_path.unlink(missing_ok=True)
-                        raise HTTPException(
-                            status_code=status.HTTP_400_BAD_REQUEST,
-                            detail=f"File too large. Max size: {max_size / (1024 * 1024):.0f}MB"
-                        )
-                    f.write(chunk)
-        except HTTPException:
-            raise
-        except Exception as e:
-            if file_path.exists():
-                file_path.unlink(missing_ok=True)
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Failed to save file: {str(e)}"
-            )
-
-        media_url = f"/media/{user['id']}/{unique_name}"
-        account.pfp_url = media_url
-
-    db.commit()
-    db.refresh(account)
+        saved = await save_upload(media, user["id"], AVATAR_MEDIA_TYPES, max_size=MAX_IMAGE_SIZE)
+        account.pfp_url = saved.url
+
+    try:
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        if saved:
+            await discard_uploads(saved.path)
+        raise
+    # the replaced picture loses its reference only once the new one is committed
+    if saved and old_pfp_url:
+        await discard_uploads(media_path(old_pfp_url))
+    await db.refresh(account)
     return {
         "id": account.id,
         "username": account.username,
@@ -157,16 +130,24 @@ async def update_user(db: db_dependency,
     }
 
 @router.get("/all", response_model=List[SimpleUserResponse])
-async def get_all_users(db: db_dependency):
-    result = db.execute(
-        select(User)
-        .options(
-            selectinload(User.favorite_categories).selectinload(FavoriteCategory.category)
+async def get_all_users(db: db_dependency, response: Response, limit: int = 50, cursor: Optional[str] = None):
+    check_limit(limit)
+    result = await db.execute(
+        paginate_by_id(
+            select(User)
+            .options(
+                selectinload(User.favorite_categories).selectinload(FavoriteCategory.category)
+            ),
+            User.id, cursor, limit
         )
     )
     users = result.scalars().all()
     if not users:
+        # following the cursor of an exactly full last page lands here
+        if cursor:
+            return []
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No users found")
+    set_next_cursor(response, len(users), limit, users[-1].id)
     return [
         {
             "id": user.id,
@@ -193,24 +174,24 @@ async def get_visited(db: db_dependency, user: user_dependency):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
 
     wq = (
-        db.query(Wishlist.pin_id)
-        .filter(Wishlist.user_id == user["id"])
+        select(Wishlist.pin_id)
+        .where(Wishlist.user_id == user["id"])
         .subquery()
     )
 
-    visit = (
-        db.query(Visit, wq.c.pin_id.isnot(None).label("in_wishlist"))
+    visit = (await db.execute(
+        select(Visit, wq.c.pin_id.isnot(None).label("in_wishlist"))
         .options(
-            joinedload(Visit.pin).joinedload(Pin.categories).joinedload(PinCategory.category)
+            joinedload(Visit.pin).selectinload(Pin.categories).joinedload(PinCategory.category)
         )
         .outerjoin(wq, wq.c.pin_id == Visit.pin_id)
-        .filter(Visit.user_id == user["id"])
-        .all()
-    )
+        .where(Visit.user_id == user["id"])
+    )).all()
 
     if not visit:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No visited pins found")
 
+    await check_rendered_variants(*(item[0].pin.title_image_url for item in visit))
     return [serialize_visit_item(item[0], is_wishlisted=item[1]) for item in visit]
 
 
@@ -220,24 +201,24 @@ async def get_wishlist(db: db_dependency, user: user_dependency):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
 
     vq = (
-        db.query(Visit.pin_id)
-        .filter(Visit.user_id == user["id"])
+        select(Visit.pin_id)
+        .where(Visit.user_id == user["id"])
         .subquery()
     )
 
-    wishlist = (
-        db.query(Wishlist, vq.c.pin_id.isnot(None).label("is_visited"))
+    wishlist = (await db.execute(
+        select(Wishlist, vq.c.pin_id.isnot(None).label("is_visited"))
         .options(
-            joinedload(Wishlist.pin).joinedload(Pin.categories).joinedload(PinCategory.category)
+            joinedload(Wishlist.pin).selectinload(Pin.categories).joinedload(PinCategory.category)
         )
         .outerjoin(vq, vq.c.pin_id == Wishlist.pin_id)
-        .filter(Wishlist.user_id == user["id"])
-        .all()
-    )
+        .where(Wishlist.user_id == user["id"])
+    )).all()
 
     if not wishlist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Wishlist not found")
 
+    await check_rendered_variants(*(item[0].pin.title_image_url for item in wishlist))
     return [serialize_wishlist_item(item[0], is_visited=item[1]) for item in wishlist]
 
 
@@ -245,10 +226,10 @@ async def get_wishlist(db: db_dependency, user: user_dependency):
 async def add_to_visited(pin_id: int, db: db_dependency, user: user_dependency):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    pin = db.query(Pin).filter(Pin.id == pin_id).first()
+    pin = await db.scalar(select(Pin).where(Pin.id == pin_id))
     if not pin:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Pin not found")
-    if db.query(Visit).filter(Visit.pin_id == pin_id, Visit.user_id == user["id"]).first():
+    if await db.scalar(select(Visit).where(Visit.pin_id == pin_id, Visit.user_id == user["id"])):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Pin already visited")
 
     visited_item = Visit(
@@ -256,18 +237,22 @@ async def add_to_visited(pin_id: int, db: db_dependency, user: user_dependency):
         user_id=user["id"]
     )
     db.add(visited_item)
-    db.commit()
-    db.refresh(visited_item)
+    await db.commit()
+    await db.refresh(visited_item)
+    await add_pin_membership("visited", user["id"], pin_id)
+    await record_counter_deltas((Pin.visit_count, pin_id, 1), (User.visited_count, user["id"], 1))
+    await record_engagement("visit", pin_id)
 
-    visited_item = db.query(Visit).options(
-        joinedload(Visit.pin).joinedload(Pin.categories).joinedload(PinCategory.category)
-    ).filter(Visit.user_id == user["id"], Visit.pin_id == pin_id).first()
+    visited_item = await db.scalar(select(Visit).options(
+        joinedload(Visit.pin).selectinload(Pin.categories).joinedload(PinCategory.category)
+    ).where(Visit.user_id == user["id"], Visit.pin_id == pin_id))
 
-    is_wishlisted = db.query(Wishlist).filter(
+    is_wishlisted = await db.scalar(select(Wishlist).where(
         Wishlist.pin_id == pin_id,
         Wishlist.user_id == user["id"]
-    ).first() is not None
+    )) is not None
 
+    await check_rendered_variants(visited_item.pin.title_image_url)
     return serialize_visit_item(visited_item, is_wishlisted=is_wishlisted)
 
 
@@ -275,10 +260,10 @@ async def add_to_visited(pin_id: int, db: db_dependency, user: user_dependency):
 async def add_to_wishlist(pin_id: int, db: db_dependency, user: user_dependency):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    pin = db.query(Pin).filter(Pin.id == pin_id).first()
+    pin = await db.scalar(select(Pin).where(Pin.id == pin_id))
     if not pin:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Pin not found")
-    if db.query(Wishlist).filter(Wishlist.pin_id == pin_id, Wishlist.user_id == user["id"]).first():
+    if await db.scalar(select(Wishlist).where(Wishlist.pin_id == pin_id, Wishlist.user_id == user["id"])):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Pin already in wishlist")
 
     wishlist_item = Wishlist(
@@ -286,18 +271,22 @@ async def add_to_wishlist(pin_id: int, db: db_dependency, user: user_dependency)
         user_id=user["id"]
     )
     db.add(wishlist_item)
-    db.commit()
-    db.refresh(wishlist_item)
+    await db.commit()
+    await db.refresh(wishlist_item)
+    await add_pin_membership("wishlist", user["id"], pin_id)
+    await record_counter_deltas((Pin.wishlist_count, pin_id, 1))
+    await record_engagement("wishlist", pin_id)
 
-    wishlist_item = db.query(Wishlist).options(
-        joinedload(Wishlist.pin).joinedload(Pin.categories).joinedload(PinCategory.category)
-    ).filter(Wishlist.user_id == user["id"], Wishlist.pin_id == pin_id).first()
+    wishlist_item = await db.scalar(select(Wishlist).options(
+        joinedload(Wishlist.pin).selectinload(Pin.categories).joinedload(PinCategory.category)
+    ).where(Wishlist.user_id == user["id"], Wishlist.pin_id == pin_id))
 
-    is_visited = db.query(Visit).filter(
+    is_visited = await db.scalar(select(Visit).where(
         Visit.pin_id == pin_id,
         Visit.user_id == user["id"]
-    ).first() is not None
+    )) is not None
 
+    await check_rendered_variants(wishlist_item.pin.title_image_url)
     return serialize_wishlist_item(wishlist_item, is_visited=is_visited)
 
 
@@ -305,11 +294,13 @@ async def add_to_wishlist(pin_id: int, db: db_dependency, user: user_dependency)
 async def remove_from_visited(pin_id: int, db: db_dependency, user: user_dependency):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    visit = db.query(Visit).filter(Visit.pin_id == pin_id, Visit.user_id == user["id"]).first()
+    visit = await db.scalar(select(Visit).where(Visit.pin_id == pin_id, Visit.user_id == user["id"]))
     if not visit:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Pin not found in visited list")
-    db.delete(visit)
-    db.commit()
+    await db.delete(visit)
+    await db.commit()
+    await remove_pin_membership("visited", user["id"], pin_id)
+    await record_counter_deltas((Pin.visit_count, pin_id, -1), (User.visited_count, user["id"], -1))
     return {"message": "Pin removed from visited list"}
 
 
@@ -317,11 +308,13 @@ async def remove_from_visited(pin_id: int, db: db_dependency, user: user_depende
 async def remove_from_wishlist(pin_id: int, db: db_dependency, user: user_dependency):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    wishlist = db.query(Wishlist).filter(Wishlist.pin_id == pin_id, Wishlist.user_id == user["id"]).first()
+    wishlist = await db.scalar(select(Wishlist).where(Wishlist.pin_id == pin_id, Wishlist.user_id == user["id"]))
     if not wishlist:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Pin not found in wishlist")
-    db.delete(wishlist)
-    db.commit()
+    await db.delete(wishlist)
+    await db.commit()
+    await remove_pin_membership("wishlist", user["id"], pin_id)
+    await record_counter_deltas((Pin.wishlist_count, pin_id, -1))
     return {"message": "Pin removed from wishlist"}
 
 
@@ -329,7 +322,7 @@ async def remove_from_wishlist(pin_id: int, db: db_dependency, user: user_depend
 async def get_user_by_id(id: int, db: db_dependency, user: user_dependency):
     if not user["is_admin"] and user["id"] != id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
-    result = db.execute(
+    result = await db.execute(
         select(User)
         .where(User.id == id)
         .options(
@@ -344,7 +337,7 @@ async def get_user_by_id(id: int, db: db_dependency, user: user_dependency):
 
 @router.get("/{id}/followers", response_model=list[FollowResponse])
 async def get_followers_by_id(id: int, db: db_dependency, user: user_dependency):
-    followers = db.query(Follow).filter(Follow.following_id == id).all()
+    followers = (await db.scalars(select(Follow).where(Follow.following_id == id))).all()
     if not followers:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No followers found for this user")
     return followers
@@ -352,7 +345,7 @@ async def get_followers_by_id(id: int, db: db_dependency, user: user_dependency)
 
 @router.get("/{id}/following", response_model=list[FollowResponse])
 async def get_following_by_id(id: int, db: db_dependency, user: user_dependency):
-    following = db.query(Follow).filter(Follow.follower_id == id).all()
+    following = (await db.scalars(select(Follow).where(Follow.follower_id == id))).all()
     if not following:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No following found for this user")
     return following
@@ -362,10 +355,10 @@ async def get_following_by_id(id: int, db: db_dependency, user: user_dependency)
 async def follow(db: db_dependency, id: int, user: user_dependency):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    account = db.query(User).filter(User.id == id).first()
+    account = await db.scalar(select(User).where(User.id == id))
     if not account:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    follow = db.query(Follow).filter(Follow.follower_id == user["id"], Follow.following_id == id).first()
+    follow = await db.scalar(select(Follow).where(Follow.follower_id == user["id"], Follow.following_id == id))
     if follow:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Already following this user")
     new_follow = Follow(
@@ -373,8 +366,10 @@ async def follow(db: db_dependency, id: int, user: user_dependency):
         following_id=id
     )
     db.add(new_follow)
-    db.commit()
-    db.refresh(new_follow)
+    await db.commit()
+    await db.refresh(new_follow)
+    await record_counter_deltas((User.following_count, user["id"], 1), (User.follower_count, id, 1))
+    await reset_timeline(user["id"])
     return new_follow
 
 
@@ -382,14 +377,16 @@ async def follow(db: db_dependency, id: int, user: user_dependency):
 async def unfollow_user(id: int, db: db_dependency, user: user_dependency):
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    account = db.query(User).filter(User.id == id).first()
+    account = await db.scalar(select(User).where(User.id == id))
     if not account:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    follow = db.query(Follow).filter(Follow.follower_id == user["id"], Follow.following_id == id).first()
+    follow = await db.scalar(select(Follow).where(Follow.follower_id == user["id"], Follow.following_id == id))
     if not follow:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Not following this user")
-    db.delete(follow)
-    db.commit()
+    await db.delete(follow)
+    await db.commit()
+    await record_counter_deltas((User.following_count, user["id"], -1), (User.follower_count, id, -1))
+    await reset_timeline(user["id"])
     return {"message": "Unfollowed successfully"}
 
 @router.get("/{id}/visited", response_model=list[VisitResponse])
@@ -398,24 +395,24 @@ async def get_visited_by_id(id: int, db: db_dependency, user: user_dependency):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
 
     wq = (
-        db.query(Wishlist.pin_id)
-        .filter(Wishlist.user_id == id)
+        select(Wishlist.pin_id)
+        .where(Wishlist.user_id == id)
         .subquery()
     )
 
-    visited = (
-        db.query(Visit, wq.c.pin_id.isnot(None).label("in_wishlist"))
+    visited = (await db.execute(
+        select(Visit, wq.c.pin_id.isnot(None).label("in_wishlist"))
         .options(
-            joinedload(Visit.pin).joinedload(Pin.categories).joinedload(PinCategory.category)
+            joinedload(Visit.pin).selectinload(Pin.categories).joinedload(PinCategory.category)
         )
         .outerjoin(wq, wq.c.pin_id == Visit.pin_id)
-        .filter(Visit.user_id == id)
-        .all()
-    )
+        .where(Visit.user_id == id)
+    )).all()
 
     if not visited:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No visited pins found")
 
+    await check_rendered_variants(*(item[0].pin.title_image_url for item in visited))
     return [serialize_visit_item(item[0], is_wishlisted=item[1]) for item in visited]
 
 
@@ -425,60 +422,122 @@ async def get_wishlist_by_id(id: int, user: user_dependency, db: db_dependency):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
 
     vq = (
-        db.query(Visit.pin_id)
-        .filter(Visit.user_id == id)
+        select(Visit.pin_id)
+        .where(Visit.user_id == id)
         .subquery()
     )
 
-    wishlist = (
-        db.query(Wishlist, vq.c.pin_id.isnot(None).label("is_visited"))
+    wishlist = (await db.execute(
+        select(Wishlist, vq.c.pin_id.isnot(None).label("is_visited"))
         .options(
-            joinedload(Wishlist.pin).joinedload(Pin.categories).joinedload(PinCategory.category)
+            joinedload(Wishlist.pin).selectinload(Pin.categories).joinedload(PinCategory.category)
         )
         .outerjoin(vq, vq.c.pin_id == Wishlist.pin_id)
-        .filter(Wishlist.user_id == id)
-        .all()
-    )
+        .where(Wishlist.user_id == id)
+    )).all()
 
     if not wishlist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Wishlist not found")
 
+    await check_rendered_variants(*(item[0].pin.title_image_url for item in wishlist))
     return [serialize_wishlist_item(item[0], is_visited=item[1]) for item in wishlist]
 
 
 @router.get("/{id}/comments")
-async def get_comments_by_id(id: int, db: db_dependency, user: user_dependency):
+async def get_comments_by_id(id: int,
+                             db: db_dependency,
+                             user: user_dependency,
+                             response: Response,
+                             limit: int = 50,
+                             cursor: Optional[str] = None):
+    check_limit(limit)
     if not user["is_admin"] and user["id"] != id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
-    comments = db.query(Comment).filter(Comment.user_id == id).all()
+    comments = (await db.scalars(
+        paginate_by_created(
+            select(Comment).where(Comment.user_id == id),
+            Comment.created_at, Comment.id, cursor, limit
+        )
+    )).all()
     if not comments:
+        if cursor:
+            return []
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No comments found for this user")
+    await load_relations(db, comments, "user")
+    set_next_cursor(response, len(comments), limit, comments[-1].created_at, comments[-1].id)
     return [serialize_comment(comment) for comment in comments]
 
 
 @router.get("/{id}/liked-comments")
-async def get_liked_comments_by_id(id: int, db: db_dependency, user: user_dependency):
+async def get_liked_comments_by_id(id: int,
+                                   db: db_dependency,
+                                   user: user_dependency,
+                                   response: Response,
+                                   limit: int = 50,
+                                   cursor: Optional[str] = None):
+    check_limit(limit)
     if not user["is_admin"] and user["id"] != id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
-    liked_comments = db.query(Comment).filter(Comment.likes.any(user_id=id)).all()
+    liked_comments = (await db.scalars(
+        paginate_by_created(
+            select(Comment).where(Comment.likes.any(user_id=id)),
+            Comment.created_at, Comment.id, cursor, limit
+        )
+    )).all()
     if not liked_comments:
+        if cursor:
+            return []
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No liked comments found for this user")
+    set_next_cursor(response, len(liked_comments), limit, liked_comments[-1].created_at, liked_comments[-1].id)
+    # authors are shared by many rows, one IN query instead of joining them onto every row
+    await load_relations(db, liked_comments, "user")
     return [serialize_comment(comment) for comment in liked_comments]
 
 
 @router.get("/{id}/liked-posts")
-async def get_liked_posts_by_id(id: int, db: db_dependency, user: user_dependency):
+async def get_liked_posts_by_id(id: int,
+                                db: db_dependency,
+                                user: user_dependency,
+                                response: Response,
+                                limit: int = 50,
+                                cursor: Optional[str] = None):
+    check_limit(limit)
     if not user["is_admin"] and user["id"] != id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
-    liked_posts = db.query(Post).filter(Post.likes.any(user_id=id)).all()
+    liked_posts = (await db.scalars(
+        paginate_by_created(
+            select(Post).where(Post.likes.any(user_id=id)),
+            Post.created_at, Post.id, cursor, limit
+        )
+    )).all()
+    if liked_posts:
+        set_next_cursor(response, len(liked_posts), limit, liked_posts[-1].created_at, liked_posts[-1].id)
+    await load_relations(db, liked_posts, "user", "pin")
+    await check_rendered_variants(*(post.media_url for post in liked_posts))
     return [serialize_post(post) for post in liked_posts]
 
 
 @router.get("/{id}/posts")
-async def get_posts_by_id(id: int, user: user_dependency, db: db_dependency):
-    posts = db.query(Post).options(joinedload(Post.user), joinedload(Post.pin)).filter(Post.user_id == id).all()
+async def get_posts_by_id(id: int,
+                          user: user_dependency,
+                          db: db_dependency,
+                          response: Response,
+                          limit: int = 50,
+                          cursor: Optional[str] = None):
+    check_limit(limit)
+    posts = (await db.scalars(
+        paginate_by_created(
+            select(Post).where(Post.user_id == id),
+            Post.created_at, Post.id, cursor, limit
+        )
+    )).all()
     if not posts:
+        if cursor:
+            return []
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No posts found for this user")
+    set_next_cursor(response, len(posts), limit, posts[-1].created_at, posts[-1].id)
+    await load_relations(db, posts, "user", "pin")
+    await check_rendered_variants(*(post.media_url for post in posts))
     return [serialize_post(post) for post in posts]
 
 
@@ -486,18 +545,25 @@ async def get_posts_by_id(id: int, user: user_dependency, db: db_dependency):
 async def suspend_user(id: int, db: db_dependency, user: user_dependency, suspension_request: SuspensionRequest):
     if not user["is_admin"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
-    account = db.query(User).filter(User.id == id).first()
+    account = await db.scalar(
+        select(User)
+        .where(User.id == id)
+        .options(
+            selectinload(User.favorite_categories).selectinload(FavoriteCategory.category)
+        )
+    )
     if not account:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     if account.is_suspended:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User is already suspended")
 
     account.is_suspended = True
-    account.suspended_at = datetime.now(UTC)
+    # suspended_at/suspended_until are naive timestamp columns, asyncpg refuses tz-aware values for those
+    account.suspended_at = datetime.now(UTC).replace(tzinfo=None)
     account.suspended_until = account.suspended_at + suspension_request.duration
     account.suspended_reason = suspension_request.reason
-    db.commit()
-    db.refresh(account)
+    await db.commit()
+    await db.refresh(account)
     return account
 
 
@@ -1,9 +1,10 @@
 from datetime import datetime, timedelta
-from pydantic import BaseModel, ConfigDict, field_serializer, model_validator
+from pydantic import BaseModel, ConfigDict, field_serializer, model_validator, computed_field
 from typing import List, Optional, Dict, Any
 import os
 from pathlib import Path
 from dotenv import load_dotenv
+from uploads import rendered_variant_urls
 
 load_dotenv()
 BASE_URL = Path(os.getenv("BASE_URL"))
@@ -11,6 +12,12 @@ BASE_URL = Path(os.getenv("BASE_URL"))
 class BaseSchema(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
+def media_sizes(url: str | None) -> Dict[str, str] | None:
+    sizes = rendered_variant_urls(url)
+    if sizes is None:
+        return None
+    return {width: f"{BASE_URL}/{path.lstrip('/')}" for width, path in sizes.items()}
+
 class CreateUserRequest(BaseModel):
     email: str
     username: str
@@ -35,7 +42,7 @@ class PinResponse(BaseSchema):
     id: int
     slug: str
     title: str
-    title_image_url: str
+    title_image_url: Optional[str] = None
     description: Optional[str] = None
     coordinates: Dict[str, Any]
     categories: List[str]
@@ -44,6 +51,11 @@ class PinResponse(BaseSchema):
     is_wishlisted: Optional[bool] = None
     is_visited: Optional[bool] = None
 
+    @computed_field
+    @property
+    def title_image_sizes(self) -> Optional[Dict[str, str]]:
+        return media_sizes(self.title_image_url)
+
     @field_serializer('title_image_url')
     def serialize_title_image_url(self, title_image_url: str | None, _info) -> str | None:
         if not title_image_url:
@@ -54,6 +66,12 @@ class PinResponse(BaseSchema):
 
         return f"{BASE_URL}/{path}"
 
+class NearbyPinResponse(PinResponse):
+    distance_m: float
+
+class TrendingPinResponse(PinResponse):
+    trending_score: float
+
 
 class CategoryRequest(BaseModel):
     name: str
@@ -68,14 +86,19 @@ class HangoutResponse(BaseSchema):
     catering: Optional[str] = None
     expected_participants: Optional[int] = None
     max_participants: Optional[int] = None
+    participant_count: int = 0
     start_time: datetime
     duration: Optional[timedelta] = None
     pin: PinResponse
     owner_id: int
     owner_username: str
-    owner_pfp: str
+    owner_pfp: Optional[str] = None
     is_attending: Optional[bool] = False
 
+class UpcomingHangoutResponse(HangoutResponse):
+    id: int
+    distance_m: Optional[float] = None
+
 class HangoutRequest(BaseModel):
     title: str
     description: str
@@ -102,6 +125,11 @@ class ParticipantUserResponse(BaseModel):
     pfp_url: str | None = None
     is_followed: bool = False
 
+    @computed_field
+    @property
+    def pfp_sizes(self) -> Optional[Dict[str, str]]:
+        return media_sizes(self.pfp_url)
+
     @field_serializer('pfp_url')
     def serialize_pfp_url(self, pfp_url: str | None, _info) -> str | None:
         if not pfp_url:
@@ -116,6 +144,12 @@ class CommentRequest(BaseModel):
     content: str
     parent_id: Optional[int] = None
 
+class PostUploadRequest(BaseModel):
+    pin_id: int
+    size: int
+    title: Optional[str] = None
+    description: Optional[str] = None
+
 class UserResponse(BaseSchema):
     id: int
     username: str
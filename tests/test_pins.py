@@ -0,0 +1,84 @@
+import asyncio
+import os
+import uuid
+from datetime import timedelta
+import pytest
+
+# runs against the real PostGIS database and Redis from .env, like the app itself
+if not os.getenv("DATABASE_URL"):
+    pytest.skip("DATABASE_URL is not set", allow_module_level=True)
+
+from fastapi.testclient import TestClient
+from geoalchemy2 import WKTElement
+from sqlalchemy import delete, select
+from database import AsyncSessionLocal, async_engine
+from main import app
+from models import User, Pin, PinCategory, LocationRequest
+from routers.auth import create_access_token
+from routers.pins import tile_for_point
+
+LON, LAT = 17.1077, 48.1486
+ZOOM = 14
+
+
+def run(coro):
+    async def in_fresh_pool():
+        # asyncpg connections belong to the loop that opened them, TestClient runs the app on its own loop
+        try:
+            return await coro
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(in_fresh_pool())
+
+
+async def create_request(title: str):
+    async with AsyncSessionLocal() as db:
+        admin = User(username=f"admin-{uuid.uuid4().hex[:8]}", email=f"{uuid.uuid4().hex}@example.com", is_admin=True)
+        db.add(admin)
+        await db.flush()
+        request = LocationRequest(
+            user_id=admin.id,
+            title=title,
+            location=WKTElement(f"POINT({LON} {LAT})", srid=4326),
+        )
+        db.add(request)
+        await db.commit()
+        return admin.id, admin.username, request.id
+
+
+async def cleanup(user_id: int, request_id: int, slug: str):
+    async with AsyncSessionLocal() as db:
+        pin_id = await db.scalar(select(Pin.id).where(Pin.slug == slug))
+        if pin_id is not None:
+            await db.execute(delete(PinCategory).where(PinCategory.pin_id == pin_id))
+            await db.execute(delete(Pin).where(Pin.id == pin_id))
+        await db.execute(delete(LocationRequest).where(LocationRequest.id == request_id))
+        await db.execute(delete(User).where(User.id == user_id))
+        await db.commit()
+
+
+def test_approved_request_shows_up_in_detail_and_tiles():
+    title = f"Test Pin {uuid.uuid4().hex[:8]}"
+    slug = title.lower().replace(" ", "-")
+    user_id, username, request_id = run(create_request(title))
+    headers = {"Authorization": f"Bearer {create_access_token(username, user_id, True, timedelta(minutes=5))}"}
+    tile_url = "/api/pins/tiles/{}/{}/{}.mvt".format(ZOOM, *tile_for_point(LON, LAT, ZOOM))
+    try:
+        with TestClient(app) as client:
+            # warm both caches with the pin still missing
+            assert client.get(f"/api/pins/{slug}", headers=headers).status_code == 404
+            tile = client.get(tile_url)
+            assert tile.status_code == 200
+            assert slug.encode() not in tile.content
+
+            approved = client.post(f"/api/pins/requests/{request_id}/approve", headers=headers)
+            assert approved.status_code == 202
+            assert approved.json()["slug"] == slug
+
+            detail = client.get(f"/api/pins/{slug}", headers=headers)
+            assert detail.status_code == 200
+            assert detail.json()["id"] == approved.json()["id"]
+            assert client.get(f"/api/pins/{approved.json()['id']}", headers=headers).status_code == 200
+            assert slug.encode() in client.get(tile_url).content
+    finally:
+        run(cleanup(user_id, request_id, slug))
@@ -0,0 +1,187 @@
+import asyncio
+import math
+import os
+import time
+import redis
+from fastapi import HTTPException
+from starlette import status
+from cache import redis_client
+from clusters import cell_for, pin_location, forget_pin_location
+from counters import record_view
+
+# time-decayed engagement scores in Redis sorted sets, one global set per kind plus one per map cell.
+# A score is stored as log(sum(weight * e^(t / tau))) over all events, so every item decays at the same rate,
+# ranking never needs a rescan and the current value is e^(score - now / tau).
+TRENDING_HALF_LIFE = float(os.getenv("TRENDING_HALF_LIFE", 24 * 3600))
+TRENDING_TAU = TRENDING_HALF_LIFE / math.log(2)
+TRENDING_WEIGHTS = {"view": 1.0, "like": 3.0, "comment": 4.0, "wishlist": 4.0, "visit": 6.0, "post": 6.0}
+# engagement on a post also counts for its pin, scaled down
+TRENDING_PIN_SHARE = float(os.getenv("TRENDING_PIN_SHARE", 0.5))
+# zoom level of the clusters.py grid used for bbox queries, 7 is ~1.4 degree cells
+TRENDING_CELL_ZOOM = int(os.getenv("TRENDING_CELL_ZOOM", 7))
+# a bbox spanning more cells than this reads the global set and filters instead
+TRENDING_MAX_CELLS = int(os.getenv("TRENDING_MAX_CELLS", 64))
+# reads take this many times `limit` candidates, callers drop the edge cells' members outside the bbox and deleted items
+TRENDING_BBOX_OVERFETCH = int(os.getenv("TRENDING_BBOX_OVERFETCH", 4))
+TRENDING_MAX_LIMIT = 100
+# decayed scores below this are pruned, and each set is capped in size
+TRENDING_MIN_SCORE = float(os.getenv("TRENDING_MIN_SCORE", 0.05))
+TRENDING_MAX_ITEMS = int(os.getenv("TRENDING_MAX_ITEMS", 10000))
+TRENDING_PRUNE_INTERVAL = float(os.getenv("TRENDING_PRUNE_INTERVAL", 3600))
+
+# log-sum-exp update, stays exact and finite however far apart the scores are
+_bump = redis_client.register_script("""
+for i, key in ipairs(KEYS) do
+    local member = ARGV[2 * i - 1]
+    local x = tonumber(ARGV[2 * i])
+    local s = tonumber(redis.call('zscore', key, member))
+    if s then
+        x = math.max(s, x) + math.log(1 + math.exp(-math.abs(s - x)))
+    end
+    redis.call('zadd', key, x, member)
+end
+return 0
+""")
+
+# moves members (ARGV) from one cell's set (KEYS[1]) to another's (KEYS[2]), merging scores like _bump
+_move = redis_client.register_script("""
+for i, member in ipairs(ARGV) do
+    local s = tonumber(redis.call('zscore', KEYS[1], member))
+    if s then
+        redis.call('zrem', KEYS[1], member)
+        local t = tonumber(redis.call('zscore', KEYS[2], member))
+        if t then
+            s = math.max(s, t) + math.log(1 + math.exp(-math.abs(s - t)))
+        end
+        redis.call('zadd', KEYS[2], s, member)
+    end
+end
+return 0
+""")
+
+
+def trending_key(kind: str, cell: tuple[int, int] | None = None):
+    return f"trending:{kind}" if cell is None else f"trending:{kind}:{cell[0]}:{cell[1]}"
+
+
+def parse_bbox(bbox: str):
+    try:
+        min_lon, min_lat, max_lon, max_lat = map(float, bbox.split(','))
+    except (ValueError, AttributeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid bbox format. Use: min_lon,min_lat,max_lon,max_lat"
+        )
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def decayed_score(score: float, now: float | None = None):
+    return math.exp(score - (now or time.time()) / TRENDING_TAU)
+
+
+async def _pin_cell(pin_id: int):
+    location = await pin_location(pin_id)
+    return cell_for(*location, TRENDING_CELL_ZOOM) if location else None
+
+
+async def record_engagement(event: str, pin_id: int, post_id: int | None = None):
+    # call after the source row change is committed; scores are best effort and dropped while Redis is down
+    x = math.log(TRENDING_WEIGHTS[event]) + time.time() / TRENDING_TAU
+    cell = await _pin_cell(pin_id)
+    keys, args = [], []
+    if post_id is not None:
+        keys += [trending_key("posts")] + ([trending_key("posts", cell)] if cell else [])
+        args += [post_id, x] * (2 if cell else 1)
+        x += math.log(TRENDING_PIN_SHARE)
+    keys += [trending_key("pins")] + ([trending_key("pins", cell)] if cell else [])
+    args += [pin_id, x] * (2 if cell else 1)
+    try:
+        await _bump(keys=keys, args=args)
+    except redis.RedisError as e:
+        print(f"Redis error in record_engagement: {e}")
+
+
+async def record_trending_view(attr, row_id: int, viewer: str, pin_id: int, post_id: int | None = None):
+    # only views that count towards view_count (first per viewer in the dedupe window) add to the score
+    if await record_view(attr, row_id, viewer):
+        await record_engagement("view", pin_id, post_id)
+
+
+async def remove_trending(kind: str, item_ids, location: tuple[float, float] | None):
+    # call after the items are deleted; location is their pin's (lon, lat), whose cell set they are in
+    item_ids = list(item_ids)
+    if not item_ids:
+        return
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zrem(trending_key(kind), *item_ids)
+            if location:
+                pipe.zrem(trending_key(kind, cell_for(*location, TRENDING_CELL_ZOOM)), *item_ids)
+            await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Redis error in remove_trending: {e}")
+
+
+async def move_trending_pin(pin_id: int, post_ids, old_location: tuple[float, float], new_location: tuple[float, float]):
+    # call after a pin's new coordinates are committed, its own and its posts' scores follow it to the new cell
+    forget_pin_location(pin_id)
+    old_cell = cell_for(*old_location, TRENDING_CELL_ZOOM)
+    new_cell = cell_for(*new_location, TRENDING_CELL_ZOOM)
+    if old_cell == new_cell:
+        return
+    post_ids = list(post_ids)
+    try:
+        await _move(keys=[trending_key("pins", old_cell), trending_key("pins", new_cell)], args=[pin_id])
+        if post_ids:
+            await _move(keys=[trending_key("posts", old_cell), trending_key("posts", new_cell)], args=post_ids)
+    except redis.RedisError as e:
+        print(f"Redis error in move_trending_pin: {e}")
+
+
+async def get_trending(kind: str, limit: int, bbox: tuple[float, float, float, float] | None = None):
+    # [(id, decayed score)] best first, up to TRENDING_BBOX_OVERFETCH * limit candidates that callers filter and
+    # cut to `limit`. Without a bbox the filter only drops items deleted since they were scored. With one, the
+    # candidates come from the covering cells, which reach past the bbox edges, and callers filter precisely.
+    candidates = limit * TRENDING_BBOX_OVERFETCH
+    try:
+        if bbox is None:
+            return _decode(await redis_client.zrevrange(trending_key(kind), 0, candidates - 1, withscores=True))
+        min_x, min_y = cell_for(bbox[0], bbox[1], TRENDING_CELL_ZOOM)
+        max_x, max_y = cell_for(bbox[2], bbox[3], TRENDING_CELL_ZOOM)
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > TRENDING_MAX_CELLS:
+            return _decode(await redis_client.zrevrange(trending_key(kind), 0, candidates - 1, withscores=True))
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    pipe.zrevrange(trending_key(kind, (x, y)), 0, candidates - 1, withscores=True)
+            cells = await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Redis error in get_trending: {e}")
+        return []
+    # an item lives in exactly one cell, so merging the per-cell top lists gives the top of the union
+    merged = sorted(_decode([entry for cell in cells for entry in cell]), key=lambda entry: entry[1], reverse=True)
+    return merged[:candidates]
+
+
+def _decode(entries):
+    now = time.time()
+    return [(int(member), decayed_score(score, now)) for member, score in entries]
+
+
+async def prune_trending():
+    # drops items that decayed below TRENDING_MIN_SCORE and caps every set at TRENDING_MAX_ITEMS
+    cutoff = math.log(TRENDING_MIN_SCORE) + time.time() / TRENDING_TAU
+    async for key in redis_client.scan_iter(match="trending:*", count=500):
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(key, "-inf", f"({cutoff}")
+            pipe.zremrangebyrank(key, 0, -TRENDING_MAX_ITEMS - 1)
+            await pipe.execute()
+
+
+async def run_trending_pruner():
+    while True:
+        await asyncio.sleep(TRENDING_PRUNE_INTERVAL)
+        try:
+            await prune_trending()
+        except Exception as e:
+            print(f"Error pruning trending scores: {e}")
@@ -0,0 +1,501 @@
+import asyncio
+import hashlib
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import NamedTuple, Optional
+import anyio
+import redis
+from dotenv import load_dotenv
+from fastapi import HTTPException, UploadFile
+from sqlalchemy import update, delete
+from sqlalchemy.dialects.postgresql import insert
+from starlette import status
+from starlette.requests import ClientDisconnect
+from cache import redis_client
+from database import AsyncSessionLocal
+from derivatives import schedule_variants, variant_paths, variant_urls, variants_rendered, check_variants
+from models import MediaBlob
+
+
+load_dotenv()
+BASE_DIR = Path(__file__).resolve().parent
+MEDIA_DIR = BASE_DIR / Path(os.getenv("MEDIA_DIR", "media"))
+# files are written here first and renamed into place, so it must be on the same filesystem as MEDIA_DIR
+PARTIAL_UPLOAD_DIR = Path(os.getenv("PARTIAL_UPLOAD_DIR", MEDIA_DIR / ".partial"))
+# store new uploads once per content as blobs/<aa>/<sha256>.<ext> with a reference count in media_blobs,
+# instead of a fresh <user_id>/<uuid>.<ext> per upload. Blobs stay refcounted even if this is switched off again.
+CONTENT_ADDRESSED_MEDIA = os.getenv("CONTENT_ADDRESSED_MEDIA", "false").lower() in ("1", "true", "yes")
+BLOB_DIR = MEDIA_DIR / "blobs"
+
+MAX_IMAGE_SIZE = 20 * 1024 * 1024
+MAX_VIDEO_SIZE = 400 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+# media type -> extension, the type comes from the file's own bytes, never from the client's content_type/filename
+MEDIA_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/tiff": ".tiff",
+    "video/mp4": ".mp4",
+}
+PIN_MEDIA_TYPES = {"image/jpeg", "image/png", "image/gif", "video/mp4"}
+POST_MEDIA_TYPES = {"image/jpeg", "image/png", "image/gif", "video/mp4"}
+AVATAR_MEDIA_TYPES = {"image/jpeg", "image/png", "image/tiff", "image/webp"}
+
+
+class SavedUpload(NamedTuple):
+    path: Path
+    url: str
+    media_type: str
+    size: int
+
+
+# ISO-BMFF major brands that are MP4 video, HEIC/HEIF, AVIF, QuickTime and 3GP share the ftyp box but are not
+MP4_BRANDS = {b"isom", b"iso2", b"iso3", b"iso4", b"iso5", b"iso6", b"mp41", b"mp42", b"avc1", b"dash", b"M4V ", b"M4VP", b"MSNV"}
+
+
+def sniff_media_type(head: bytes) -> Optional[str]:
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return "image/tiff"
+    if head[4:8] == b"ftyp" and head[8:12] in MP4_BRANDS:
+        return "video/mp4"
+    return None
+
+
+def media_path(url: str) -> Path:
+    # "/media/<user_id>/<name>" -> file under MEDIA_DIR
+    return MEDIA_DIR / url.removeprefix("/").removeprefix("media/")
+
+
+def rendered_variant_urls(url: Optional[str]):
+    # variant_urls, but None until the variant files exist
+    sizes = variant_urls(url)
+    if sizes is None or not variants_rendered(media_path(url)):
+        return None
+    return sizes
+
+
+async def check_rendered_variants(*urls: Optional[str]):
+    # one batched existence check for the urls rendered_variant_urls is about to be asked about
+    await check_variants(media_path(url) for url in urls if variant_urls(url) is not None)
+
+
+def blob_path(digest: str, media_type: str):
+    return BLOB_DIR / digest[:2] / f"{digest}{MEDIA_EXTENSIONS[media_type]}"
+
+
+def is_blob_path(path: Path):
+    return Path(path).parent.parent == BLOB_DIR
+
+
+def _hash_file(path: Path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def acquire_blob(digest: str, media_type: str, size: int):
+    # if a release is deleting the same row right now, the upsert waits for it and then inserts a fresh one
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            insert(MediaBlob)
+            .values(digest=digest, media_type=media_type, size=size, ref_count=1)
+            .on_conflict_do_update(index_elements=[MediaBlob.digest], set_={"ref_count": MediaBlob.ref_count + 1})
+        )
+        await db.commit()
+
+
+async def release_blob(path: Path):
+    digest = Path(path).stem
+    async with AsyncSessionLocal() as db:
+        ref_count = await db.scalar(
+            update(MediaBlob)
+            .where(MediaBlob.digest == digest)
+            .values(ref_count=MediaBlob.ref_count - 1)
+            .returning(MediaBlob.ref_count)
+        )
+        if ref_count is not None and ref_count <= 0:
+            await db.execute(delete(MediaBlob).where(MediaBlob.digest == digest))
+            # unlinked while the row is still locked, so a concurrent acquire_blob finds the file gone
+            await _unlink_with_variants(path)
+        await db.commit()
+
+
+async def place_upload(source: Path, user_id: int, media_type: str, size: int, digest: Optional[str] = None) -> SavedUpload:
+    # moves a fully written file from PARTIAL_UPLOAD_DIR to its final place and schedules its variants
+    if CONTENT_ADDRESSED_MEDIA:
+        if digest is None:
+            digest = await anyio.to_thread.run_sync(_hash_file, source)
+        file_path = blob_path(digest, media_type)
+        url = f"/media/blobs/{digest[:2]}/{file_path.name}"
+        await acquire_blob(digest, media_type, size)
+        try:
+            if await anyio.Path(file_path).exists():
+                # same bytes are already stored, variants included
+                await anyio.Path(source).unlink(missing_ok=True)
+                return SavedUpload(file_path, url, media_type, size)
+            await anyio.Path(file_path.parent).mkdir(parents=True, exist_ok=True)
+            await anyio.Path(source).rename(file_path)
+        except BaseException:
+            await release_blob(file_path)
+            raise
+    else:
+        user_dir = MEDIA_DIR / str(user_id)
+        await anyio.Path(user_dir).mkdir(parents=True, exist_ok=True)
+        file_path = user_dir / f"{uuid.uuid4().hex}{MEDIA_EXTENSIONS[media_type]}"
+        await anyio.Path(source).rename(file_path)
+        url = f"/media/{user_id}/{file_path.name}"
+
+    schedule_variants(file_path, media_type)
+    return SavedUpload(file_path, url, media_type, size)
+
+
+def _describe(types: set):
+    return ", ".join(sorted(MEDIA_EXTENSIONS[t].lstrip(".").upper() for t in types))
+
+
+async def save_upload(upload: UploadFile, user_id: int, allowed_types: set, max_size: Optional[int] = None) -> SavedUpload:
+    # streams the upload to PARTIAL_UPLOAD_DIR in CHUNK_SIZE pieces (file IO and hashing run in worker threads),
+    # then place_upload moves it to its final location
+    head = await upload.read(CHUNK_SIZE)
+    media_type = sniff_media_type(head)
+    if media_type not in allowed_types:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid file type. Allowed types: {_describe(allowed_types)}"
+        )
+    if max_size is None:
+        max_size = MAX_VIDEO_SIZE if media_type.startswith("video/") else MAX_IMAGE_SIZE
+
+    await anyio.Path(PARTIAL_UPLOAD_DIR).mkdir(parents=True, exist_ok=True)
+    file_path = PARTIAL_UPLOAD_DIR / f"{uuid.uuid4().hex}.upload.part"
+
+    size = 0
+    digest = hashlib.sha256() if CONTENT_ADDRESSED_MEDIA else None
+    try:
+        async with await anyio.open_file(file_path, "wb") as f:
+            chunk = head
+            while chunk:
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=f"File too large. Max size: {max_size / (1024 * 1024):.0f}MB"
+                    )
+                await f.write(chunk)
+                if digest is not None:
+                    # hashlib drops the GIL for big buffers, so this really runs beside the event loop
+                    await anyio.to_thread.run_sync(digest.update, chunk)
+                chunk = await upload.read(CHUNK_SIZE)
+        return await place_upload(file_path, user_id, media_type, size, digest.hexdigest() if digest else None)
+    except HTTPException:
+        await discard_uploads(file_path)
+        raise
+    except Exception as e:
+        await discard_uploads(file_path)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to save file: {str(e)}"
+        )
+    except BaseException:
+        # client went away / request cancelled mid-write, don't leave the partial file behind
+        await discard_uploads(file_path)
+        raise
+
+
+async def save_uploads(uploads: list[UploadFile], user_id: int, allowed_types: set, max_size: Optional[int] = None):
+    # all files are written concurrently, if one is rejected the ones already on disk are removed again
+    results = await asyncio.gather(
+        *(save_upload(upload, user_id, allowed_types, max_size) for upload in uploads),
+        return_exceptions=True
+    )
+    failures = [r for r in results if isinstance(r, BaseException)]
+    if failures:
+        await discard_uploads(*(r.path for r in results if isinstance(r, SavedUpload)))
+        raise failures[0]
+    return results
+
+
+async def _unlink_with_variants(original: Path):
+    for path in (original, *variant_paths(Path(original)).values()):
+        try:
+            await anyio.Path(path).unlink(missing_ok=True)
+        except OSError as e:
+            print(f"Error deleting file {path}: {e}")
+
+
+async def discard_uploads(*paths: Path):
+    # removes the files together with any resized variants generated for them, blobs only lose one reference
+    for path in paths:
+        if is_blob_path(path):
+            await release_blob(path)
+        else:
+            await _unlink_with_variants(path)
+
+
+# resumable uploads: a Redis hash per session plus a .part file in PARTIAL_UPLOAD_DIR that chunks are appended to in place
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 3600))
+UPLOAD_SWEEP_INTERVAL = int(os.getenv("UPLOAD_SWEEP_INTERVAL", 3600))
+# one request at a time per session (a chunk or the completion), the holder keeps extending it while it streams
+UPLOAD_LOCK_TTL = int(os.getenv("UPLOAD_LOCK_TTL", 60))
+
+# the lock holds a per-request token, so a request whose lock expired can't extend or release its successor's
+_extend_lock = redis_client.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+_release_lock = redis_client.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+
+def upload_session_key(upload_id: str):
+    return f"uploads:session:{upload_id}"
+
+
+def partial_upload_path(upload_id: str):
+    return PARTIAL_UPLOAD_DIR / f"{upload_id}.part"
+
+
+def _upload_service_unavailable(e: redis.RedisError):
+    print(f"Redis error in upload session: {e}")
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Upload service unavailable")
+
+
+class UploadLock:
+    def __init__(self, upload_id: str):
+        self.key = f"uploads:lock:{upload_id}"
+        self.token = uuid.uuid4().hex
+        self.extended_at = 0.0
+        self.lost = False
+
+    async def acquire(self):
+        try:
+            acquired = await redis_client.set(self.key, self.token, nx=True, ex=UPLOAD_LOCK_TTL)
+        except redis.RedisError as e:
+            raise _upload_service_unavailable(e)
+        if not acquired:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Another request for this upload is in progress")
+        self.extended_at = time.monotonic()
+
+    async def extend(self):
+        # called per chunk, only talks to Redis every third of the TTL
+        if time.monotonic() - self.extended_at < UPLOAD_LOCK_TTL / 3:
+            return
+        try:
+            held = await _extend_lock(keys=[self.key], args=[self.token, UPLOAD_LOCK_TTL])
+        except redis.RedisError as e:
+            print(f"Redis error in UploadLock.extend: {e}")
+            return
+        if not held:
+            # stalled past the TTL and another request may own the file now, stop touching it
+            self.lost = True
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload lock expired, resume from the current offset")
+        self.extended_at = time.monotonic()
+
+    async def release(self):
+        try:
+            await _release_lock(keys=[self.key], args=[self.token])
+        except redis.RedisError as e:
+            print(f"Redis error in UploadLock.release: {e}")
+
+
+async def create_upload_session(user_id: int, size: int, **fields):
+    if size <= 0 or size > MAX_VIDEO_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Upload size must be between 1 byte and {MAX_VIDEO_SIZE / (1024 * 1024):.0f}MB"
+        )
+    upload_id = uuid.uuid4().hex
+    session = {"id": upload_id, "user_id": user_id, "size": size, "offset": 0, **fields}
+
+    await anyio.Path(PARTIAL_UPLOAD_DIR).mkdir(parents=True, exist_ok=True)
+    await (await anyio.open_file(partial_upload_path(upload_id), "wb")).aclose()
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(upload_session_key(upload_id), mapping={k: "" if v is None else v for k, v in session.items()})
+            pipe.expire(upload_session_key(upload_id), UPLOAD_SESSION_TTL)
+            await pipe.execute()
+    except redis.RedisError as e:
+        await discard_uploads(partial_upload_path(upload_id))
+        raise _upload_service_unavailable(e)
+    return session
+
+
+async def get_upload_session(upload_id: str, user_id: int):
+    try:
+        raw = await redis_client.hgetall(upload_session_key(upload_id))
+    except redis.RedisError as e:
+        raise _upload_service_unavailable(e)
+    session = {k.decode(): v.decode() for k, v in raw.items()}
+    if "user_id" not in session or int(session["user_id"]) != user_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found or expired")
+    session["user_id"] = int(session["user_id"])
+    session["size"] = int(session["size"])
+    session["offset"] = int(session["offset"])
+    return session
+
+
+async def append_upload_chunk(session: dict, offset: int, chunks):
+    # chunks is an async iterator of bytes (the raw request body), written straight into the .part file
+    key = upload_session_key(session["id"])
+    lock = UploadLock(session["id"])
+    await lock.acquire()
+    try:
+        try:
+            current = await redis_client.hget(key, "offset")
+        except redis.RedisError as e:
+            raise _upload_service_unavailable(e)
+        if current is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found or expired")
+        if offset != int(current):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Offset mismatch, upload is at {int(current)}"
+            )
+
+        written = offset
+        try:
+            async with await anyio.open_file(partial_upload_path(session["id"]), "r+b") as f:
+                # anything past the recorded offset is from a chunk that never got acknowledged
+                await f.truncate(offset)
+                await f.seek(offset)
+                try:
+                    async for chunk in chunks:
+                        await lock.extend()
+                        if written + len(chunk) > session["size"]:
+                            await f.truncate(written)
+                            raise HTTPException(
+                                status_code=status.HTTP_400_BAD_REQUEST,
+                                detail="Chunk goes past the declared upload size"
+                            )
+                        await f.write(chunk)
+                        written += len(chunk)
+                except ClientDisconnect:
+                    # keep what arrived, the client resumes from the offset it reads back
+                    pass
+        except FileNotFoundError:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found or expired")
+        finally:
+            if not lock.lost:
+                try:
+                    async with redis_client.pipeline(transaction=True) as pipe:
+                        pipe.hset(key, "offset", written)
+                        pipe.expire(key, UPLOAD_SESSION_TTL)
+                        await pipe.execute()
+                except redis.RedisError as e:
+                    print(f"Redis error in append_upload_chunk: {e}")
+    finally:
+        await lock.release()
+
+    session["offset"] = written
+    return session
+
+
+async def finish_upload_session(session: dict, allowed_types: set) -> SavedUpload:
+    # under the chunk lock, so a chunk PUT still writing can't have its file moved away mid-write
+    lock = UploadLock(session["id"])
+    await lock.acquire()
+    try:
+        try:
+            current = await redis_client.hget(upload_session_key(session["id"]), "offset")
+        except redis.RedisError as e:
+            raise _upload_service_unavailable(e)
+        if current is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found or expired")
+        session["offset"] = int(current)
+        return await _finish_upload_session(session, allowed_types)
+    finally:
+        await lock.release()
+
+
+async def _finish_upload_session(session: dict, allowed_types: set) -> SavedUpload:
+    if session["offset"] != session["size"]:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload incomplete, {session['offset']} of {session['size']} bytes received"
+        )
+    part_path = partial_upload_path(session["id"])
+    async with await anyio.open_file(part_path, "rb") as f:
+        media_type = sniff_media_type(await f.read(16))
+    if media_type not in allowed_types:
+        await delete_upload_session(session["id"])
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid file type. Allowed types: {_describe(allowed_types)}"
+        )
+    max_size = MAX_VIDEO_SIZE if media_type.startswith("video/") else MAX_IMAGE_SIZE
+    if session["size"] > max_size:
+        await delete_upload_session(session["id"])
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"File too large. Max size: {max_size / (1024 * 1024):.0f}MB"
+        )
+
+    saved = await place_upload(part_path, session["user_id"], media_type, session["size"])
+    await delete_upload_session(session["id"])
+    return saved
+
+
+async def delete_upload_session(upload_id: str):
+    try:
+        await redis_client.delete(upload_session_key(upload_id))
+    except redis.RedisError as e:
+        print(f"Redis error in delete_upload_session: {e}")
+    await discard_uploads(partial_upload_path(upload_id))
+
+
+async def abort_upload_session(upload_id: str):
+    # takes the chunk lock like complete does, a chunk PUT still writing would otherwise recreate the session's
+    # offset and keep appending to the removed file
+    lock = UploadLock(upload_id)
+    await lock.acquire()
+    try:
+        await delete_upload_session(upload_id)
+    finally:
+        await lock.release()
+
+
+async def sweep_partial_uploads():
+    # a session's Redis hash just expires, its .part file is removed here once it hasn't grown for a full TTL
+    directory = anyio.Path(PARTIAL_UPLOAD_DIR)
+    if not await directory.exists():
+        return 0
+    cutoff = time.time() - UPLOAD_SESSION_TTL
+    removed = 0
+    async for path in directory.glob("*.part"):
+        try:
+            if (await path.stat()).st_mtime < cutoff:
+                await path.unlink(missing_ok=True)
+                removed += 1
+        except OSError as e:
+            print(f"Error sweeping partial upload {path}: {e}")
+    return removed
+
+
+async def run_partial_upload_sweeper():
+    while True:
+        try:
+            await sweep_partial_uploads()
+        except Exception as e:
+            print(f"Error sweeping partial uploads: {e}")
+        await asyncio.sleep(UPLOAD_SWEEP_INTERVAL)